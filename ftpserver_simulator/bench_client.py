@@ -0,0 +1,195 @@
+import argparse
+import ftplib
+import json
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+SERVER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'simulated_server.py')
+USER = 'dummy'
+PASSWORD = '12345'
+# the --users generated users log in as TEMPLATE_USER.format(n) with TEMPLATE_PASSWORD.format(n)
+TEMPLATE_USER = 'customer{:05d}'
+TEMPLATE_PASSWORD = 'pw{:05d}'
+
+
+def get_free_port(host):
+    sock = socket.socket()
+    sock.bind((host, 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def start_server(backend, host, port, home, args):
+    # runs simulated_server.py with a generated configuration, so every backend is measured the same way
+    config = {"SERVER": {"HOST": host, "PORT": port, "HOMEDIRECTORY_NAME": "FTPData",
+                         "HOMEDIRECTORY_PATH": home, "BACKEND": backend, "MAX_CONS": args.max_cons,
+                         "MAX_CONS_PER_IP": 0, "AC_IN_BUFFER_SIZE": args.buffer_size,
+                         "AC_OUT_BUFFER_SIZE": args.buffer_size},
+              "USER_DEFAULTS": {"PERM": "elradfmwMT"},
+              "USERS": [{"USERNAME": USER, "PASSWORD": PASSWORD}],
+              "USER_TEMPLATES": [{"COUNT": args.users, "USERNAME": TEMPLATE_USER, "PASSWORD": TEMPLATE_PASSWORD}]}
+    config_file = os.path.join(home, 'simulated_server_config.json')
+    with open(config_file, 'w') as f:
+        json.dump(config, f)
+
+    server = subprocess.Popen([sys.executable, SERVER_SCRIPT, '-c', config_file],
+                              stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    # creating the home directories of thousands of users takes a while
+    deadline = time.time() + 10 + args.users / 1000.0
+    while time.time() < deadline:
+        try:
+            socket.create_connection((host, port), timeout=1).close()
+            return server
+        except OSError:
+            time.sleep(0.1)
+    server.kill()
+    raise RuntimeError("simulated server (%s backend) did not start on port %d" % (backend, port))
+
+
+def write_files(directory, count, size):
+    os.makedirs(directory, exist_ok=True)
+    block = (b'ISA*00*          *00*          *ZZ*SENDER         *ZZ*RECEIVER       ~' * (size // 64 + 1))[:size]
+    for n in range(count):
+        with open(os.path.join(directory, 'EDI%07d.edi' % n), 'wb') as f:
+            f.write(block)
+
+
+def run_in_threads(target, clients):
+    results = [None] * clients
+    errors = []
+
+    def run(n):
+        try:
+            results[n] = target(n)
+        except (ftplib.Error, OSError) as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=run, args=(n,)) for n in range(clients)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return [result for result in results if result is not None], errors
+
+
+def measure_connections(host, port, clients, connections, users):
+    # connect, log in and quit as fast as possible from every client, spread over the generated users if any
+    def connect(n):
+        for i in range(connections):
+            ftp = ftplib.FTP()
+            ftp.connect(host, port, timeout=30)
+            if users:
+                user = (n * connections + i) * 7919 % users
+                ftp.login(TEMPLATE_USER.format(user), TEMPLATE_PASSWORD.format(user))
+            else:
+                ftp.login(USER, PASSWORD)
+            ftp.quit()
+        return connections
+
+    start = time.perf_counter()
+    results, errors = run_in_threads(connect, clients)
+    elapsed = time.perf_counter() - start
+    return sum(results), len(errors), elapsed
+
+
+def measure_downloads(host, port, clients, file_names):
+    # every client takes the next file off a shared list and retrieves it, the server deletes it once sent
+    pending = list(reversed(file_names))
+    lock = threading.Lock()
+
+    def download(n):
+        received = [0]
+
+        def count(data):
+            received[0] += len(data)
+
+        ftp = ftplib.FTP()
+        ftp.connect(host, port, timeout=30)
+        ftp.login(USER, PASSWORD)
+        while True:
+            with lock:
+                if not pending:
+                    break
+                file_name = pending.pop()
+            ftp.retrbinary('RETR ' + file_name, count, blocksize=65536)
+        ftp.quit()
+        return received[0]
+
+    start = time.perf_counter()
+    results, errors = run_in_threads(download, clients)
+    elapsed = time.perf_counter() - start
+    return sum(results), len(errors), elapsed
+
+
+def send_reloads(server, interval, stop):
+    # SIGHUP reloads the users while the sessions of the measurement are open
+    reloads = 0
+    while not stop.wait(interval):
+        server.send_signal(signal.SIGHUP)
+        reloads += 1
+    return reloads
+
+
+def run(backend, args):
+    home = tempfile.mkdtemp(prefix='ftp_bench_')
+    port = get_free_port(args.host)
+    server = start_server(backend, args.host, port, home, args)
+    stop = threading.Event()
+    reloader = None
+    if args.reload_every:
+        reloader = threading.Thread(target=send_reloads, args=(server, args.reload_every, stop), daemon=True)
+        reloader.start()
+    try:
+        connections, connection_errors, elapsed = measure_connections(args.host, port, args.clients,
+                                                                      args.connections, args.users)
+        print("%-12s connections=%d errors=%d elapsed=%.2fs connections/sec=%.1f" % (
+            backend, connections, connection_errors, elapsed, connections / elapsed))
+
+        user_home = os.path.join(home, 'FTPData', USER)
+        write_files(user_home, args.files, args.size)
+        file_names = sorted(os.listdir(user_home))
+        received, download_errors, elapsed = measure_downloads(args.host, port, args.clients, file_names)
+        print("%-12s files=%d errors=%d elapsed=%.2fs files/sec=%.1f MB/s=%.2f" % (
+            backend, len(file_names), download_errors, elapsed, len(file_names) / elapsed,
+            received / elapsed / 1024 / 1024))
+    finally:
+        stop.set()
+        if reloader:
+            reloader.join()
+        server.terminate()
+        server.wait()
+        shutil.rmtree(home, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load test of the simulated FTP server backends")
+    parser.add_argument('--backends', nargs='+', default=['single', 'threaded', 'multiprocess'],
+                        help='server backends to run')
+    parser.add_argument('--host', default='127.0.0.1', help='address the simulated server listens on')
+    parser.add_argument('--clients', type=int, default=32, help='number of concurrent client sessions')
+    parser.add_argument('--connections', type=int, default=20, help='connect/login/quit cycles per client')
+    parser.add_argument('--files', type=int, default=2000, help='number of EDI files to download')
+    parser.add_argument('--size', type=int, default=64 * 1024, help='size of each EDI file in bytes')
+    parser.add_argument('--max-cons', type=int, default=512, help='MAX_CONS of the simulated server')
+    parser.add_argument('--buffer-size', type=int, default=65536,
+                        help='AC_IN_BUFFER_SIZE and AC_OUT_BUFFER_SIZE of the simulated server')
+    parser.add_argument('--users', type=int, default=0,
+                        help='configure this many more users and log in as them in the connection test')
+    parser.add_argument('--reload-every', type=float, default=0,
+                        help='send SIGHUP to reload the users every this many seconds during the tests')
+    args = parser.parse_args()
+
+    for backend in args.backends:
+        run(backend, args)
+
+
+if __name__ == "__main__":
+    main()
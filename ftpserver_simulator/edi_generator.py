@@ -0,0 +1,267 @@
+import argparse
+import bisect
+import json
+import math
+import multiprocessing
+import os
+import random
+import threading
+import time
+
+# size of the preallocated body block, the body of a large file is written in chunks of this size
+BODY_BLOCK_SIZE = 256 * 1024
+# files written between two checks of the drop rate
+RATE_CHECK_BATCH = 1000
+# extension of the generated files
+EDI_EXTENSION = '.x12'
+
+ISA_HEADER = ("ISA*00*          *00*          *ZZ*SIMSENDER      *ZZ*SIMRECEIVER    *%(date6)s*%(time)s*U*00401*"
+              "%(control)09d*0*P*>~GS*%(group)s*SIMSENDER*SIMRECEIVER*%(date8)s*%(time)s*%(control)d*X*004010~"
+              "ST*%(type)s*0001~")
+ISA_TRAILER = "SE*%(segments)d*0001~GE*1*%(control)d~IEA*1*%(control)09d~"
+
+# transaction sets: functional group id, the opening segments and the segment group repeated to reach the file size
+TRANSACTION_SETS = {
+    '997': ('FA', "AK1*PO*%(control)d~",
+            "AK2*850*0001~AK5*A~"),
+    '810': ('IN', "BIG*%(date8)s*INV%(control)09d**PO%(control)09d~N1*ST*SIMULATED STORE*92*0001~",
+            "IT1*1*10*EA*12.50**VP*ITEM00001*UP*012345678905~PID*F****SIMULATED WIDGET~"),
+    '850': ('PO', "BEG*00*SA*PO%(control)09d**%(date8)s~N1*ST*SIMULATED STORE*92*0001~",
+            "PO1*1*10*EA*12.50**VP*ITEM00001*UP*012345678905~PID*F****SIMULATED WIDGET~")
+}
+
+# a burst of tiny acknowledgements with a few large invoice and purchase order batches
+DEFAULT_MIX = [
+    {"TYPE": "997", "WEIGHT": 995, "MIN_SIZE": 256, "MAX_SIZE": 2048},
+    {"TYPE": "810", "WEIGHT": 3, "MIN_SIZE": 64 * 1024, "MAX_SIZE": 32 * 1024 * 1024},
+    {"TYPE": "850", "WEIGHT": 2, "MIN_SIZE": 16 * 1024, "MAX_SIZE": 8 * 1024 * 1024}
+]
+
+
+class EDITemplate(object):
+    """
+    Preallocated X12 interchange of one transaction set type. Only the envelope is formatted per file, the body
+    is a run of identical segment groups written from one block built up front.
+    """
+
+    def __init__(self, transaction_type, min_size, max_size):
+        group, opening, unit = TRANSACTION_SETS[transaction_type]
+        self.transaction_type = transaction_type
+        self.group = group
+        self.opening = opening
+        self.unit = unit.encode('ascii')
+        self.unit_segments = unit.count('~')
+        self.opening_segments = opening.count('~')
+        self.block = self.unit * max(1, BODY_BLOCK_SIZE // len(self.unit))
+        self.min_size = min_size
+        self.max_size = max_size
+
+    def sample_size(self, rng):
+        # log-uniform, so a range of 1KB to 64MB gives as many small files as large ones per decade
+        if self.min_size >= self.max_size:
+            return self.min_size
+        return int(math.exp(rng.uniform(math.log(self.min_size), math.log(self.max_size))))
+
+    def write(self, fd, control, size, stamp):
+        fields = dict(stamp, type=self.transaction_type, group=self.group, control=control)
+        head = (ISA_HEADER % fields + self.opening % fields).encode('ascii')
+        units = max(1, (size - len(head) - 64) // len(self.unit))
+        fields['segments'] = units * self.unit_segments + self.opening_segments + 2
+        tail = (ISA_TRAILER % fields).encode('ascii')
+
+        body_size = units * len(self.unit)
+        if body_size <= len(self.block):
+            write_all(fd, head + self.block[:body_size] + tail)
+            return len(head) + body_size + len(tail)
+        write_all(fd, head)
+        remaining = body_size
+        while remaining > 0:
+            chunk = min(remaining, len(self.block))
+            write_all(fd, self.block[:chunk])
+            remaining -= chunk
+        write_all(fd, tail)
+        return len(head) + body_size + len(tail)
+
+
+class RateSchedule(object):
+    """
+    Drop rate over time from a list of [seconds, files per second] phases, repeated once the last one ends.
+    A rate of 0 pauses the drop for that phase, no phases at all means as fast as possible.
+    """
+
+    def __init__(self, phases, scale=1.0):
+        self.phases = [(float(seconds), float(rate) * scale) for seconds, rate in phases or []]
+        self.period = sum(seconds for seconds, rate in self.phases)
+        self.period_files = sum(seconds * rate for seconds, rate in self.phases)
+
+    def files_due(self, elapsed):
+        # number of files that should have been dropped after 'elapsed' seconds
+        if not self.period:
+            return None
+        cycles, offset = divmod(elapsed, self.period)
+        due = cycles * self.period_files
+        for seconds, rate in self.phases:
+            due += min(offset, seconds) * rate
+            offset -= seconds
+            if offset <= 0:
+                break
+        return int(due)
+
+
+class EDIGenerator(object):
+    """
+    Drops synthetic X12 files into the given directories round-robin, at the rate of the schedule. Files are
+    written under 'staging_dir' and renamed into place, so a client never lists a file that is half written.
+    """
+
+    def __init__(self, directories, staging_dir, mix=None, rate=None, count=0, seed=None, first_control=1,
+                 control_step=1):
+        self.directories = directories
+        self.staging_dir = staging_dir
+        self.templates = [EDITemplate(item['TYPE'], int(item['MIN_SIZE']), int(item['MAX_SIZE']))
+                          for item in mix or DEFAULT_MIX]
+        self.cum_weights = []
+        total = 0
+        for item in mix or DEFAULT_MIX:
+            total += float(item.get('WEIGHT', 1))
+            self.cum_weights.append(total)
+        self.schedule = rate if isinstance(rate, RateSchedule) else RateSchedule(rate)
+        self.count = count
+        self.rng = random.Random(seed)
+        self.control_step = control_step
+        self.files = 0
+        self.bytes = 0
+        self.stopped = threading.Event()
+        os.makedirs(staging_dir, exist_ok=True)
+        for directory in directories:
+            os.makedirs(directory, exist_ok=True)
+        # carry on after the files an earlier run left behind, a rename over one of them would replace it
+        last_control = get_last_control(directories)
+        self.control = first_control
+        if last_control >= first_control:
+            self.control += ((last_control - first_control) // control_step + 1) * control_step
+
+    def get_stamp(self):
+        now = time.localtime()
+        return {'date6': time.strftime('%y%m%d', now), 'date8': time.strftime('%Y%m%d', now),
+                'time': time.strftime('%H%M', now)}
+
+    def drop_file(self, stamp):
+        template = self.templates[bisect.bisect_right(self.cum_weights, self.rng.random() * self.cum_weights[-1])
+                                  if len(self.templates) > 1 else 0]
+        control = self.control % 1000000000 or 1
+        self.control += self.control_step
+        file_name = "%s_%s_%09d%s" % (template.transaction_type, stamp['date8'], control, EDI_EXTENSION)
+        staging_file = os.path.join(self.staging_dir, file_name)
+
+        fd = os.open(staging_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            size = template.write(fd, control, template.sample_size(self.rng), stamp)
+        finally:
+            os.close(fd)
+        os.rename(staging_file, os.path.join(self.directories[self.files % len(self.directories)], file_name))
+        self.files += 1
+        self.bytes += size
+
+    def run(self):
+        start = time.time()
+        while not self.stopped.is_set() and (not self.count or self.files < self.count):
+            due = self.schedule.files_due(time.time() - start)
+            batch = RATE_CHECK_BATCH if due is None else min(due - self.files, RATE_CHECK_BATCH)
+            if self.count:
+                batch = min(batch, self.count - self.files)
+            if batch <= 0:
+                self.stopped.wait(0.01)
+                continue
+            stamp = self.get_stamp()
+            for _ in range(batch):
+                self.drop_file(stamp)
+        return self.files, self.bytes
+
+    def start(self):
+        # keeps dropping files in the background while clients download
+        thread = threading.Thread(target=self.run, name='edi-generator', daemon=True)
+        thread.start()
+        return thread
+
+    def stop(self):
+        self.stopped.set()
+
+
+def get_last_control(directories):
+    # highest control number in the names of the generated files already in the directories, 0 when there are none
+    last_control = 0
+    for directory in directories:
+        with os.scandir(directory) as entries:
+            for entry in entries:
+                name, extension = os.path.splitext(entry.name)
+                control = name.rpartition('_')[2]
+                if extension == EDI_EXTENSION and control.isdigit():
+                    last_control = max(last_control, int(control))
+    return last_control
+
+
+def write_all(fd, data):
+    view = memoryview(data)
+    while view:
+        view = view[os.write(fd, view):]
+
+
+def get_generator(directories, staging_dir, generatorPARMS, workers=1, worker=0):
+    # the GENERATOR section of the simulator configuration, split between 'workers' processes
+    count = int(generatorPARMS.get('COUNT', 0))
+    if count and workers > 1:
+        count = count // workers + (1 if worker < count % workers else 0)
+    seed = generatorPARMS.get('SEED', None)
+    return EDIGenerator(directories, staging_dir, generatorPARMS.get('MIX'),
+                        RateSchedule(generatorPARMS.get('RATE'), 1.0 / workers), count,
+                        None if seed is None else int(seed) + worker, first_control=worker + 1, control_step=workers)
+
+
+def generate_in_process(args):
+    directories, staging_dir, generatorPARMS, workers, worker = args
+    return get_generator(directories, staging_dir, generatorPARMS, workers, worker).run()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Synthetic X12 EDI corpus generator")
+    parser.add_argument('-d', '--directory', dest='directories', nargs='+', required=True,
+                        help='directories to drop the files into, e.g. the FTPData user home directories')
+    parser.add_argument('-c', '--config', dest='filename',
+                        help='simulator configuration file with a GENERATOR section (MIX, RATE, COUNT, SEED)')
+    parser.add_argument('--count', type=int, help='number of files, overrides COUNT')
+    parser.add_argument('--seed', type=int, help='random seed, overrides SEED')
+    parser.add_argument('--no-rate', action='store_true', help='ignore RATE and generate as fast as possible')
+    parser.add_argument('--workers', type=int, default=1, help='number of generator processes')
+    args = parser.parse_args()
+
+    generatorPARMS = {}
+    if args.filename:
+        with open(args.filename) as json_data_file:
+            generatorPARMS = dict(json.load(json_data_file).get('GENERATOR', {}))
+    if args.count is not None:
+        generatorPARMS['COUNT'] = args.count
+    if args.seed is not None:
+        generatorPARMS['SEED'] = args.seed
+    if args.no_rate:
+        generatorPARMS['RATE'] = None
+    if not generatorPARMS.get('COUNT') and not generatorPARMS.get('RATE'):
+        parser.error("a COUNT is needed when files are generated as fast as possible")
+
+    staging_dir = os.path.join(os.path.dirname(os.path.abspath(args.directories[0])), '.generator')
+    start = time.perf_counter()
+    if args.workers > 1:
+        jobs = [(args.directories, os.path.join(staging_dir, str(worker)), generatorPARMS, args.workers, worker)
+                for worker in range(args.workers)]
+        with multiprocessing.Pool(args.workers) as pool:
+            results = pool.map(generate_in_process, jobs)
+        files, total_bytes = sum(r[0] for r in results), sum(r[1] for r in results)
+    else:
+        files, total_bytes = get_generator(args.directories, staging_dir, generatorPARMS).run()
+    elapsed = time.perf_counter() - start
+    print("files=%d bytes=%d elapsed=%.2fs files/sec=%.1f MB/s=%.2f" % (
+        files, total_bytes, elapsed, files / elapsed, total_bytes / elapsed / 1024 / 1024))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,81 @@
+import multiprocessing
+import random
+import time
+
+# commands the listing faults apply to
+LIST_COMMANDS = ('LIST', 'NLST', 'MLSD')
+
+
+class FaultInjector(object):
+    """
+    Faults and latency from the FAULTS section of the simulator configuration. Every session gets its own
+    random sequence derived from SEED and the order the session connected in, so a scenario replays the
+    same way for the same sequence of connections. The session numbers come from a counter in shared memory,
+    so with the multiprocess backend the sessions of different processes still get numbers of their own, in
+    the order they connected. Which client connects in which order, and how the sessions interleave, is up
+    to the clients and the scheduler; a run with concurrent clients replays only as far as those do.
+    """
+
+    def __init__(self, faultPARMS):
+        self.seed = faultPARMS.get('SEED', 0)
+        # seconds to wait before running a command, '*' applies to every command without its own entry
+        self.command_delay = dict((cmd.upper(), float(delay))
+                                  for cmd, delay in faultPARMS.get('COMMAND_DELAY', {}).items())
+        # bytes per second a session can download, 0 means no limit
+        self.bandwidth = int(faultPARMS.get('BANDWIDTH', 0))
+        # chance that a download drops the session at a random point of the file
+        self.disconnect_rate = float(faultPARMS.get('DISCONNECT_RATE', 0))
+        # seconds before a directory listing is sent and the chance it is cut short
+        self.list_delay = float(faultPARMS.get('LIST_DELAY', 0))
+        self.partial_list_rate = float(faultPARMS.get('PARTIAL_LIST_RATE', 0))
+        # number of the next session, shared with the processes forked for the sessions
+        self.sessions = multiprocessing.Value('q', 0)
+
+    def session(self):
+        with self.sessions.get_lock():
+            number = self.sessions.value
+            self.sessions.value += 1
+        return SessionFaults(self, random.Random("%s:%d" % (self.seed, number)))
+
+
+class SessionFaults(object):
+    """
+    Fault decisions of one client session.
+    """
+
+    def __init__(self, injector, rng):
+        self.injector = injector
+        self.rng = rng
+        self.started = time.time()
+        self.bytes_sent = 0
+
+    def get_command_delay(self, cmd):
+        delays = self.injector.command_delay
+        return delays.get(cmd.upper(), delays.get('*', 0))
+
+    def get_cut_fraction(self):
+        # None, or how far into the file the session is dropped; both draws happen for every transfer
+        # so the sequence does not depend on which transfers were cut
+        cut, fraction = self.rng.random(), self.rng.random()
+        return fraction if cut < self.injector.disconnect_rate else None
+
+    def get_list_limit(self, count):
+        # number of listing entries to send
+        partial, fraction = self.rng.random(), self.rng.random()
+        return int(count * fraction) if partial < self.injector.partial_list_rate else count
+
+    def throttle(self, nbytes):
+        # sleeps long enough to keep the session under BANDWIDTH, for servers that block per session
+        if not self.injector.bandwidth:
+            return
+        self.bytes_sent += nbytes
+        ahead = self.bytes_sent / float(self.injector.bandwidth) - (time.time() - self.started)
+        if ahead > 0:
+            time.sleep(ahead)
+
+
+def get_fault_injector(data):
+    faultPARMS = data.get('FAULTS', {})
+    if not faultPARMS.get('ENABLED', False):
+        return None
+    return FaultInjector(faultPARMS)
@@ -1,32 +1,203 @@
 import logging
 import os
+import signal
 
-from pyftpdlib.handlers import FTPHandler
-from pyftpdlib.servers import FTPServer
-from pyftpdlib.authorizers import DummyAuthorizer
+from pyftpdlib.handlers import FTPHandler, DTPHandler, ThrottledDTPHandler
+from pyftpdlib.servers import FTPServer, ThreadedFTPServer, MultiprocessFTPServer
+from pyftpdlib.authorizers import DummyAuthorizer, AuthenticationFailed
 import json
 import argparse
 
+import edi_generator
+import fault_injection
+import simulated_users
+
 logfileName = os.path.join(os.path.dirname(__file__), 'simulated_ftp_server.log')
 logging.basicConfig(filename=logfileName, level=logging.INFO)
 
+# FTP commands that store a file, refused once the user is over QUOTA
+UPLOAD_COMMANDS = ('STOR', 'APPE', 'STOU')
+
+# BACKEND in the SERVER configuration: one IO loop for everything, a thread per session or a process per session
+SERVER_BACKENDS = {
+    'single': FTPServer,
+    'threaded': ThreadedFTPServer,
+    'multiprocess': MultiprocessFTPServer
+}
+
+
+class MyDTPHandler(DTPHandler):
+    # own subclass so the buffer sizes from the configuration do not change pyftpdlib's DTPHandler
+    pass
+
+
+class MyThrottledDTPHandler(ThrottledDTPHandler):
+    # data channel of users with a BANDWIDTH limit, see get_user_dtp_handler()
+    pass
+
+
+# (data channel class, bandwidth): its throttled subclass, one per limit in use
+user_dtp_handlers = {}
+
+
+def get_user_dtp_handler(dtp_handler, bandwidth):
+    if not bandwidth:
+        return dtp_handler
+    key = (dtp_handler, bandwidth)
+    user_dtp_handler = user_dtp_handlers.get(key)
+    if user_dtp_handler is None:
+        base = dtp_handler if issubclass(dtp_handler, ThrottledDTPHandler) else MyThrottledDTPHandler
+        # the FAULTS BANDWIDTH still applies when it is lower
+        write_limit = min(limit for limit in (base.write_limit, bandwidth) if limit)
+        user_dtp_handler = type('%s%d' % (base.__name__, bandwidth), (base,), {
+            'read_limit': bandwidth, 'write_limit': write_limit,
+            'ac_in_buffer_size': dtp_handler.ac_in_buffer_size, 'ac_out_buffer_size': dtp_handler.ac_out_buffer_size})
+        user_dtp_handlers[key] = user_dtp_handler
+    return user_dtp_handler
+
+
+class UserTableAuthorizer(DummyAuthorizer):
+    """
+    pyftpdlib authorizer on the simulator's UserTable, which can be reloaded while sessions are open.
+    Every call is a single dict lookup, however many users there are.
+    """
+
+    def __init__(self, users):
+        super(UserTableAuthorizer, self).__init__()
+        self.users = users
+
+    def add_user(self, username, password, homedir, perm='elr', msg_login=None, msg_quit=None, quota=0,
+                 bandwidth=0):
+        # adds to the UserTable until the next reload, which only keeps the users of the configuration.
+        # The login and quit messages are the simulator's own for every user.
+        entry = {'USERNAME': username, 'PASSWORD': password, 'HOME': homedir, 'PERM': perm, 'QUOTA': quota,
+                 'BANDWIDTH': bandwidth}
+        self.users.add(simulated_users.make_user(entry, {}, homedir))
+
+    def validate_authentication(self, username, password, handler):
+        if self.users.authenticate(username, password) is None:
+            raise AuthenticationFailed("Authentication failed.")
+
+    def has_user(self, username):
+        return self.users.lookup(username) is not None
+
+    def get_home_dir(self, username):
+        return self.users.lookup(username).home
+
+    def get_perms(self, username):
+        user = self.users.lookup(username)
+        return user.perm if user else ''
+
+    def has_perm(self, username, perm, path=None):
+        return perm in self.get_perms(username)
+
+    def get_msg_login(self, username):
+        return "Login successful."
+
+    def get_msg_quit(self, username):
+        return "Goodbye."
+
+
+class MyFaultyDTPHandler(ThrottledDTPHandler):
+    """
+    Data channel used when FAULTS is enabled: throttled to BANDWIDTH (write_limit) and, for some downloads,
+    drops the whole session part way through the file.
+    """
+
+    def __init__(self, sock, cmd_channel):
+        super(MyFaultyDTPHandler, self).__init__(sock, cmd_channel)
+        self.cut_fraction = cmd_channel.faults.get_cut_fraction() if cmd_channel.faults else None
+        self.cut_at = None
+
+    def send(self, data):
+        sent = super(MyFaultyDTPHandler, self).send(data)
+        if self.cut_fraction is not None and self.file_obj is not None:
+            if self.cut_at is None:
+                self.cut_at = int(os.fstat(self.file_obj.fileno()).st_size * self.cut_fraction)
+            if self.tot_bytes_sent >= self.cut_at:
+                print("%s:%s disconnected after %d bytes of %s (fault injection)" % (
+                    self.cmd_channel.remote_ip, self.cmd_channel.remote_port, self.tot_bytes_sent,
+                    self.file_obj.name))
+                self.cut_fraction = None
+                self.cmd_channel.close()
+        return sent
+
 
 class MyHandler(FTPHandler):
+    dtp_handler = MyDTPHandler
+    # set from the FAULTS configuration, see fault_injection.py
+    fault_injector = None
+    faults = None
+    # the UserTable of the authorizer, and the user this session is logged in as
+    users = None
+    session_user = None
 
     def on_connect(self):
         print("%s:%s connected" % (self.remote_ip, self.remote_port))
+        if self.fault_injector:
+            self.faults = self.fault_injector.session()
+
+    def pre_process_command(self, line, cmd, arg):
+        if cmd in UPLOAD_COMMANDS and self.session_user and self.users.is_over_quota(self.session_user):
+            self.respond("552 Requested file action aborted. Exceeded storage allocation.")
+            return
+        delay = self.faults.get_command_delay(cmd) if self.faults else 0
+        if delay:
+            # delayed on the IO loop, so other sessions of the single backend keep going
+            self.ioloop.call_later(delay, self.process_delayed_command, line, cmd, arg, _errback=self.handle_error)
+        else:
+            super(MyHandler, self).pre_process_command(line, cmd, arg)
+
+    def process_delayed_command(self, line, cmd, arg):
+        if not self._closed:
+            super(MyHandler, self).pre_process_command(line, cmd, arg)
+
+    def push_dtp_data(self, data, isproducer=False, file=None, cmd=None):
+        if not self.faults or cmd not in fault_injection.LIST_COMMANDS:
+            return super(MyHandler, self).push_dtp_data(data, isproducer, file, cmd)
+
+        # slow or partial directory listings
+        if isproducer:
+            chunks = []
+            chunk = data.more()
+            while chunk:
+                chunks.append(chunk)
+                chunk = data.more()
+            data = b''.join(chunks)
+        lines = data.splitlines(True)
+        limit = self.faults.get_list_limit(len(lines))
+        data = b''.join(lines[:limit])
+        if self.fault_injector.list_delay:
+            self.ioloop.call_later(self.fault_injector.list_delay, self.push_delayed_data, data, file, cmd,
+                                   _errback=self.handle_error)
+        else:
+            super(MyHandler, self).push_dtp_data(data, False, file, cmd)
+
+    def push_delayed_data(self, data, file, cmd):
+        if not self._closed:
+            super(MyHandler, self).push_dtp_data(data, False, file, cmd)
 
     def on_disconnect(self):
         # do something when client disconnects
-        pass
+        self.end_user_session()
 
     def on_login(self, username):
         # do something when user login
-        pass
+        self.session_user = username
+        self.users.login(username)
+        user = self.users.lookup(username)
+        self.dtp_handler = get_user_dtp_handler(self.dtp_handler, user.bandwidth if user else 0)
 
     def on_logout(self, username):
         # do something when user logs out
-        pass
+        self.end_user_session()
+
+    def end_user_session(self):
+        # on_logout and on_disconnect can both come for the same session
+        if self.session_user:
+            self.users.logout(self.session_user)
+            self.session_user = None
+            self.dtp_handler = type(self).dtp_handler
 
     def on_file_sent(self, file):
         # do something when a file has been sent
@@ -74,21 +245,79 @@ def assure_path_exists(path):
         os.makedirs(path)
 
 
+def configure_buffers(handler, serverPARMS):
+    # the same buffer sizes are used for the control and the data channel
+    for name in ('ac_in_buffer_size', 'ac_out_buffer_size'):
+        value = serverPARMS.get(name.upper(), False)
+        if value:
+            setattr(handler, name, int(value))
+            setattr(handler.dtp_handler, name, int(value))
+
+
+def configure_faults(handler, fault_injector):
+    if not fault_injector:
+        return
+    handler.fault_injector = fault_injector
+    handler.dtp_handler = MyFaultyDTPHandler
+    handler.dtp_handler.write_limit = fault_injector.bandwidth
+    print("Fault injection enabled (seed %s)" % fault_injector.seed)
+
+
+def start_generator(users, DataFileHomeDirectory, generatorPARMS):
+    # keeps dropping synthetic EDI files into the users' home directories while clients download
+    usernames = [username for username in generatorPARMS.get('USERS', sorted(users.users)) if users.lookup(username)]
+    directories = [users.lookup(username).home for username in usernames]
+    generator = edi_generator.get_generator(directories, os.path.join(DataFileHomeDirectory, '.generator'),
+                                            generatorPARMS)
+    generator.start()
+    print("EDI generator started for %s" % ", ".join(usernames))
+    return generator
+
+
+def read_config(filename):
+    full_path_filename = os.path.join(os.path.dirname(__file__), filename)
+    with open(full_path_filename) as json_data_file:
+        return json.load(json_data_file)
+
+
+def load_users(users, data, DataFileHomeDirectory):
+    try:
+        users.load(data, DataFileHomeDirectory)
+    except (ValueError, OSError) as e:
+        print("Bad user configuration, the users are left as they were: %s" % e)
+        return False
+    print("%d users loaded" % len(users))
+    return True
+
+
+def install_reload_handler(filename, users, DataFileHomeDirectory):
+    # SIGHUP reloads the users from the configuration file, sessions already logged in are not dropped.
+    # The other sections are only read at startup.
+    def reload_users(signum, frame):
+        try:
+            data = read_config(filename)
+        except (OSError, ValueError) as e:
+            print("Configuration not reloaded: %s" % e)
+            return
+        load_users(users, data, DataFileHomeDirectory)
+
+    if hasattr(signal, 'SIGHUP'):
+        signal.signal(signal.SIGHUP, reload_users)
+
+
 def main():
     parser = argparse.ArgumentParser(description="Simulated FTP Server ")
     parser.add_argument("-c", "--config",
                         dest="filename", required=True, type=extant_file,
                         help="Server configuration file", metavar="FILE")
     args = parser.parse_args()
-    full_path_filename = os.path.join(os.path.dirname(__file__), args.filename)
-    with open(full_path_filename) as json_data_file:
-        data = json.load(json_data_file)
-    print(data)
+    data = read_config(args.filename)
+    print(dict((key, value) for key, value in data.items() if key not in ('USERS', 'USER_TEMPLATES')))
 
     serverPARMS = data.get('SERVER', False)
 
     HOST = serverPARMS.get('HOST', False)
-    PORT = serverPARMS.get('PORT', False)
+    PORT = int(serverPARMS.get('PORT', 0))
     HOMEDIRECTORY_NAME = serverPARMS.get('HOMEDIRECTORY_NAME', False)
     HOMEDIRECTORY_PATH = serverPARMS.get('HOMEDIRECTORY_PATH', False)
     if HOST and PORT and HOMEDIRECTORY_NAME:
@@ -96,20 +325,40 @@ def main():
             DataFileHomeDirectory = os.path.join(HOMEDIRECTORY_PATH, HOMEDIRECTORY_NAME)
         else:
             DataFileHomeDirectory = os.path.join(os.path.dirname(__file__), HOMEDIRECTORY_NAME)
-        # Instantiate a dummy authorizer for managing 'virtual' users
-        authorizer = DummyAuthorizer()
-        # Define a new user having full r/w permissions and a read-only
-        # add_user(username, password, homedir, perm="elr", msg_login="Login successful.", msg_quit="Goodbye.")
-        FTP_USER_DATAFILE_LOCATION = os.path.join(DataFileHomeDirectory, 'dev1')
-        assure_path_exists(FTP_USER_DATAFILE_LOCATION)
-        authorizer.add_user('dev1', '12345!', homedir=FTP_USER_DATAFILE_LOCATION, perm='elradfmwMT')
-        FTP_USER_DATAFILE_LOCATION = os.path.join(DataFileHomeDirectory, 'dummy')
-        assure_path_exists(FTP_USER_DATAFILE_LOCATION)
-        authorizer.add_user('dummy', '12345', homedir=FTP_USER_DATAFILE_LOCATION, perm='elradfmwMT')
+        users = simulated_users.UserTable()
+        if not load_users(users, data, DataFileHomeDirectory) or not len(users):
+            print("No users configured. Program exited")
+            return
+        install_reload_handler(args.filename, users, DataFileHomeDirectory)
+
+        generatorPARMS = data.get('GENERATOR', {})
+        if generatorPARMS.get('ENABLED', False):
+            start_generator(users, DataFileHomeDirectory, generatorPARMS)
+
+        fault_injector = fault_injection.get_fault_injector(data)
+
+        if serverPARMS.get('PROTOCOL', 'ftp') == 'sftp':
+            # paramiko is only needed for the SFTP mode
+            import simulated_sftp_server
+            simulated_sftp_server.serve_forever(HOST, PORT, users, serverPARMS, fault_injector)
+            return
+
+        # authorizer for the 'virtual' users of the configuration
         handler = MyHandler
-        handler.authorizer = authorizer
-        server = FTPServer((HOST, PORT), handler)
-        print("Server started...")
+        handler.authorizer = UserTableAuthorizer(users)
+        handler.users = users
+        configure_faults(handler, fault_injector)
+        configure_buffers(handler, serverPARMS)
+
+        BACKEND = serverPARMS.get('BACKEND', 'single')
+        if BACKEND not in SERVER_BACKENDS:
+            print("Unknown BACKEND '%s', expected one of %s. Program exited" % (BACKEND, sorted(SERVER_BACKENDS)))
+            return
+        server = SERVER_BACKENDS[BACKEND]((HOST, PORT), handler)
+        server.max_cons = int(serverPARMS.get('MAX_CONS', server.max_cons))
+        server.max_cons_per_ip = int(serverPARMS.get('MAX_CONS_PER_IP', server.max_cons_per_ip))
+        print("Server started (%s backend, max_cons=%d, max_cons_per_ip=%d)..." % (
+            BACKEND, server.max_cons, server.max_cons_per_ip))
         server.serve_forever()
     else:
         print("Missing or bad server configuration parameter(s). Program exited")
@@ -0,0 +1,295 @@
+import logging
+import os
+import socket
+import threading
+import time
+
+import paramiko
+
+import simulated_users
+
+logger = logging.getLogger(__name__)
+
+# generated at startup when the SERVER configuration has no HOST_KEY_FILE
+HOST_KEY_BITS = 2048
+# seconds a client has to finish the SSH handshake and authenticate
+AUTH_TIMEOUT = 30
+
+
+class SimulatedSSHServer(paramiko.ServerInterface):
+    """
+    Password authentication against the simulator's users and a session channel for the sftp subsystem.
+    """
+
+    def __init__(self, users, remote_address, transport, faults=None):
+        self.users = users
+        self.remote_address = remote_address
+        self.transport = transport
+        self.faults = faults
+        self.username = None
+        # the user's BANDWIDTH, set by the SFTP subsystem of the session
+        self.throttle = None
+
+    def get_allowed_auths(self, username):
+        return 'password'
+
+    def check_auth_password(self, username, password):
+        if self.username is None and self.users.authenticate(username, password) is not None:
+            self.username = username
+            self.users.login(username)
+            return paramiko.AUTH_SUCCESSFUL
+        return paramiko.AUTH_FAILED
+
+    def check_channel_request(self, kind, chanid):
+        if kind == 'session':
+            return paramiko.OPEN_SUCCEEDED
+        return paramiko.OPEN_FAILED_ADMINISTRATIVELY_PROHIBITED
+
+
+class SimulatedSFTPHandle(paramiko.SFTPHandle):
+    """
+    Open file of an SFTP session. A file that was opened for reading is removed when it is closed after
+    the client has read it to the end, like MyHandler.on_file_sent does for FTP.
+    """
+
+    def __init__(self, path, flags=0, server=None):
+        super(SimulatedSFTPHandle, self).__init__(flags)
+        self.path = path
+        self.flags = flags
+        self.size = os.path.getsize(path)
+        self.read_to = 0
+        self.server = server
+        self.faults = server.faults if server else None
+        cut_fraction = self.faults.get_cut_fraction() if self.faults else None
+        self.cut_at = int(self.size * cut_fraction) if cut_fraction is not None else None
+
+    def read(self, offset, length):
+        data = super(SimulatedSFTPHandle, self).read(offset, length)
+        if isinstance(data, bytes):
+            self.read_to = max(self.read_to, offset + len(data))
+            if self.server and self.server.throttle:
+                self.server.throttle.throttle(len(data))
+            if self.faults:
+                self.faults.throttle(len(data))
+                if self.cut_at is not None and self.read_to >= self.cut_at:
+                    print("%s:%s disconnected after %d bytes of %s (fault injection)" % (
+                        self.server.remote_address[0], self.server.remote_address[1], self.read_to, self.path))
+                    self.server.transport.close()
+        return data
+
+    def write(self, offset, data):
+        if self.server and self.server.throttle:
+            self.server.throttle.throttle(len(data))
+        return super(SimulatedSFTPHandle, self).write(offset, data)
+
+    def stat(self):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.fstat(self.readfile.fileno()))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def close(self):
+        super(SimulatedSFTPHandle, self).close()
+        if self.flags & (os.O_WRONLY | os.O_RDWR):
+            return
+        if self.read_to < self.size:
+            # partially sent, same as on_incomplete_file_sent: the file stays for the next attempt
+            return
+        if os.path.exists(self.path):
+            os.remove(self.path)
+            print("File: " + self.path + " has being removed since it has being sent to the caller.")
+        else:
+            print("Sorry, I can not remove %s file." % self.path)
+
+
+class SimulatedSFTPServer(paramiko.SFTPServerInterface):
+    """
+    SFTP file operations, confined to the home directory of the logged in user and checked against the
+    user's PERM letters (as pyftpdlib reads them), QUOTA and BANDWIDTH.
+    """
+
+    def __init__(self, server, *args, **kwargs):
+        super(SimulatedSFTPServer, self).__init__(server, *args, **kwargs)
+        self.ssh_server = server
+        self.users = server.users
+        self.username = server.username
+        user = self.users.lookup(self.username)
+        self.root = user.home
+        self.faults = server.faults
+        server.throttle = simulated_users.Throttle(user.bandwidth) if user.bandwidth else None
+
+    def _realpath(self, path):
+        return self.root + self.canonicalize(path)
+
+    def _denied(self, perm):
+        # looked up on every operation, so a reload of the users applies to open sessions too
+        user = self.users.lookup(self.username)
+        return user is None or perm not in user.perm
+
+    def _delay(self, cmd):
+        # COMMAND_DELAY is keyed by the FTP command of the same operation, every session has its own thread
+        if self.faults:
+            delay = self.faults.get_command_delay(cmd)
+            if delay:
+                time.sleep(delay)
+
+    def list_folder(self, path):
+        self._delay('LIST')
+        if self._denied('l'):
+            return paramiko.SFTP_PERMISSION_DENIED
+        path = self._realpath(path)
+        try:
+            entries = []
+            for entry in os.scandir(path):
+                attr = paramiko.SFTPAttributes.from_stat(entry.stat())
+                attr.filename = entry.name
+                entries.append(attr)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        if self.faults:
+            # slow or partial directory listings
+            if self.faults.injector.list_delay:
+                time.sleep(self.faults.injector.list_delay)
+            entries = entries[:self.faults.get_list_limit(len(entries))]
+        return entries
+
+    def stat(self, path):
+        self._delay('SIZE')
+        if self._denied('l'):
+            return paramiko.SFTP_PERMISSION_DENIED
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.stat(self._realpath(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def lstat(self, path):
+        try:
+            return paramiko.SFTPAttributes.from_stat(os.lstat(self._realpath(path)))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+
+    def open(self, path, flags, attr):
+        writing = flags & (os.O_WRONLY | os.O_RDWR)
+        self._delay('STOR' if writing else 'RETR')
+        if self._denied(('a' if flags & os.O_APPEND else 'w') if writing else 'r'):
+            return paramiko.SFTP_PERMISSION_DENIED
+        if writing and self.users.is_over_quota(self.username):
+            return paramiko.SFTP_FAILURE
+        path = self._realpath(path)
+        try:
+            fd = os.open(path, flags, getattr(attr, 'st_mode', None) or 0o666)
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        if flags & os.O_WRONLY:
+            mode = 'ab' if flags & os.O_APPEND else 'wb'
+        elif flags & os.O_RDWR:
+            mode = 'a+b' if flags & os.O_APPEND else 'r+b'
+        else:
+            mode = 'rb'
+        try:
+            f = os.fdopen(fd, mode)
+        except OSError as e:
+            os.close(fd)
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        handle = SimulatedSFTPHandle(path, flags, self.ssh_server)
+        handle.filename = path
+        handle.readfile = f
+        handle.writefile = f
+        return handle
+
+    def remove(self, path):
+        self._delay('DELE')
+        if self._denied('d'):
+            return paramiko.SFTP_PERMISSION_DENIED
+        try:
+            os.remove(self._realpath(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def rename(self, oldpath, newpath):
+        self._delay('RNFR')
+        if self._denied('f'):
+            return paramiko.SFTP_PERMISSION_DENIED
+        try:
+            os.rename(self._realpath(oldpath), self._realpath(newpath))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def mkdir(self, path, attr):
+        if self._denied('m'):
+            return paramiko.SFTP_PERMISSION_DENIED
+        try:
+            os.mkdir(self._realpath(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+    def rmdir(self, path):
+        if self._denied('d'):
+            return paramiko.SFTP_PERMISSION_DENIED
+        try:
+            os.rmdir(self._realpath(path))
+        except OSError as e:
+            return paramiko.SFTPServer.convert_errno(e.errno)
+        return paramiko.SFTP_OK
+
+
+def get_host_key(serverPARMS):
+    host_key_file = serverPARMS.get('HOST_KEY_FILE', False)
+    if host_key_file:
+        return paramiko.RSAKey.from_private_key_file(host_key_file)
+    return paramiko.RSAKey.generate(HOST_KEY_BITS)
+
+
+def start_session(sock, address, host_key, users, sessions, faults):
+    # the SSH handshake runs in its own thread so a slow client never holds up accept()
+    print("%s:%s connected" % address)
+    transport = paramiko.Transport(sock)
+    transport.add_server_key(host_key)
+    transport.set_subsystem_handler('sftp', paramiko.SFTPServer, SimulatedSFTPServer)
+    server = SimulatedSSHServer(users, address, transport, faults)
+    try:
+        transport.start_server(server=server)
+        channel = transport.accept(AUTH_TIMEOUT)
+        if channel is None:
+            transport.close()
+            return
+        transport.join()
+    except (paramiko.SSHException, EOFError, OSError) as e:
+        logger.info("%s:%s session failed: %s" % (address[0], address[1], e))
+        transport.close()
+    finally:
+        if server.username:
+            users.logout(server.username)
+        if sessions:
+            sessions.release()
+
+
+def serve_forever(host, port, users, serverPARMS, fault_injector=None):
+    """
+    SFTP server for the users of simulated_server.py (a simulated_users.UserTable, which SIGHUP can reload
+    while sessions are open), every session on its own paramiko Transport. MAX_CONS caps the number of
+    concurrent sessions, 0 means no limit.
+    """
+    max_cons = int(serverPARMS.get('MAX_CONS', 0)) or None
+    sessions = threading.BoundedSemaphore(max_cons) if max_cons else None
+    host_key = get_host_key(serverPARMS)
+
+    listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    listener.bind((host, port))
+    listener.listen(max_cons or socket.SOMAXCONN)
+    print("SFTP server started (max_cons=%d)..." % (max_cons or 0))
+
+    while True:
+        sock, address = listener.accept()
+        if sessions and not sessions.acquire(blocking=False):
+            print("%s:%s refused, too many connections" % address)
+            sock.close()
+            continue
+        # fault sequences are handed out in the order sessions connect
+        faults = fault_injector.session() if fault_injector else None
+        threading.Thread(target=start_session, args=(sock, address, host_key, users, sessions, faults),
+                         daemon=True).start()
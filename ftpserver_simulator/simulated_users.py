@@ -0,0 +1,169 @@
+import os
+import threading
+import time
+
+# pyftpdlib's permission letters, the SFTP mode maps its operations onto the same ones
+PERMISSIONS = 'elradfmwMT'
+# seconds the disk usage of a home directory is reused for before it is measured again for a QUOTA check
+QUOTA_CHECK_INTERVAL = 5.0
+
+
+class SimulatedUser(object):
+    """
+    One entry of the USERS configuration.
+    """
+
+    def __init__(self, username, password, home, perm, quota=0, bandwidth=0):
+        self.username = username
+        self.password = password
+        self.home = home
+        self.perm = perm
+        # bytes the home directory may hold before uploads are refused, 0 means no limit
+        self.quota = quota
+        # bytes per second each session of the user can transfer, 0 means no limit
+        self.bandwidth = bandwidth
+
+
+class UserTable(object):
+    """
+    The simulator's users, built from the USERS, USER_TEMPLATES and USER_DEFAULTS sections. Lookups are one
+    dict access whatever the number of users. load() builds a new table and swaps it in, so a reload never
+    blocks a login. A user that a reload removes can no longer log in, its sessions still open keep working
+    with the entry they logged in with until they end.
+    """
+
+    def __init__(self):
+        self.users = {}
+        # users removed by a reload while they were logged in
+        self.retired = {}
+        self.sessions = {}
+        self.lock = threading.Lock()
+        self.usage = {}
+
+    def __len__(self):
+        return len(self.users)
+
+    def load(self, data, DataFileHomeDirectory):
+        # raises ValueError on a bad entry, the current users then stay as they are
+        users = read_users(data, DataFileHomeDirectory)
+        for user in users.values():
+            if not os.path.isdir(user.home):
+                os.makedirs(user.home)
+        with self.lock:
+            retired = {}
+            for username in self.sessions:
+                user = self.lookup(username)
+                if username not in users and user is not None:
+                    retired[username] = user
+            self.retired = retired
+            self.users = users
+        return users
+
+    def add(self, user):
+        # one more user, until the next load() builds the table from the configuration again
+        if not os.path.isdir(user.home):
+            os.makedirs(user.home)
+        with self.lock:
+            if user.username in self.users:
+                raise ValueError("user %s already exists" % user.username)
+            users = dict(self.users)
+            users[user.username] = user
+            self.users = users
+            self.retired.pop(user.username, None)
+
+    def lookup(self, username):
+        user = self.users.get(username)
+        if user is None:
+            user = self.retired.get(username)
+        return user
+
+    def authenticate(self, username, password):
+        user = self.users.get(username)
+        if user is not None and user.password == password:
+            return user
+        return None
+
+    def login(self, username):
+        with self.lock:
+            self.sessions[username] = self.sessions.get(username, 0) + 1
+
+    def logout(self, username):
+        with self.lock:
+            count = self.sessions.get(username, 0) - 1
+            if count > 0:
+                self.sessions[username] = count
+            else:
+                self.sessions.pop(username, None)
+                self.retired.pop(username, None)
+
+    def is_over_quota(self, username):
+        user = self.lookup(username)
+        if user is None or not user.quota:
+            return False
+        measured = self.usage.get(username)
+        if measured is None or time.time() - measured[0] > QUOTA_CHECK_INTERVAL:
+            measured = self.usage[username] = (time.time(), get_disk_usage(user.home))
+        return measured[1] >= user.quota
+
+
+class Throttle(object):
+    # keeps one session under the user's BANDWIDTH, for servers that block per session
+
+    def __init__(self, bandwidth):
+        self.bandwidth = bandwidth
+        self.started = time.time()
+        self.nbytes = 0
+
+    def throttle(self, nbytes):
+        if not self.bandwidth:
+            return
+        self.nbytes += nbytes
+        ahead = self.nbytes / float(self.bandwidth) - (time.time() - self.started)
+        if ahead > 0:
+            time.sleep(ahead)
+
+
+def get_disk_usage(path):
+    total = 0
+    for directory, _, files in os.walk(path):
+        for name in files:
+            try:
+                total += os.path.getsize(os.path.join(directory, name))
+            except OSError:
+                # downloaded and removed in the meantime
+                pass
+    return total
+
+
+def make_user(entry, defaults, DataFileHomeDirectory):
+    settings = dict(defaults)
+    settings.update(entry)
+    username = settings.get('USERNAME')
+    if not username or 'PASSWORD' not in settings:
+        raise ValueError("user entry without USERNAME or PASSWORD: %r" % (entry,))
+    perm = settings.get('PERM', 'elr')
+    unknown = set(perm) - set(PERMISSIONS)
+    if unknown:
+        raise ValueError("user %s: unknown permission(s) %s" % (username, ''.join(sorted(unknown))))
+    # HOME is relative to the home directory of the server, every user has their own by default
+    home = os.path.join(DataFileHomeDirectory, settings.get('HOME', username))
+    return SimulatedUser(username, str(settings['PASSWORD']), os.path.realpath(home), perm,
+                         int(settings.get('QUOTA', 0)), int(settings.get('BANDWIDTH', 0)))
+
+
+def read_users(data, DataFileHomeDirectory):
+    defaults = data.get('USER_DEFAULTS', {})
+    entries = list(data.get('USERS', []))
+    # USER_TEMPLATES: COUNT users each, n is filled into every string setting ("customer{:05d}")
+    for template in data.get('USER_TEMPLATES', []):
+        for n in range(int(template.get('COUNT', 0))):
+            entries.append(dict((key, value.format(n) if isinstance(value, str) else value)
+                                for key, value in template.items() if key != 'COUNT'))
+
+    users = {}
+    for entry in entries:
+        user = make_user(entry, defaults, DataFileHomeDirectory)
+        if user.username in users:
+            raise ValueError("user %s is configured twice" % user.username)
+        users[user.username] = user
+    return users
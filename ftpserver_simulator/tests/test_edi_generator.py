@@ -0,0 +1,51 @@
+import os
+
+import edi_generator
+
+MIX = [{"TYPE": "997", "WEIGHT": 1, "MIN_SIZE": 256, "MAX_SIZE": 512}]
+
+
+def controls(directory):
+    return sorted(int(os.path.splitext(name)[0].rpartition('_')[2]) for name in os.listdir(directory))
+
+
+def test_rate_schedule():
+    schedule = edi_generator.RateSchedule([[10, 5], [5, 0], [5, 2]])
+    assert schedule.files_due(0) == 0
+    assert schedule.files_due(4) == 20
+    assert schedule.files_due(12) == 50
+    assert schedule.files_due(17) == 54
+    # repeated once the last phase ends
+    assert schedule.files_due(24) == 60 + 20
+    assert edi_generator.RateSchedule(None).files_due(100) is None
+
+
+def test_generated_files_are_complete_interchanges(tmp_path):
+    home = str(tmp_path / 'home')
+    edi_generator.EDIGenerator([home], str(tmp_path / '.generator'), None, count=20, seed=1).run()
+    assert controls(home) == list(range(1, 21))
+    for name in os.listdir(home):
+        with open(os.path.join(home, name), 'rb') as f:
+            data = f.read()
+        assert data.startswith(b'ISA*') and data.endswith(b'~')
+        assert data.count(b'IEA*1*') == 1
+
+
+def test_restarted_generator_does_not_overwrite_earlier_files(tmp_path):
+    homes = [str(tmp_path / 'alice'), str(tmp_path / 'bob')]
+    staging_dir = str(tmp_path / '.generator')
+    edi_generator.EDIGenerator(homes, staging_dir, MIX, count=5).run()
+    edi_generator.EDIGenerator(homes, staging_dir, MIX, count=5).run()
+    assert sorted(controls(homes[0]) + controls(homes[1])) == list(range(1, 11))
+
+
+def test_restarted_workers_keep_their_own_control_numbers(tmp_path):
+    home = str(tmp_path / 'home')
+    staging_dir = str(tmp_path / '.generator')
+    edi_generator.EDIGenerator([home], staging_dir, MIX, count=3).run()
+
+    generators = [edi_generator.EDIGenerator([home], staging_dir + str(worker), MIX, count=2,
+                                             first_control=worker + 1, control_step=2) for worker in range(2)]
+    for generator in generators:
+        generator.run()
+    assert controls(home) == [1, 2, 3, 4, 5, 6, 7]
@@ -0,0 +1,46 @@
+import multiprocessing
+
+import fault_injection
+
+
+def get_injector(**faultPARMS):
+    faultPARMS.setdefault('ENABLED', True)
+    faultPARMS.setdefault('SEED', 7)
+    return fault_injection.get_fault_injector({'FAULTS': faultPARMS})
+
+
+def draws(faults, count=5):
+    return [faults.get_cut_fraction() for _ in range(count)]
+
+
+def test_same_seed_replays_the_same_sessions():
+    first, second = get_injector(DISCONNECT_RATE=0.5), get_injector(DISCONNECT_RATE=0.5)
+    sessions = [draws(first.session()) for _ in range(3)]
+    assert sessions == [draws(second.session()) for _ in range(3)]
+    assert sessions[0] != sessions[1]
+    assert draws(get_injector(DISCONNECT_RATE=0.5, SEED=8).session()) != sessions[0]
+
+
+def test_disabled():
+    assert fault_injection.get_fault_injector({}) is None
+    assert get_injector(ENABLED=False) is None
+
+
+def start_session(injector, results):
+    results.put(draws(injector.session(), 1))
+
+
+def test_forked_sessions_get_numbers_of_their_own():
+    # the multiprocess backend forks a process per session, the sessions started in them must not repeat the
+    # sequence of another process
+    injector = get_injector(DISCONNECT_RATE=1.0)
+    context = multiprocessing.get_context('fork')
+    results = context.Queue()
+    for _ in range(3):
+        process = context.Process(target=start_session, args=(injector, results))
+        process.start()
+        process.join()
+    forked = [results.get(timeout=5) for _ in range(3)]
+    replay = get_injector(DISCONNECT_RATE=1.0)
+    assert forked == [draws(replay.session(), 1) for _ in range(3)]
+    assert injector.sessions.value == 3
@@ -0,0 +1,120 @@
+import os
+
+import pytest
+
+import simulated_users
+
+
+def users(*names):
+    return {'USERS': [{'USERNAME': name, 'PASSWORD': name + '-secret'} for name in names]}
+
+
+@pytest.fixture
+def table(tmp_path):
+    table = simulated_users.UserTable()
+    table.load(users('alice', 'bob'), str(tmp_path))
+    return table
+
+
+def test_load_creates_the_home_directories(tmp_path, table):
+    assert len(table) == 2
+    assert os.path.isdir(str(tmp_path / 'alice'))
+    assert table.authenticate('alice', 'alice-secret').home == os.path.realpath(str(tmp_path / 'alice'))
+    assert table.authenticate('alice', 'wrong') is None
+    assert table.authenticate('carol', 'carol-secret') is None
+
+
+def test_reload_adds_and_removes_users(tmp_path, table):
+    table.load(users('bob', 'carol'), str(tmp_path))
+    assert table.authenticate('alice', 'alice-secret') is None
+    assert table.lookup('alice') is None
+    assert table.authenticate('carol', 'carol-secret') is not None
+
+
+def test_removed_user_keeps_the_sessions_already_logged_in(tmp_path, table):
+    alice = table.authenticate('alice', 'alice-secret')
+    table.login('alice')
+    table.login('alice')
+
+    table.load(users('bob'), str(tmp_path))
+
+    # no new logins, the open sessions still find their entry
+    assert table.authenticate('alice', 'alice-secret') is None
+    assert table.lookup('alice') is alice
+    table.logout('alice')
+    assert table.lookup('alice') is alice
+    table.logout('alice')
+    assert table.lookup('alice') is None
+    assert table.retired == {}
+
+
+def test_retired_user_stays_retired_across_reloads(tmp_path, table):
+    alice = table.authenticate('alice', 'alice-secret')
+    table.login('alice')
+    table.load(users('bob'), str(tmp_path))
+    table.load(users('bob', 'carol'), str(tmp_path))
+    assert table.lookup('alice') is alice
+    # added back, new logins get the new entry
+    table.load(users('alice', 'bob'), str(tmp_path))
+    assert table.lookup('alice') is not alice
+    assert table.retired == {}
+
+
+def test_bad_reload_keeps_the_current_users(tmp_path, table):
+    with pytest.raises(ValueError):
+        table.load({'USERS': [{'USERNAME': 'carol'}]}, str(tmp_path))
+    with pytest.raises(ValueError):
+        table.load(users('carol', 'carol'), str(tmp_path))
+    with pytest.raises(ValueError):
+        table.load({'USERS': [{'USERNAME': 'carol', 'PASSWORD': 'x', 'PERM': 'elrX'}]}, str(tmp_path))
+    assert sorted(table.users) == ['alice', 'bob']
+
+
+def test_templates_and_defaults(tmp_path):
+    data = {
+        'USER_DEFAULTS': {'PERM': 'elradfmw', 'QUOTA': 1000},
+        'USER_TEMPLATES': [{'COUNT': 3, 'USERNAME': 'customer{:05d}', 'PASSWORD': 'pw{}', 'HOME': 'shared'}],
+        'USERS': [{'USERNAME': 'admin', 'PASSWORD': 'admin', 'QUOTA': 0}]
+    }
+    users = simulated_users.read_users(data, str(tmp_path))
+    assert sorted(users) == ['admin', 'customer00000', 'customer00001', 'customer00002']
+    assert users['customer00002'].password == 'pw2'
+    assert users['customer00002'].home == os.path.realpath(str(tmp_path / 'shared'))
+    assert (users['customer00000'].perm, users['customer00000'].quota) == ('elradfmw', 1000)
+    assert users['admin'].quota == 0
+
+
+def test_quota(tmp_path, monkeypatch):
+    table = simulated_users.UserTable()
+    table.load({'USERS': [{'USERNAME': 'alice', 'PASSWORD': 'x', 'QUOTA': 100}]}, str(tmp_path))
+    assert not table.is_over_quota('alice')
+    (tmp_path / 'alice' / 'EDI.edi').write_bytes(b'x' * 100)
+    # measured again only after QUOTA_CHECK_INTERVAL
+    assert not table.is_over_quota('alice')
+    monkeypatch.setattr(simulated_users, 'QUOTA_CHECK_INTERVAL', -1)
+    assert table.is_over_quota('alice')
+
+
+def test_added_user_lasts_until_the_next_reload(tmp_path, table):
+    table.add(simulated_users.make_user({'USERNAME': 'carol', 'PASSWORD': 'x'}, {}, str(tmp_path)))
+    assert os.path.isdir(str(tmp_path / 'carol'))
+    assert table.authenticate('carol', 'x') is not None
+    with pytest.raises(ValueError):
+        table.add(simulated_users.make_user({'USERNAME': 'alice', 'PASSWORD': 'x'}, {}, str(tmp_path)))
+    assert table.authenticate('alice', 'alice-secret') is not None
+
+    table.load(users('alice', 'bob'), str(tmp_path))
+    assert table.authenticate('carol', 'x') is None
+
+
+def test_authorizer_add_user(tmp_path, table):
+    pytest.importorskip('pyftpdlib')
+    import simulated_server
+
+    authorizer = simulated_server.UserTableAuthorizer(table)
+    authorizer.add_user('carol', 'x', str(tmp_path / 'shared'), perm='elradfmw', quota=100)
+    assert authorizer.has_user('carol')
+    assert authorizer.has_perm('carol', 'w')
+    assert table.lookup('carol').quota == 100
+    with pytest.raises(ValueError):
+        authorizer.add_user('dave', 'x', str(tmp_path), perm='elrX')
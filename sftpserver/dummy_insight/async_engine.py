@@ -0,0 +1,473 @@
+import asyncio
+import base64
+import collections
+import contextlib
+import hashlib
+import logging
+import os
+import posixpath
+import time
+
+import pipeline_metrics
+import rate_limits
+import transfer_manifest
+import transfer_schedule
+
+# asyncssh, aiobotocore and aio-pika are only imported by the functions that open the real connections, the
+# engine itself runs against anything with the same methods (benchmarks/standins.py)
+
+# the messages go to the downloader's log
+logger = logging.getLogger('dummydownloader.async_engine')
+
+# concurrent SFTP reads, S3 uploads and confirmed publishes of a feed, the queues between the stages hold twice
+# as many files as the stage after them works on, so downloads wait when uploads fall behind and uploads wait
+# when publishes do
+ASYNC_DOWNLOADS = 8
+ASYNC_UPLOADS = 8
+ASYNC_PUBLISHES = 16
+# bytes asked for in one read, asyncssh splits it into pipelined SFTP requests
+ASYNC_BLOCK_SIZE = 1024 * 1024
+# same as dummydownloader's, the start-up scan ignores downloads in progress
+PARTIAL_SUFFIX = '.part'
+# seconds between two looks at an adaptive limit that has no room, its controller is shared with threads
+LIMIT_POLL = 0.05
+
+# ftp_client settings the engine does not implement, as well as transfer_mode 'stream': the feeds that set them
+# run on the blocking engine
+UNSUPPORTED_SETTINGS = ('strict_order', 'content_index_file', 'batch_format')
+
+# a file of the remote listing, with the attributes the listing cache and the schedule look at
+RemoteEntry = collections.namedtuple('RemoteEntry', ('filename', 'st_size', 'st_mtime', 'st_mode'))
+
+
+class Transfer(object):
+    # a file in download_dir on its way through the upload and publish stages
+
+    def __init__(self, filename, size, mtime, content_md5, s3_key=None, manifest_key=None, part_md5s=None):
+        self.filename = filename
+        self.size = size
+        self.mtime = mtime
+        self.content_md5 = content_md5
+        # hex MD5 of every multipart part, taken while downloading, None for the files found in download_dir
+        self.part_md5s = part_md5s
+        self.s3_key = s3_key
+        # key of the file's entry in the transfer manifest
+        self.manifest_key = manifest_key
+
+    @property
+    def date_prefix(self):
+        # same as dummydownloader.get_s3_date_prefix_from_mtime
+        return time.strftime("%Y/%m/%d/", time.localtime(self.mtime))
+
+
+def get_unsupported_settings(feed_type, config):
+    # the settings of the feed's ftp_client config the engine would ignore
+    ftp_client = config[feed_type]['ftp_client']
+    settings = [name for name in UNSUPPORTED_SETTINGS if ftp_client.get(name)]
+    if ftp_client.get('transfer_mode') == 'stream':
+        settings.append('transfer_mode')
+    return settings
+
+
+def read_file(local_filename, offset=0, length=-1):
+    with open(local_filename, 'rb') as f:
+        f.seek(offset)
+        return f.read(length)
+
+
+def get_file_md5(local_filename):
+    content_hash = hashlib.md5()
+    with open(local_filename, 'rb') as f:
+        for block in iter(lambda: f.read(ASYNC_BLOCK_SIZE), b''):
+            content_hash.update(block)
+    return content_hash.hexdigest()
+
+
+def get_content_md5(content_md5):
+    # Content-MD5 header value of a hex MD5
+    return base64.b64encode(bytes.fromhex(content_md5)).decode('ascii')
+
+
+def update_part_hashes(part_hashes, part_size, position, block):
+    # the MD5 of every part_size part of a file, fed with the block read at 'position'
+    view = memoryview(block)
+    while view:
+        part, offset = divmod(position, part_size)
+        if part == len(part_hashes):
+            part_hashes.append(hashlib.md5())
+        chunk = view[:part_size - offset]
+        part_hashes[part].update(chunk)
+        position += len(chunk)
+        view = view[len(chunk):]
+
+
+async def acquire_limit(limit):
+    # RateLimit.acquire without blocking the event loop
+    while True:
+        started = limit.acquire(0)
+        if started is not None:
+            return started
+        await asyncio.sleep(LIMIT_POLL)
+
+
+async def throttle(limit, nbytes):
+    delay = limit.reserve(nbytes)
+    if delay:
+        await asyncio.sleep(delay)
+
+
+class AsyncFeedCycle(object):
+    """
+    One download/publish cycle of a feed on an asyncio event loop, the --engine async counterpart of
+    download_and_publish. Download, upload and publish run as pools of tasks ('async_downloads', 'async_uploads'
+    and 'async_publishes' in the ftp_client config) joined by bounded queues. The files left in download_dir by
+    an earlier run go through the upload and publish stages first, like publish_files does at start-up.
+
+    Every file keeps the guarantees of the blocking engine: it is uploaded (with the Content-MD5 taken while it
+    was downloaded) before its message is published, published with a broker confirm before it is deleted, and
+    recorded in the transfer manifest at every stage. Files are not published in listing order, each one goes
+    as soon as it is uploaded. After a failure no new work is started and the files still in the pipeline stay
+    in download_dir (or on the server) for the next cycle; after shutdown no new download is started but the
+    files already downloaded are still uploaded and published.
+
+    'select' filters the remote listing (listing cache, manifest), 'on_downloaded' is called with every
+    downloaded entry and 'report_error' with the message of every failure, all on the event loop.
+
+    Downloads and uploads go through the same RateLimits of the server and the bucket as the blocking engine's:
+    every block waits for its bytes, and an adaptive limit caps how many of the tasks transfer at once.
+
+    Strict order, the content index, batches and the stream transfer_mode are not implemented, see
+    get_unsupported_settings.
+    """
+
+    def __init__(self, feed_type, config, download_dir, multipart, manifest=None, select=None, on_downloaded=None,
+                 report_error=None, shutdown_event=None):
+        ftp_client = config[feed_type]['ftp_client']
+        self.feed_type = feed_type
+        self.download_dir = download_dir
+        self.source_dir = config[feed_type]['sftp_server']['source_dir']
+        self.s3_bucket = ftp_client['s3_bucket']
+        self.multipart = multipart
+        self.manifest = manifest
+        self.select = select
+        self.on_downloaded = on_downloaded
+        self.report_error = report_error or logger.error
+        self.shutdown_event = shutdown_event
+        self.schedule = transfer_schedule.get_transfer_schedule(feed_type, config)
+        self.downloads = int(ftp_client.get('async_downloads', ASYNC_DOWNLOADS))
+        self.uploads = int(ftp_client.get('async_uploads', ASYNC_UPLOADS))
+        self.publishes = int(ftp_client.get('async_publishes', ASYNC_PUBLISHES))
+        self.block_size = int(ftp_client.get('async_block_size', ASYNC_BLOCK_SIZE))
+        # same as dummydownloader.get_s3_config
+        self.sftp_limit = rate_limits.get_sftp_limit(config[feed_type]['sftp_server'])
+        self.s3_limit = rate_limits.get_bucket_limit(self.s3_bucket, config[feed_type].get('s3', config['s3']),
+                                                     self.uploads)
+        self.metrics = pipeline_metrics.registry.feed(feed_type)
+        self.failed = None
+        self.published = 0
+
+    def fail(self, message):
+        logger.error(message)
+        self.report_error(message)
+        self.failed.set()
+
+    def is_stopping(self):
+        return self.failed.is_set() or (self.shutdown_event is not None and self.shutdown_event.is_set())
+
+    async def run(self, sftp, s3client, publisher):
+        # True when every file was published
+        self.failed = asyncio.Event()
+        self.published = 0
+        uploads = asyncio.Queue(self.uploads * 2)
+        publishes = asyncio.Queue(self.publishes * 2)
+
+        uploaders = [asyncio.ensure_future(self.upload_worker(s3client, uploads, publishes))
+                     for _ in range(self.uploads)]
+        publishers = [asyncio.ensure_future(self.publish_worker(publisher, publishes))
+                      for _ in range(self.publishes)]
+        try:
+            await self.recover(uploads, publishes)
+
+            downloads = asyncio.Queue()
+            try:
+                for entry in await self.list_files(sftp):
+                    downloads.put_nowait(entry)
+            except Exception as e:
+                self.fail("SFTP listing of " + self.source_dir + " failed. " + str(e))
+            message = str(downloads.qsize()) + " files to be downloaded."
+            logger.info(message)
+
+            await asyncio.gather(*[self.download_worker(sftp, downloads, uploads)
+                                   for _ in range(min(self.downloads, downloads.qsize()))])
+        finally:
+            # the workers stop at their None, after the files queued before it
+            for _ in uploaders:
+                await uploads.put(None)
+            await asyncio.gather(*uploaders)
+            for _ in publishers:
+                await publishes.put(None)
+            await asyncio.gather(*publishers)
+
+        message = str(self.published) + " files published."
+        logger.info(message)
+        return not self.failed.is_set()
+
+    async def list_files(self, sftp):
+        names = await sftp.readdir(self.source_dir)
+        entries = [RemoteEntry(name.filename, name.attrs.size, name.attrs.mtime, name.attrs.permissions)
+                   for name in names if name.filename not in ('.', '..')]
+        if self.select:
+            entries = self.select(entries)
+        return self.schedule.order(entries)
+
+    async def recover(self, uploads, publishes):
+        # the start-up scan of publish_files, with the same use of the transfer manifest
+        loop = asyncio.get_event_loop()
+        files = sorted(entry.name for entry in os.scandir(self.download_dir)
+                       if entry.is_file() and not entry.name.endswith(PARTIAL_SUFFIX))
+        if files:
+            message = "Start to publish " + str(len(files)) + " files in " + self.download_dir
+            logger.info(message)
+
+        for file in files:
+            if self.failed.is_set():
+                break
+            local_filename = os.path.join(self.download_dir, file)
+            unfinished = self.manifest.get_unfinished(file) if self.manifest else None
+            if self.manifest and unfinished is None and self.manifest.is_published(file):
+                # published by an earlier run which then failed to delete it
+                self.delete(file)
+                continue
+            file_stats = os.stat(local_filename)
+            content_md5 = await loop.run_in_executor(None, get_file_md5, local_filename)
+            transfer = Transfer(file, file_stats.st_size, file_stats.st_mtime, content_md5,
+                                manifest_key=unfinished and unfinished[3])
+            if unfinished and unfinished[0] >= transfer_manifest.UPLOADED:
+                transfer.s3_key = unfinished[1]
+                await publishes.put(transfer)
+            else:
+                await uploads.put(transfer)
+
+    async def download_worker(self, sftp, downloads, uploads):
+        while not self.is_stopping() and not downloads.empty():
+            entry = downloads.get_nowait()
+            try:
+                transfer = await self.download(sftp, entry)
+            except Exception as e:
+                self.fail(entry.filename + " failed to be downloaded to " + self.download_dir + ". " + str(e))
+                break
+            if self.manifest:
+                transfer.manifest_key = self.manifest.mark_downloaded(
+                    posixpath.join(self.source_dir, entry.filename), entry.st_size, entry.st_mtime, entry.filename)
+            if self.on_downloaded:
+                self.on_downloaded(entry)
+            # waits while the upload stage is full
+            await uploads.put(transfer)
+
+    async def download(self, sftp, entry):
+        # hashed on the way to disk like the blocking engine, an interrupted download starts over next time.
+        # A file uploaded in parts is hashed per part as well, for the Content-MD5 of each part.
+        local_filename = os.path.join(self.download_dir, entry.filename)
+        partial_filename = local_filename + PARTIAL_SUFFIX
+        content_hash = hashlib.md5()
+        part_hashes = [] if entry.st_size >= self.multipart['threshold'] else None
+        position = 0
+        started = await acquire_limit(self.sftp_limit)
+        error = True
+        try:
+            start = time.perf_counter()
+            async with sftp.open(posixpath.join(self.source_dir, entry.filename), 'rb') as remote_file:
+                with open(partial_filename, 'wb') as local_file:
+                    while True:
+                        block = await remote_file.read(self.block_size)
+                        if not block:
+                            break
+                        await throttle(self.sftp_limit, len(block))
+                        content_hash.update(block)
+                        if part_hashes is not None:
+                            update_part_hashes(part_hashes, self.multipart['part_size'], position, block)
+                            position += len(block)
+                        local_file.write(block)
+            error = False
+        finally:
+            self.sftp_limit.release(started, error, entry.st_size)
+        os.replace(partial_filename, local_filename)
+        self.metrics.record('sftp_get', 1, entry.st_size, time.perf_counter() - start)
+
+        message = entry.filename + " is downloaded to " + self.download_dir
+        logger.info(message)
+        return Transfer(entry.filename, entry.st_size, os.path.getmtime(local_filename), content_hash.hexdigest(),
+                        part_md5s=part_hashes and [part_hash.hexdigest() for part_hash in part_hashes])
+
+    async def upload_worker(self, s3client, uploads, publishes):
+        while True:
+            transfer = await uploads.get()
+            if transfer is None:
+                break
+            if self.failed.is_set():
+                # taken off the queue so the stage before does not wait for room, the file stays in download_dir
+                continue
+            try:
+                await self.upload(s3client, transfer)
+            except Exception as e:
+                self.fail("File " + transfer.filename + " in " + self.download_dir +
+                          " failed to be uploaded to S3 bucket " + self.s3_bucket + ". " + str(e))
+                continue
+            await publishes.put(transfer)
+
+    async def upload(self, s3client, transfer):
+        loop = asyncio.get_event_loop()
+        local_filename = os.path.join(self.download_dir, transfer.filename)
+        key = transfer.date_prefix + transfer.filename
+        started = await acquire_limit(self.s3_limit)
+        error = True
+        try:
+            start = time.perf_counter()
+            if transfer.size >= self.multipart['threshold']:
+                etag = await self.upload_multipart(s3client, local_filename, key, transfer)
+            else:
+                # read off the event loop, the body of every upload in flight is held in memory
+                body = await loop.run_in_executor(None, read_file, local_filename)
+                await throttle(self.s3_limit, len(body))
+                response = await s3client.put_object(Bucket=self.s3_bucket, Key=key, Body=body,
+                                                     ContentMD5=get_content_md5(transfer.content_md5),
+                                                     Metadata={'content-md5': transfer.content_md5})
+                etag = response['ETag']
+            error = False
+        finally:
+            self.s3_limit.release(started, error, transfer.size)
+        transfer.s3_key = key
+        if self.manifest and transfer.manifest_key:
+            self.manifest.mark_uploaded(transfer.manifest_key, key, etag)
+        self.metrics.record('s3_upload', 1, transfer.size, time.perf_counter() - start)
+
+        message = "File " + transfer.filename + " in " + self.download_dir + " is uploaded to S3 bucket " + \
+                  self.s3_bucket + "/" + transfer.date_prefix
+        logger.info(message)
+
+    async def upload_multipart(self, s3client, local_filename, key, transfer):
+        # 'multipart_concurrency' parts in flight, without the checkpoints of the blocking engine: an
+        # interrupted upload is aborted and starts over in the next cycle. The parts of a file found in
+        # download_dir at start-up have no MD5 of their own, they are sent without a Content-MD5.
+        loop = asyncio.get_event_loop()
+        part_size = self.multipart['part_size']
+        in_flight = asyncio.Semaphore(self.multipart['concurrency'])
+        response = await s3client.create_multipart_upload(Bucket=self.s3_bucket, Key=key,
+                                                          Metadata={'content-md5': transfer.content_md5})
+        upload_id = response['UploadId']
+
+        async def upload_part(part_number, offset):
+            async with in_flight:
+                body = await loop.run_in_executor(None, read_file, local_filename, offset, part_size)
+                await throttle(self.s3_limit, len(body))
+                kwargs = {}
+                if transfer.part_md5s and part_number <= len(transfer.part_md5s):
+                    kwargs['ContentMD5'] = get_content_md5(transfer.part_md5s[part_number - 1])
+                response = await s3client.upload_part(Bucket=self.s3_bucket, Key=key, PartNumber=part_number,
+                                                      UploadId=upload_id, Body=body, **kwargs)
+            return {'ETag': response['ETag'], 'PartNumber': part_number}
+
+        try:
+            parts = await asyncio.gather(*[upload_part(part_number, offset) for part_number, offset
+                                           in enumerate(range(0, max(transfer.size, 1), part_size), 1)])
+            response = await s3client.complete_multipart_upload(Bucket=self.s3_bucket, Key=key, UploadId=upload_id,
+                                                                MultipartUpload={'Parts': list(parts)})
+        except Exception:
+            try:
+                await s3client.abort_multipart_upload(Bucket=self.s3_bucket, Key=key, UploadId=upload_id)
+            except Exception:
+                pass
+            raise
+        return response['ETag']
+
+    async def publish_worker(self, publisher, publishes):
+        while True:
+            transfer = await publishes.get()
+            if transfer is None:
+                break
+            if self.failed.is_set():
+                continue
+            headers = {
+                "data.type": "*stream",
+                "data.size": transfer.size,
+                "data.s3bucket": self.s3_bucket,
+                "data.s3keyprefix": transfer.s3_key[:-len(transfer.filename)],
+                "data.md5": transfer.content_md5
+            }
+            start = time.perf_counter()
+            try:
+                # returns once the broker has confirmed the message
+                await publisher.publish(transfer.filename, headers)
+            except Exception as e:
+                self.fail("File name " + transfer.filename + " in " + self.download_dir +
+                          " failed to be pushed to RabbitMQ. " + str(e))
+                continue
+            self.metrics.record('mq_publish', 1, transfer.size, time.perf_counter() - start)
+            self.published += 1
+            if self.manifest and transfer.manifest_key:
+                self.manifest.mark_published([transfer.manifest_key])
+            self.delete(transfer.filename, transfer.size)
+
+    def delete(self, file, size=0):
+        start = time.perf_counter()
+        try:
+            os.remove(os.path.join(self.download_dir, file))
+        except OSError as e:
+            self.fail("File " + file + " in " + self.download_dir + " needs to be removed manually. " + str(e))
+            return
+        self.metrics.record('delete', 1, size, time.perf_counter() - start)
+
+
+class AsyncMQPublisher(object):
+    """
+    File messages of a feed on an aio-pika channel with publisher confirms. publish() returns once the broker
+    has confirmed the message, many of them can be waiting for their confirms at the same time.
+    """
+
+    def __init__(self, exchange, routing_key):
+        self.exchange = exchange
+        self.routing_key = routing_key
+
+    async def publish(self, body, headers):
+        import aio_pika
+
+        message = aio_pika.Message(body.encode(), headers=headers, content_type='text/plain',
+                                   delivery_mode=aio_pika.DeliveryMode.PERSISTENT)
+        await self.exchange.publish(message, routing_key=self.routing_key)
+
+
+async def open_sftp_client(stack, sftp_dict):
+    import asyncssh
+
+    # no host key check, like the pysftp connections of the blocking engine
+    connection = await stack.enter_async_context(await asyncssh.connect(
+        sftp_dict['host'], port=int(sftp_dict['port']), username=sftp_dict['user_name'],
+        password=sftp_dict['password'], known_hosts=None))
+    return await stack.enter_async_context(await connection.start_sftp_client())
+
+
+async def open_s3_client(stack, s3):
+    from aiobotocore.session import get_session
+
+    return await stack.enter_async_context(get_session().create_client(
+        's3', aws_access_key_id=s3['aws_access_key_id'], aws_secret_access_key=s3['aws_secret_access_key']))
+
+
+async def open_mq_publisher(stack, mq):
+    import aio_pika
+
+    connection = await aio_pika.connect_robust(host=mq['host'], port=int(mq['port']), virtualhost=mq['virtual_host'],
+                                               login=mq['user_name'], password=mq['password'])
+    stack.push_async_callback(connection.close)
+    channel = await connection.channel(publisher_confirms=True)
+    exchange = await channel.declare_exchange(mq['exchange'], mq['exchange_type'], durable=True)
+    return AsyncMQPublisher(exchange, mq['routing_key'])
+
+
+async def run_cycle(cycle, sftp_dict, s3, mq):
+    # opens the connections of the cycle, raises if one of them cannot be opened
+    async with contextlib.AsyncExitStack() as stack:
+        publisher = await open_mq_publisher(stack, mq)
+        s3client = await open_s3_client(stack, s3)
+        sftp = await open_sftp_client(stack, sftp_dict)
+        return await cycle.run(sftp, s3client, publisher)
@@ -0,0 +1,89 @@
+import argparse
+import hashlib
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import standins
+import dummydownloader
+
+FEED_TYPE = 'benchmark'
+
+
+def write_acks(directory, count, size):
+    # tiny acknowledgements of distinct content
+    names = []
+    for i in range(count):
+        name = 'ACK_%08d.edi' % i
+        with open(os.path.join(directory, name), 'wb') as f:
+            f.write(('ACK %08d ' % i).encode() + b'~' * (size - 13) + b'\n')
+        names.append(name)
+    return names
+
+
+def run(batch_format, args):
+    download_dir = tempfile.mkdtemp(prefix='edi_bench_')
+    try:
+        names = write_acks(download_dir, args.files, args.size)
+        hashes = {}
+        for name in names:
+            with open(os.path.join(download_dir, name), 'rb') as f:
+                hashes[name] = hashlib.md5(f.read()).hexdigest()
+
+        ftp_client = {'upload_workers': args.upload_workers}
+        if batch_format:
+            ftp_client['batch_format'] = batch_format
+        config = standins.make_feed_config(FEED_TYPE, download_dir, **ftp_client)
+        latency = args.latency_ms / 1000.0
+        mq_connection = standins.FakeMQConnection(latency=latency)
+        s3client = standins.FakeS3Client(latency=latency)
+        dummydownloader.feed_context.mq_connection = mq_connection
+
+        start = time.perf_counter()
+        result = dummydownloader.publish_files(mq_connection, s3client, FEED_TYPE, config)
+        elapsed = time.perf_counter() - start
+        left = os.listdir(download_dir)
+    finally:
+        shutil.rmtree(download_dir, ignore_errors=True)
+
+    # every file has to come out of the objects intact, through the offsets of its batch's index
+    published = {}
+    for message in mq_connection.published:
+        headers = message[3].headers
+        body = s3client.objects[('edi-benchmark', headers['data.s3keyprefix'] + message[2])]
+        if hashlib.md5(body).hexdigest() != headers['data.md5']:
+            return False, elapsed, s3client, mq_connection, {}
+        for member in headers.get('data.batch.members', [{'name': message[2], 'offset': 0, 'size': len(body)}]):
+            data = body[member['offset']:member['offset'] + member['size']]
+            published[member['name']] = hashlib.md5(data).hexdigest()
+    return result and not left and published == hashes, elapsed, s3client, mq_connection, published
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Publishing thousands of tiny files one by one and in batches")
+    parser.add_argument('--files', type=int, default=2000, help='number of acknowledgement files')
+    parser.add_argument('--size', type=int, default=512, help='size of each file in bytes')
+    parser.add_argument('--upload-workers', type=int, default=4, help='upload_workers of the feed')
+    parser.add_argument('--latency-ms', type=float, default=5.0, help='simulated S3 and RabbitMQ round trip')
+    args = parser.parse_args()
+
+    dummydownloader.console.setLevel(logging.WARNING)
+
+    failed = False
+    for batch_format in (None, 'tar', 'zip', 'lines'):
+        result, elapsed, s3client, mq_connection, published = run(batch_format, args)
+        print("%-8s elapsed=%.2fs %.0f files/s, %d S3 requests, %d messages, %d AMQP round trips" % (
+            batch_format or 'per file', elapsed, args.files / elapsed, s3client.request_count,
+            len(mq_connection.published), mq_connection.round_trips))
+        if not result:
+            print("  the published objects do not hold every file intact")
+            failed = True
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
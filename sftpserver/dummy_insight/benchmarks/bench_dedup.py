@@ -0,0 +1,139 @@
+import argparse
+import hashlib
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import standins
+import dummydownloader
+
+FEED_TYPE = 'benchmark'
+
+
+def write_files(directory, count, size, prefix):
+    # files of distinct content, write_edi_files gives every file the same body
+    names = []
+    for i in range(count):
+        name = '%s_%08d.edi' % (prefix, i)
+        with open(os.path.join(directory, name), 'wb') as f:
+            f.write(('%s %08d ' % (prefix, i)).encode() + os.urandom(size))
+        names.append(name)
+    return names
+
+
+def measure_hashing(size):
+    # the cost of hashing on the way to disk, without any network latency in the way
+    remote_root = tempfile.mkdtemp(prefix='edi_bench_remote_')
+    download_dir = tempfile.mkdtemp(prefix='edi_bench_')
+    try:
+        rates = {}
+        for mode in ('plain', 'md5'):
+            with open(os.path.join(remote_root, 'BATCH.edi'), 'wb') as f:
+                block = os.urandom(1024 * 1024)
+                for offset in range(0, size, len(block)):
+                    f.write(block[:min(len(block), size - offset)])
+            sftp = standins.FakeSFTPConnection(remote_root)
+            content_hash = dummydownloader.new_content_hash() if mode == 'md5' else None
+            start = time.perf_counter()
+            dummydownloader.download_file(sftp, 'BATCH.edi', os.path.join(download_dir, 'BATCH.edi'), size,
+                                          dummydownloader.PREFETCH_THRESHOLD, content_hash)
+            rates[mode] = size / (time.perf_counter() - start) / 1024 / 1024
+            os.remove(os.path.join(download_dir, 'BATCH.edi'))
+        return rates
+    finally:
+        shutil.rmtree(remote_root, ignore_errors=True)
+        shutil.rmtree(download_dir, ignore_errors=True)
+
+
+def run(duplicates, args):
+    remote_root = tempfile.mkdtemp(prefix='edi_bench_remote_')
+    download_dir = tempfile.mkdtemp(prefix='edi_bench_')
+    try:
+        originals = write_files(remote_root, args.files, args.size, 'EDI')
+        # the partner sends the first files again under new names
+        resent = []
+        for i, name in enumerate(originals[:args.duplicates]):
+            resent.append('RESEND_%08d.edi' % i)
+            shutil.copy(os.path.join(remote_root, name), os.path.join(remote_root, resent[-1]))
+        hashes = {}
+        for name in originals + resent:
+            with open(os.path.join(remote_root, name), 'rb') as f:
+                hashes[name] = hashlib.md5(f.read()).hexdigest()
+
+        config = standins.make_feed_config(FEED_TYPE, download_dir, duplicates=duplicates,
+                                           content_index_file=os.path.join(download_dir + '.index', 'index.db'))
+        latency = args.latency_ms / 1000.0
+        bandwidth = args.bandwidth_mb * 1024 * 1024
+        mq_connection = standins.FakeMQConnection(latency=latency)
+        s3client = standins.FakeS3Client(latency=latency, store=False, bandwidth=bandwidth)
+        dummydownloader.feed_context.mq_connection = mq_connection
+        sftp = standins.FakeSFTPConnection(remote_root, latency=latency, bandwidth=bandwidth)
+        entries = sorted(sftp.listdir_attr(), key=lambda entry: entry.filename)
+
+        start = time.perf_counter()
+        index = dummydownloader.content_index.open_content_index(FEED_TYPE, config, download_dir)
+        publish_queue = dummydownloader.PublishQueue(mq_connection, s3client, FEED_TYPE, config, index=index)
+        try:
+            downloader = dummydownloader.SFTPDownloader(sftp, FEED_TYPE, config)
+
+            def on_downloaded(entry):
+                publish_queue.put(entry.filename, content_md5=downloader.content_md5.pop(entry.filename))
+                return publish_queue.drain(block=False)
+
+            result = downloader.download(entries, on_downloaded) and publish_queue.drain()
+        finally:
+            publish_queue.close()
+            index.close()
+        elapsed = time.perf_counter() - start
+        left = os.listdir(download_dir)
+    finally:
+        shutil.rmtree(remote_root, ignore_errors=True)
+        shutil.rmtree(download_dir, ignore_errors=True)
+        shutil.rmtree(download_dir + '.index', ignore_errors=True)
+
+    headers = dict((message[2], message[3].headers) for message in mq_connection.published)
+    return result and not left, elapsed, s3client, headers, hashes, originals, resent
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Hashing cost and savings of the content index on re-sent files")
+    parser.add_argument('--files', type=int, default=200, help='number of files of distinct content')
+    parser.add_argument('--duplicates', type=int, default=200, help='how many of them are sent again')
+    parser.add_argument('--size', type=int, default=256 * 1024, help='size of each file in bytes')
+    parser.add_argument('--hash-size', type=int, default=128 * 1024 * 1024, help='size of the hashing test file')
+    parser.add_argument('--bandwidth-mb', type=float, default=32.0, help='SFTP and S3 MB/s per connection')
+    parser.add_argument('--latency-ms', type=float, default=2.0, help='simulated SFTP, S3 and RabbitMQ round trip')
+    args = parser.parse_args()
+
+    dummydownloader.console.setLevel(logging.WARNING)
+
+    rates = measure_hashing(args.hash_size)
+    print("download to disk: %.0f MB/s plain, %.0f MB/s with MD5" % (rates['plain'], rates['md5']))
+
+    failed = False
+    for duplicates in ('publish', 'pointer', 'skip'):
+        result, elapsed, s3client, headers, hashes, originals, resent = run(duplicates, args)
+        print("%-8s elapsed=%.2fs uploaded=%.1f MB in %d requests, %d messages" % (
+            duplicates, elapsed, s3client.bytes_received / 1024.0 / 1024.0, s3client.request_count, len(headers)))
+
+        expected = originals + resent if duplicates != 'skip' else originals
+        if not result or sorted(headers) != sorted(expected):
+            print("  not every file was published as expected")
+            failed = True
+            continue
+        if any(headers[name]['data.md5'] != hashes[name] for name in expected):
+            print("  a message carries the wrong MD5")
+            failed = True
+        pointers = [name for name in expected if 'data.s3key' in headers[name]]
+        if pointers != (resent if duplicates == 'pointer' else []):
+            print("  %d pointer messages, expected one per re-sent file" % len(pointers))
+            failed = True
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,281 @@
+import argparse
+import json
+import logging
+import os
+import platform
+import shutil
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+import standins
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+SIMULATOR_DIR = os.path.normpath(os.path.join(BENCHMARKS_DIR, '..', '..', '..', 'ftpserver_simulator'))
+FEED_TYPE = 'benchmark'
+USER_NAME = 'bench'
+PASSWORD = 'bench'
+# seconds the simulator gets to start listening
+SIMULATOR_START_TIMEOUT = 30
+
+
+def get_free_port():
+    with socket.socket() as sock:
+        sock.bind(('127.0.0.1', 0))
+        return sock.getsockname()[1]
+
+
+def generate_corpus(home, args):
+    # the simulator's own X12 mix, with the sizes capped so a run stays short
+    sys.path.insert(0, SIMULATOR_DIR)
+    import edi_generator
+
+    mix = [dict(item, MIN_SIZE=min(item['MIN_SIZE'], args.max_size), MAX_SIZE=min(item['MAX_SIZE'], args.max_size))
+           for item in edi_generator.DEFAULT_MIX]
+    generator = edi_generator.EDIGenerator([home], os.path.join(os.path.dirname(home), '.generator'), mix,
+                                           count=args.files, seed=args.seed)
+    return generator.run()
+
+
+def start_simulator(work_dir, port):
+    # SFTP mode, with one user whose home directory holds the corpus
+    config_file = os.path.join(work_dir, 'simulated_server_config.json')
+    with open(config_file, 'w') as f:
+        json.dump({
+            'SERVER': {'HOST': '127.0.0.1', 'PORT': port, 'HOMEDIRECTORY_NAME': 'FTPData',
+                       'HOMEDIRECTORY_PATH': work_dir, 'PROTOCOL': 'sftp', 'MAX_CONS': 64},
+            'USERS': [{'USERNAME': USER_NAME, 'PASSWORD': PASSWORD}]
+        }, f, indent=2)
+
+    log = open(os.path.join(work_dir, 'simulator.log'), 'w')
+    process = subprocess.Popen([sys.executable, os.path.join(SIMULATOR_DIR, 'simulated_server.py'), '-c', config_file],
+                               stdout=log, stderr=subprocess.STDOUT, cwd=SIMULATOR_DIR)
+    log.close()
+
+    deadline = time.monotonic() + SIMULATOR_START_TIMEOUT
+    while time.monotonic() < deadline:
+        if process.poll() is not None:
+            raise RuntimeError("the simulator exited, see " + os.path.join(work_dir, 'simulator.log'))
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("the simulator is not listening on port " + str(port))
+
+
+def write_downloader_config(work_dir, port, args):
+    # the -c configuration of the downloader: one dev feed against the simulator, S3 and RabbitMQ are replaced
+    # by the stand-ins in the downloader process
+    config = standins.make_feed_config(FEED_TYPE, os.path.join(work_dir, 'download'),
+                                       upload_workers=args.upload_workers)
+    config[FEED_TYPE]['sftp_server'].update({'host': '127.0.0.1', 'port': port, 'user_name': USER_NAME,
+                                             'password': PASSWORD, 'sessions': args.sessions})
+    config_file = os.path.join(work_dir, 'dummydownloader_config.json')
+    with open(config_file, 'w') as f:
+        json.dump({'dev': config}, f, indent=2)
+    return config_file
+
+
+def run_downloader(args):
+    # runs in the downloader process: dummydownloader's own main() on the generated configuration, with the S3
+    # client and the RabbitMQ connection replaced by the stand-ins
+    import dummydownloader
+    import async_engine
+
+    latency = args.latency_ms / 1000.0
+    bandwidth = args.bandwidth_mb * 1024 * 1024 if args.bandwidth_mb else None
+    if args.engine == 'async':
+        s3client = standins.AsyncFakeS3Client(latency=latency, store=False, bandwidth=bandwidth)
+        publisher = standins.AsyncFakeMQPublisher(latency=latency)
+
+        async def open_s3_client(stack, s3):
+            return s3client
+
+        async def open_mq_publisher(stack, mq):
+            return publisher
+
+        async_engine.open_s3_client = open_s3_client
+        async_engine.open_mq_publisher = open_mq_publisher
+        published = publisher.published
+    else:
+        s3client = standins.FakeS3Client(latency=latency, store=False, bandwidth=bandwidth)
+        mq_connection = standins.FakeMQConnection(latency=latency)
+        dummydownloader.get_s3_client = lambda feed_type, config: s3client
+        dummydownloader.get_mq_connection = lambda feed_type, config: mq_connection
+        published = mq_connection.published
+
+    dummydownloader.console.setLevel(logging.WARNING)
+    start = time.perf_counter()
+    result = dummydownloader.main(['dummydownloader.py', '-s', 'dev', '-t', FEED_TYPE,
+                                   '-c', os.path.join(args.work_dir, 'dummydownloader_config.json'),
+                                   '--engine', args.engine,
+                                   '--metrics-file', os.path.join(args.work_dir, 'metrics.json'),
+                                   '--profile', os.path.join(args.work_dir, 'trace.json')])
+    elapsed = time.perf_counter() - start
+
+    with open(os.path.join(args.work_dir, 'downloader.json'), 'w') as f:
+        json.dump({'result': result if isinstance(result, (bool, int)) else str(result), 'elapsed': elapsed,
+                   'published': len(published), 's3_objects': len(s3client.objects)}, f)
+    return 0
+
+
+def run_process(command):
+    # the exit code and the peak RSS (KB) of the process itself
+    process = subprocess.Popen(command)
+    _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return process.returncode, rusage.ru_maxrss
+
+
+def stop_process(process):
+    process.terminate()
+    _, status, rusage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    return rusage.ru_maxrss
+
+
+def get_stage_latencies(trace_file):
+    # p50/p99 of every span of the --profile trace, per file (per batch for mq_commit)
+    with open(trace_file) as f:
+        events = json.load(f)['traceEvents']
+    durations = {}
+    for event in events:
+        if event.get('ph') == 'X':
+            durations.setdefault(event['name'], []).append(event['dur'] / 1000.0)
+
+    stages = {}
+    for name, values in sorted(durations.items()):
+        values.sort()
+        stages[name] = {'count': len(values), 'p50_ms': values[(len(values) - 1) // 2],
+                        'p99_ms': values[min(len(values) - 1, int(len(values) * 0.99))],
+                        'total_ms': sum(values)}
+    return stages
+
+
+def get_version():
+    try:
+        return subprocess.check_output(['git', 'describe', '--always', '--dirty'], cwd=BENCHMARKS_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare(report, baseline, tolerance):
+    # the regressions against an earlier report beyond 'tolerance'
+    regressions = []
+    for key in ('files_per_second', 'mb_per_second'):
+        if report['results'][key] < baseline['results'][key] * (1 - tolerance):
+            regressions.append("%s %.1f, was %.1f" % (key, report['results'][key], baseline['results'][key]))
+    if report['peak_rss_kb']['downloader'] > baseline['peak_rss_kb']['downloader'] * (1 + tolerance):
+        regressions.append("downloader peak RSS %d KB, was %d KB" % (report['peak_rss_kb']['downloader'],
+                                                                   baseline['peak_rss_kb']['downloader']))
+    return regressions
+
+
+def run_benchmark(args):
+    work_dir = tempfile.mkdtemp(prefix='edi_bench_e2e_')
+    try:
+        home = os.path.join(work_dir, 'FTPData', USER_NAME)
+        files, nbytes = generate_corpus(home, args)
+        port = get_free_port()
+        config_file = write_downloader_config(work_dir, port, args)
+        simulator = start_simulator(work_dir, port)
+        try:
+            command = [sys.executable, os.path.abspath(__file__), '--work-dir', work_dir] + sys.argv[1:]
+            exit_code, downloader_rss = run_process(command)
+        finally:
+            simulator_rss = stop_process(simulator)
+
+        if exit_code or not os.path.exists(os.path.join(work_dir, 'downloader.json')):
+            print("The downloader failed with exit code %d, its configuration was %s" % (exit_code, config_file))
+            return None
+        with open(os.path.join(work_dir, 'downloader.json')) as f:
+            downloader = json.load(f)
+        with open(os.path.join(work_dir, 'metrics.json')) as f:
+            metrics = json.load(f)['feeds'][FEED_TYPE]
+        stages = get_stage_latencies(os.path.join(work_dir, 'trace.json'))
+        left_remote = len(os.listdir(home))
+        left_local = len(os.listdir(os.path.join(work_dir, 'download')))
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    elapsed = downloader['elapsed']
+    downloaded = metrics['stages']['sftp_get']['files']
+    downloaded_bytes = metrics['stages']['sftp_get']['bytes']
+    return {
+        'version': get_version(),
+        'python': platform.python_version(),
+        'started': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'parameters': dict((key, value) for key, value in vars(args).items()
+                           if key not in ('work_dir', 'output', 'baseline', 'tolerance')),
+        'corpus': {'files': files, 'bytes': nbytes},
+        'results': {
+            'elapsed': elapsed,
+            'downloaded': downloaded,
+            'published': downloader['published'],
+            'complete': downloader['published'] == files and not left_remote and not left_local,
+            'files_per_second': downloaded / elapsed,
+            'mb_per_second': downloaded_bytes / elapsed / 1024 / 1024
+        },
+        'stages': stages,
+        'peak_rss_kb': {'downloader': downloader_rss, 'simulator': simulator_rss}
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="End to end: the simulator serving a generated corpus over SFTP, "
+                                                 "the downloader run on a generated configuration, S3 and RabbitMQ "
+                                                 "stand-ins. Writes the results as JSON.")
+    parser.add_argument('--files', type=int, default=2000, help='number of EDI files in the corpus')
+    parser.add_argument('--max-size', type=int, default=4 * 1024 * 1024, help='largest file of the corpus in bytes')
+    parser.add_argument('--seed', type=int, default=1, help='seed of the corpus')
+    parser.add_argument('--engine', choices=['blocking', 'async'], default='blocking',
+                        help='--engine of the downloader')
+    parser.add_argument('--sessions', type=int, default=4, help='SFTP sessions of the feed')
+    parser.add_argument('--upload-workers', type=int, default=4, help='upload_workers of the feed')
+    parser.add_argument('--latency-ms', type=float, default=2.0, help='simulated S3 and RabbitMQ round trip')
+    parser.add_argument('--bandwidth-mb', type=float, default=0, help='S3 MB/s per connection, 0 for no limit')
+    parser.add_argument('--output', default='end_to_end.json', help='file the results are written to')
+    parser.add_argument('--baseline', help='results of an earlier run, fail on a regression against them')
+    parser.add_argument('--tolerance', type=float, default=0.2,
+                        help='fraction throughput may drop, and peak RSS grow, against the baseline')
+    # set in the downloader process the benchmark starts
+    parser.add_argument('--work-dir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.work_dir:
+        return run_downloader(args)
+
+    report = run_benchmark(args)
+    if report is None:
+        return 1
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+
+    results = report['results']
+    print("%d files (%.1f MB) in %.2fs: %.0f files/s %.2f MB/s, peak RSS %d KB (simulator %d KB)" % (
+        results['downloaded'], report['corpus']['bytes'] / 1024 / 1024, results['elapsed'],
+        results['files_per_second'], results['mb_per_second'], report['peak_rss_kb']['downloader'],
+        report['peak_rss_kb']['simulator']))
+    for name, stage in report['stages'].items():
+        print("  %-20s %6d  p50=%8.2fms  p99=%8.2fms" % (name, stage['count'], stage['p50_ms'], stage['p99_ms']))
+    print("Results written to " + args.output)
+
+    failed = not results['complete']
+    if failed:
+        print("  %d of %d files published" % (results['published'], report['corpus']['files']))
+    if args.baseline:
+        with open(args.baseline) as f:
+            regressions = compare(report, json.load(f), args.tolerance)
+        for regression in regressions:
+            print("  regression: " + regression)
+        failed = failed or bool(regressions)
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
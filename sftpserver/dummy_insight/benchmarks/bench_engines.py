@@ -0,0 +1,134 @@
+import argparse
+import asyncio
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import standins
+import dummydownloader
+import async_engine
+
+FEED_TYPE = 'benchmark'
+
+
+class CheckedMessages(list):
+    # the published messages of a stand-in, checked as each one is confirmed: its object is in S3 and its file
+    # is still in download_dir
+
+    def __init__(self, s3client, download_dir):
+        super(CheckedMessages, self).__init__()
+        self.s3client = s3client
+        self.download_dir = download_dir
+        self.violations = 0
+
+    def append(self, message):
+        file, headers = message
+        if ('edi-benchmark', headers['data.s3keyprefix'] + file) not in self.s3client.objects or \
+                not os.path.exists(os.path.join(self.download_dir, file)):
+            self.violations += 1
+        super(CheckedMessages, self).append(message)
+
+    def extend(self, messages):
+        for message in messages:
+            self.append(message)
+
+
+class BlockingMessages(CheckedMessages):
+    # FakeMQConnection's (exchange, routing key, body, properties)
+
+    def append(self, message):
+        super(BlockingMessages, self).append((message[2], message[3].headers))
+
+
+def run_blocking(config, remote_root, download_dir, args):
+    latency = args.latency_ms / 1000.0
+    bandwidth = args.bandwidth_mb * 1024 * 1024
+    mq_connection = standins.FakeMQConnection(latency=latency)
+    s3client = standins.FakeS3Client(latency=latency, store=False, bandwidth=bandwidth)
+    mq_connection.published = BlockingMessages(s3client, download_dir)
+    dummydownloader.feed_context.mq_connection = mq_connection
+
+    def connect(sftp_dict):
+        return standins.FakeSFTPConnection(remote_root, latency=latency, bandwidth=bandwidth)
+
+    sftp = connect(None)
+    publish_queue = dummydownloader.PublishQueue(mq_connection, s3client, FEED_TYPE, config)
+    try:
+        downloader = dummydownloader.SFTPDownloader(sftp, FEED_TYPE, config, connect=connect)
+
+        def on_downloaded(entry):
+            publish_queue.put(entry.filename, content_md5=downloader.content_md5.pop(entry.filename))
+            return publish_queue.drain(block=False)
+
+        result = downloader.download(sftp.listdir_attr(), on_downloaded) and publish_queue.drain()
+    finally:
+        publish_queue.close()
+    return result, mq_connection.published
+
+
+def run_async(config, remote_root, download_dir, args):
+    latency = args.latency_ms / 1000.0
+    bandwidth = args.bandwidth_mb * 1024 * 1024
+    # the async engine has one SFTP connection, give it the bandwidth of the blocking engine's sessions
+    sftp = standins.AsyncFakeSFTPClient(remote_root, latency=latency, bandwidth=bandwidth * args.sessions)
+    s3client = standins.AsyncFakeS3Client(latency=latency, store=False, bandwidth=bandwidth)
+    publisher = standins.AsyncFakeMQPublisher(latency=latency)
+    publisher.published = CheckedMessages(s3client, download_dir)
+
+    cycle = async_engine.AsyncFeedCycle(FEED_TYPE, config, download_dir,
+                                        dummydownloader.get_multipart_config(FEED_TYPE, config))
+    result = asyncio.run(cycle.run(sftp, s3client, publisher))
+    return result, publisher.published
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Blocking vs asyncio engine on the same feed")
+    parser.add_argument('--files', type=int, default=1000, help='number of EDI files')
+    parser.add_argument('--size', type=int, default=16 * 1024, help='size of each file in bytes')
+    parser.add_argument('--sessions', type=int, default=4, help='SFTP sessions of the blocking engine')
+    parser.add_argument('--upload-workers', type=int, default=4, help='S3 upload threads of the blocking engine')
+    parser.add_argument('--concurrency', type=int, default=16,
+                        help='downloads and uploads in flight in the async engine, twice as many publishes')
+    parser.add_argument('--bandwidth-mb', type=float, default=32.0, help='SFTP and S3 MB/s per connection')
+    parser.add_argument('--latency-ms', type=float, default=5.0, help='simulated SFTP, S3 and RabbitMQ round trip')
+    args = parser.parse_args()
+
+    dummydownloader.console.setLevel(logging.WARNING)
+
+    failed = False
+    for engine, run in (('blocking', run_blocking), ('async', run_async)):
+        remote_root = tempfile.mkdtemp(prefix='edi_bench_remote_')
+        download_dir = tempfile.mkdtemp(prefix='edi_bench_')
+        try:
+            names = standins.write_edi_files(remote_root, args.files, args.size)
+            nbytes = sum(os.path.getsize(os.path.join(remote_root, name)) for name in names)
+            config = standins.make_feed_config(FEED_TYPE, download_dir, upload_workers=args.upload_workers,
+                                               async_downloads=args.concurrency, async_uploads=args.concurrency,
+                                               async_publishes=args.concurrency * 2)
+            config[FEED_TYPE]['sftp_server']['sessions'] = args.sessions
+
+            start = time.perf_counter()
+            result, published = run(config, remote_root, download_dir, args)
+            elapsed = time.perf_counter() - start
+            left = os.listdir(download_dir)
+        finally:
+            shutil.rmtree(remote_root, ignore_errors=True)
+            shutil.rmtree(download_dir, ignore_errors=True)
+
+        print("%-9s elapsed=%.2fs %.0f files/s %.1f MB/s" % (engine, elapsed, len(published) / elapsed,
+                                                              nbytes / elapsed / 1024 / 1024))
+        if not result or len(published) != len(names) or left:
+            print("  %d of %d files published, %d left in download_dir" % (len(published), len(names), len(left)))
+            failed = True
+        if published.violations:
+            print("  %d messages published before their upload or after their delete" % published.violations)
+            failed = True
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,70 @@
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+
+import standins
+import dummydownloader
+
+FEED_TYPE = 'benchmark'
+
+
+class OutageErrorReporter(dummydownloader.MQErrorReporter):
+    # the broker is down for the first 'outage' seconds, every connection attempt then takes 'connect_timeout'
+
+    def __init__(self, spill_file, outage, connect_timeout, **kwargs):
+        super(OutageErrorReporter, self).__init__(spill_file, **kwargs)
+        self.back_at = time.monotonic() + outage
+        self.connect_timeout = connect_timeout
+        self.connection = standins.FakeMQConnection()
+
+    def connect(self, feed_type, config):
+        if time.monotonic() < self.back_at:
+            time.sleep(self.connect_timeout)
+            return None
+        return self.connection
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Error reporting during a RabbitMQ outage")
+    parser.add_argument('--errors', type=int, default=20000, help='number of errors reported')
+    parser.add_argument('--distinct', type=int, default=50, help='number of different error messages')
+    parser.add_argument('--outage', type=float, default=2.0, help='seconds the broker is down')
+    parser.add_argument('--connect-timeout', type=float, default=1.0,
+                        help='seconds a connection attempt takes while the broker is down')
+    args = parser.parse_args()
+
+    dummydownloader.console.setLevel(logging.WARNING)
+    spill_file = os.path.join(tempfile.mkdtemp(prefix='edi_bench_'), 'errors.jsonl')
+    config = standins.make_feed_config(FEED_TYPE, tempfile.gettempdir())
+    reporter = OutageErrorReporter(spill_file, args.outage, args.connect_timeout, dedupe_window=1,
+                                   retry_interval=0.5)
+    reporter.register(FEED_TYPE, config)
+
+    slowest = 0.0
+    start = time.perf_counter()
+    for n in range(args.errors):
+        before = time.perf_counter()
+        reporter.report(FEED_TYPE, 'edi.exception', FEED_TYPE, dummydownloader.get_log_time("ERROR") +
+                        "S3 upload failed. error %d" % (n % args.distinct))
+        slowest = max(slowest, time.perf_counter() - before)
+    elapsed = time.perf_counter() - start
+    print("reported=%d in %.3fs (%.1f us per error, slowest %.1f us)" % (
+        args.errors, elapsed, elapsed / args.errors * 1000000, slowest * 1000000))
+
+    # wait for the broker to come back and the spill file to be replayed
+    deadline = time.monotonic() + args.outage + 10
+    while time.monotonic() < deadline and (os.path.exists(spill_file) or os.path.exists(spill_file + '.replay')):
+        time.sleep(0.1)
+    reporter.close()
+
+    print("sent=%d merged=%d spilled=%d published=%d spill file left=%s" % (
+        reporter.sent, reporter.merged, reporter.spilled, len(reporter.connection.published),
+        os.path.exists(spill_file)))
+    return 0 if not os.path.exists(spill_file) else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
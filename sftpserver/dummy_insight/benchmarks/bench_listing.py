@@ -0,0 +1,91 @@
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import time
+
+import standins
+import dummydownloader
+import remote_listing
+import transfer_manifest
+
+SOURCE_DIR = '.'
+
+
+def run_cycle(sftp, listing, manifest, download_dir):
+    # the selection part of a download cycle: one listing, then the files left to download
+    start = time.perf_counter()
+    files = sftp.listdir_attr()
+    listed = time.perf_counter()
+    if listing:
+        files = listing.select(files)
+    files = dummydownloader.skip_processed_files(manifest, SOURCE_DIR, files, download_dir, listing)
+    return files, listed - start, time.perf_counter() - listed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Selection of new files in a large remote directory")
+    parser.add_argument('--files', type=int, default=100000, help='files already processed in the remote directory')
+    parser.add_argument('--new', type=int, default=10, help='files added between two cycles')
+    parser.add_argument('--stable-polls', type=int, default=2, help='listings a file must keep its size for')
+    parser.add_argument('--latency-ms', type=float, default=20.0, help='simulated SFTP round trip')
+    args = parser.parse_args()
+
+    # one log line per skipped file is what the manifest path costs, keep it but off the console
+    dummydownloader.console.setLevel(logging.WARNING)
+    remote_root = tempfile.mkdtemp(prefix='edi_bench_remote_')
+    download_dir = tempfile.mkdtemp(prefix='edi_bench_')
+    try:
+        names = set(standins.write_edi_files(remote_root, args.files, 64))
+        os.mkdir(os.path.join(remote_root, 'archive'))
+        manifest = transfer_manifest.TransferManifest(os.path.join(download_dir, 'manifest.db'))
+        sftp = standins.FakeSFTPConnection(remote_root, latency=args.latency_ms / 1000.0)
+        # an earlier run has published every file, recorded in one transaction instead of one per file
+        with manifest.db:
+            manifest.db.executemany("INSERT INTO transfers (remote_path, size, mtime, local_name, stage, updated) "
+                                    "VALUES (?, ?, ?, ?, ?, ?)",
+                                    [(dummydownloader.get_remote_path(SOURCE_DIR, entry.filename), entry.st_size,
+                                      int(entry.st_mtime), entry.filename, transfer_manifest.PUBLISHED, time.time())
+                                     for entry in sftp.listdir_attr() if entry.filename in names])
+
+        files, list_seconds, select_seconds = run_cycle(sftp, None, manifest, download_dir)
+        print("manifest only: listed=%.3fs selected=%d in %.3fs" % (list_seconds, len(files), select_seconds))
+
+        listing = remote_listing.ListingCache(args.stable_polls, os.path.join(download_dir, 'listing.json'))
+        run_cycle(sftp, listing, manifest, download_dir)
+        new_names = standins.write_edi_files(remote_root, args.new, 64, prefix='NEW')
+        growing = os.path.join(remote_root, new_names[0])
+
+        selected = []
+        for cycle in range(args.stable_polls + 1):
+            if cycle < args.stable_polls:
+                # a partner upload still in progress
+                with open(growing, 'ab') as f:
+                    f.write(b'~' * 64)
+            files, list_seconds, select_seconds = run_cycle(sftp, listing, manifest, download_dir)
+            selected.append([entry.filename for entry in files])
+            print("listing cache cycle %d: listed=%.3fs selected=%d in %.3fs (%d done, %d still changing)" % (
+                cycle + 1, list_seconds, len(files), select_seconds, listing.skipped, listing.waiting))
+            for entry in files:
+                listing.mark_done(entry.filename)
+        start = time.perf_counter()
+        listing.save()
+        print("listing cache saved in %.3fs (%d bytes)" % (time.perf_counter() - start,
+                                                           os.path.getsize(listing.path)))
+        manifest.close()
+    finally:
+        shutil.rmtree(remote_root, ignore_errors=True)
+        shutil.rmtree(download_dir, ignore_errors=True)
+
+    # the stable new files come out one cycle before the one that was still growing, nothing comes out twice
+    expected_stable = sorted(new_names[1:])
+    if sorted(selected[-2]) != expected_stable or selected[-1] != [new_names[0]] or any(selected[:-2]):
+        print("unexpected selection: " + str(selected))
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,83 @@
+import argparse
+import logging
+import shutil
+import sys
+import tempfile
+import time
+
+import standins
+import dummydownloader
+import pipeline_metrics
+
+FEED_TYPE = 'benchmark'
+
+
+def run_pipeline(file_count, file_size, latency):
+    # SFTP download, S3 upload, publish and delete of every file, the loop the metrics are recorded in
+    remote_root = tempfile.mkdtemp(prefix='edi_bench_remote_')
+    download_dir = tempfile.mkdtemp(prefix='edi_bench_')
+    try:
+        standins.write_edi_files(remote_root, file_count, file_size)
+        config = standins.make_feed_config(FEED_TYPE, download_dir)
+        mq_connection = standins.FakeMQConnection(latency=latency)
+        s3client = standins.FakeS3Client(latency=latency, store=False)
+        dummydownloader.feed_context.mq_connection = mq_connection
+
+        start = time.perf_counter()
+        sftp = standins.FakeSFTPConnection(remote_root, latency=latency)
+        publish_queue = dummydownloader.PublishQueue(mq_connection, s3client, FEED_TYPE, config)
+        try:
+            def on_downloaded(entry):
+                publish_queue.put(entry.filename)
+                return publish_queue.drain(block=False)
+
+            downloader = dummydownloader.SFTPDownloader(sftp, FEED_TYPE, config)
+            result = downloader.download(sftp.listdir_attr(), on_downloaded) and publish_queue.drain()
+        finally:
+            publish_queue.close()
+        elapsed = time.perf_counter() - start
+    finally:
+        shutil.rmtree(remote_root, ignore_errors=True)
+        shutil.rmtree(download_dir, ignore_errors=True)
+
+    return result, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Overhead of the pipeline metrics on the transfer loop")
+    parser.add_argument('--files', type=int, default=2000, help='number of EDI files per run')
+    parser.add_argument('--size', type=int, default=1024, help='size of each EDI file in bytes')
+    parser.add_argument('--rounds', type=int, default=5, help='runs with and without metrics, the fastest counts')
+    parser.add_argument('--latency-ms', type=float, default=0.0, help='simulated SFTP, S3 and RabbitMQ round trip')
+    parser.add_argument('--max-overhead', type=float, default=5.0,
+                        help='fail if the metrics slow the loop down by more than this many percent')
+    args = parser.parse_args()
+
+    dummydownloader.console.setLevel(logging.WARNING)
+    latency = args.latency_ms / 1000.0
+
+    best = {True: None, False: None}
+    for _ in range(args.rounds):
+        # alternate, so both sides see the same drift of the machine
+        for enabled in (False, True):
+            pipeline_metrics.registry.enabled = enabled
+            result, elapsed = run_pipeline(args.files, args.size, latency)
+            if not result:
+                print("pipeline run failed")
+                return 1
+            if best[enabled] is None or elapsed < best[enabled]:
+                best[enabled] = elapsed
+
+    overhead = (best[True] - best[False]) / best[False] * 100
+    print("files=%d without metrics=%.3fs (%.1f files/sec) with metrics=%.3fs (%.1f files/sec) overhead=%.2f%%" % (
+        args.files, best[False], args.files / best[False], best[True], args.files / best[True], overhead))
+    print(pipeline_metrics.registry.render_prometheus().splitlines()[2])
+
+    if overhead > args.max_overhead:
+        print("metrics overhead above %.1f%%" % args.max_overhead)
+        return 1
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,81 @@
+import argparse
+import logging
+import os
+import shutil
+import tempfile
+import time
+
+import pika
+
+import standins
+import dummydownloader
+
+FEED_TYPE = 'benchmark'
+
+
+def publish_per_file_channel(mq_connection, config, download_dir, files):
+    # what publish_to_rabbitmq used to do for every file: new channel, declare, publish
+    mq = config[FEED_TYPE]['rabbitmq']
+    for file in files:
+        mq_channel = mq_connection.channel()
+        properties = pika.BasicProperties(content_type='text/plain',
+                                          headers={"data.size": os.path.getsize(os.path.join(download_dir, file))},
+                                          delivery_mode=2)
+        mq_channel.exchange_declare(exchange=mq['exchange'], exchange_type=mq['exchange_type'], durable=True)
+        mq_channel.basic_publish(exchange=mq['exchange'], routing_key=mq['routing_key'], body=file,
+                                 properties=properties)
+    return len(files)
+
+
+def publish_batched(mq_connection, config, download_dir, files, batch_size):
+    mq = config[FEED_TYPE]['rabbitmq']
+    mq_publisher = dummydownloader.MQPublisher(mq_connection, batch_size, batch_ms=1000)
+    confirmed = 0
+    for file in files:
+        dummydownloader.publish_to_rabbitmq(mq_publisher, mq['exchange'], mq['exchange_type'], mq['routing_key'],
+                                            download_dir, file, FEED_TYPE, 'edi-benchmark', '2020/01/01/', config)
+        if mq_publisher.batch_due():
+            confirmed += len(mq_publisher.flush())
+    confirmed += len(mq_publisher.flush())
+    mq_publisher.close()
+    return confirmed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="RabbitMQ publish micro-benchmark")
+    parser.add_argument('--messages', type=int, default=1000, help='number of file messages to publish')
+    parser.add_argument('--batch-sizes', type=int, nargs='+', default=[1, 10, 50, 200],
+                        help='confirm batch sizes to run')
+    parser.add_argument('--latency-ms', type=float, default=1.0, help='simulated broker round trip')
+    args = parser.parse_args()
+
+    dummydownloader.console.setLevel(logging.WARNING)
+    latency = args.latency_ms / 1000.0
+
+    download_dir = tempfile.mkdtemp(prefix='edi_bench_')
+    try:
+        files = standins.write_edi_files(download_dir, args.messages, 512)
+        config = standins.make_feed_config(FEED_TYPE, download_dir)
+
+        mq_connection = standins.FakeMQConnection(latency=latency)
+        dummydownloader.feed_context.mq_connection = mq_connection
+        start = time.perf_counter()
+        count = publish_per_file_channel(mq_connection, config, download_dir, files)
+        elapsed = time.perf_counter() - start
+        print("per-file channel      messages=%d round_trips=%d messages/sec=%.1f" % (
+            count, mq_connection.round_trips, count / elapsed))
+
+        for batch_size in args.batch_sizes:
+            mq_connection = standins.FakeMQConnection(latency=latency)
+            dummydownloader.feed_context.mq_connection = mq_connection
+            start = time.perf_counter()
+            count = publish_batched(mq_connection, config, download_dir, files, batch_size)
+            elapsed = time.perf_counter() - start
+            print("publisher batch=%-5d messages=%d round_trips=%d messages/sec=%.1f" % (
+                batch_size, count, mq_connection.round_trips, count / elapsed))
+    finally:
+        shutil.rmtree(download_dir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,148 @@
+import argparse
+import logging
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import time
+
+import standins
+import dummydownloader
+import rate_limits
+
+FEED_TYPE = 'benchmark'
+
+
+class PartnerServer(object):
+    """
+    A partner's SFTP server: connections beyond 'max_sessions' are refused, like a per-user session limit, and
+    the transfers in progress share 'bandwidth' bytes per second.
+    """
+
+    def __init__(self, root, max_sessions, bandwidth, latency):
+        self.root = root
+        self.max_sessions = max_sessions
+        self.bandwidth = bandwidth
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.sessions = 0
+        self.peak_sessions = 0
+        self.refused = 0
+        self.transferring = 0
+
+    def connect(self, sftp_dict=None):
+        with self.lock:
+            if self.sessions >= self.max_sessions:
+                self.refused += 1
+                raise ConnectionRefusedError("too many sessions for this user")
+            self.sessions += 1
+            self.peak_sessions = max(self.peak_sessions, self.sessions)
+        return PartnerConnection(self)
+
+
+class PartnerConnection(standins.FakeSFTPConnection):
+
+    def __init__(self, server):
+        super(PartnerConnection, self).__init__(server.root, latency=server.latency)
+        self.server = server
+        self.closed = False
+
+    def transfer(self, data):
+        with self.server.lock:
+            self.server.transferring += 1
+            share = self.server.bandwidth / self.server.transferring
+        try:
+            time.sleep(len(data) / share)
+        finally:
+            with self.server.lock:
+                self.server.transferring -= 1
+        self.bytes_sent += len(data)
+        return data
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            with self.server.lock:
+                self.server.sessions -= 1
+
+
+def run(name, sftp_server, args):
+    remote_root = tempfile.mkdtemp(prefix='edi_bench_remote_')
+    download_dir = tempfile.mkdtemp(prefix='edi_bench_')
+    try:
+        standins.write_edi_files(remote_root, args.files, args.size)
+        config = standins.make_feed_config(FEED_TYPE, download_dir)
+        config[FEED_TYPE]['sftp_server'].update(sftp_server)
+        server = PartnerServer(remote_root, args.max_sessions, args.bandwidth_mb * 1024 * 1024,
+                               args.latency_ms / 1000.0)
+        sftp = server.connect()
+        downloader = dummydownloader.SFTPDownloader(sftp, FEED_TYPE, config, connect=server.connect)
+
+        def on_downloaded(entry):
+            os.remove(os.path.join(download_dir, entry.filename))
+            return True
+
+        start = time.perf_counter()
+        result = downloader.download(sftp.listdir_attr(), on_downloaded)
+        elapsed = time.perf_counter() - start
+        sftp.close()
+        left = os.listdir(remote_root)
+    finally:
+        shutil.rmtree(remote_root, ignore_errors=True)
+        shutil.rmtree(download_dir, ignore_errors=True)
+
+    limit = downloader.limit.as_dict()
+    nbytes = args.files * args.size
+    text = "%-9s elapsed=%.2fs %.0f files/s %.2f MB/s, peak %d sessions, %d refused" % (
+        name, elapsed, args.files / elapsed, nbytes / elapsed / 1024 / 1024, server.peak_sessions, server.refused)
+    if 'concurrency_limit' in limit:
+        text += ", limit %d (%d up, %d down)" % (limit['concurrency_limit'], limit['increases'], limit['decreases'])
+    print(text)
+    return result and not left, elapsed, server
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Fixed and adaptive SFTP sessions, and byte rate limits, against "
+                                                 "a partner server with a session limit and a shared link")
+    parser.add_argument('--files', type=int, default=1500, help='number of EDI files')
+    parser.add_argument('--size', type=int, default=32 * 1024, help='size of each file in bytes')
+    parser.add_argument('--max-sessions', type=int, default=6, help='sessions the partner server accepts')
+    parser.add_argument('--sessions', type=int, default=16, help='sessions of the feed, the adaptive maximum')
+    parser.add_argument('--bandwidth-mb', type=float, default=8.0, help='MB/s of the link to the partner server')
+    parser.add_argument('--latency-ms', type=float, default=10.0, help='simulated SFTP round trip')
+    parser.add_argument('--window', type=float, default=0.5, help='adaptive_window of the controller')
+    parser.add_argument('--cap-mb', type=float, default=2.0, help='max_bytes_per_second of the capped run, in MB')
+    args = parser.parse_args()
+
+    dummydownloader.console.setLevel(logging.WARNING)
+
+    failed = False
+    # every run is against a server of its own, so every run gets a limit of its own
+    runs = [
+        ('fixed-4', {'port': 1, 'sessions': 4}),
+        ('fixed-' + str(args.sessions), {'port': 2, 'sessions': args.sessions}),
+        ('adaptive', {'port': 3, 'sessions': args.sessions, 'adaptive_sessions': True,
+                      'adaptive_window': args.window}),
+        ('capped', {'port': 4, 'sessions': 4, 'max_bytes_per_second': args.cap_mb * 1024 * 1024}),
+    ]
+    for name, sftp_server in runs:
+        result, elapsed, server = run(name, sftp_server, args)
+        if not result:
+            print("  not every file was downloaded")
+            failed = True
+        if name == 'capped':
+            limit = rate_limits.registry.limits['sftp:localhost:4']
+            allowed = limit.bucket.rate * elapsed + limit.bucket.burst
+            if limit.bucket.bytes > allowed * 1.02:
+                print("  %d bytes transferred, the limit allows %d" % (limit.bucket.bytes, allowed))
+                failed = True
+
+    for limit in rate_limits.registry:
+        print(str(limit))
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
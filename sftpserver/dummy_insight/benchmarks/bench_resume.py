@@ -0,0 +1,114 @@
+import argparse
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+
+import standins
+import dummydownloader
+
+
+def download_with_interruptions(rng, size, interruptions):
+    # drops the SFTP connection at random offsets until the file is complete, then checks the bytes
+    remote_root = tempfile.mkdtemp(prefix='edi_bench_remote_')
+    download_dir = tempfile.mkdtemp(prefix='edi_bench_')
+    try:
+        content = os.urandom(size)
+        with open(os.path.join(remote_root, 'BATCH.edi'), 'wb') as f:
+            f.write(content)
+        local_filename = os.path.join(download_dir, 'BATCH.edi')
+
+        transferred = 0
+        restart_cost = 0
+        attempts = 0
+        while True:
+            attempts += 1
+            fail_after = rng.randrange(1, size) if attempts <= interruptions else None
+            sftp = standins.FakeSFTPConnection(remote_root, fail_after_bytes=fail_after)
+            try:
+                dummydownloader.download_file(sftp, 'BATCH.edi', local_filename, size,
+                                              dummydownloader.PREFETCH_THRESHOLD)
+                transferred += sftp.bytes_sent
+                break
+            except EOFError:
+                transferred += sftp.bytes_sent
+                # starting over from zero would have cost everything sent so far in this attempt
+                restart_cost += os.path.getsize(local_filename + dummydownloader.PARTIAL_SUFFIX)
+
+        with open(local_filename, 'rb') as f:
+            intact = f.read() == content
+        return attempts, transferred, restart_cost + size, intact
+    finally:
+        shutil.rmtree(remote_root, ignore_errors=True)
+        shutil.rmtree(download_dir, ignore_errors=True)
+
+
+def upload_with_interruptions(rng, size, part_size, interruptions):
+    # fails a random S3 request until the multipart upload completes, then checks the object
+    download_dir = tempfile.mkdtemp(prefix='edi_bench_')
+    try:
+        content = os.urandom(size)
+        local_filename = os.path.join(download_dir, 'BATCH.edi')
+        with open(local_filename, 'wb') as f:
+            f.write(content)
+        multipart = {'threshold': 0, 'part_size': part_size, 'concurrency': 4,
+                     'checkpoint_dir': download_dir + '.checkpoints'}
+        part_count = (size + part_size - 1) // part_size
+
+        s3client = standins.FakeS3Client()
+        attempts = 0
+        restart_cost = 0
+        while True:
+            attempts += 1
+            if attempts <= interruptions:
+                s3client.fail_at_request = s3client.request_count + rng.randrange(1, part_count + 2)
+            else:
+                s3client.fail_at_request = None
+            received = s3client.bytes_received
+            try:
+                dummydownloader.upload_file_multipart(s3client, 'edi-benchmark', local_filename, 'BATCH.edi',
+                                                      multipart)
+                break
+            except ConnectionError:
+                restart_cost += s3client.bytes_received - received
+
+        intact = s3client.objects[('edi-benchmark', 'BATCH.edi')] == content
+        return attempts, s3client.bytes_received, restart_cost + size, intact
+    finally:
+        shutil.rmtree(download_dir, ignore_errors=True)
+        shutil.rmtree(download_dir + '.checkpoints', ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Resumable transfer benchmark with interruptions at random offsets")
+    parser.add_argument('--size', type=int, default=32 * 1024 * 1024, help='size of the batch file in bytes')
+    parser.add_argument('--part-size', type=int, default=1024 * 1024, help='multipart upload part size')
+    parser.add_argument('--interruptions', type=int, default=5, help='number of interruptions per transfer')
+    parser.add_argument('--rounds', type=int, default=5, help='number of transfers of each kind')
+    parser.add_argument('--seed', type=int, default=1, help='random seed for the interruption offsets')
+    args = parser.parse_args()
+
+    dummydownloader.console.setLevel(logging.WARNING)
+    rng = random.Random(args.seed)
+    ok = True
+
+    for n in range(args.rounds):
+        attempts, transferred, restart_cost, intact = download_with_interruptions(rng, args.size, args.interruptions)
+        ok = ok and intact
+        print("download %d: attempts=%d bytes sent=%d (restart from zero: %d) intact=%s" % (
+            n, attempts, transferred, restart_cost, intact))
+
+    for n in range(args.rounds):
+        attempts, transferred, restart_cost, intact = upload_with_interruptions(rng, args.size, args.part_size,
+                                                                                args.interruptions)
+        ok = ok and intact
+        print("upload   %d: attempts=%d bytes sent=%d (restart from zero: %d) intact=%s" % (
+            n, attempts, transferred, restart_cost, intact))
+
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
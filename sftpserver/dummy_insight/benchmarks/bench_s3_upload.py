@@ -0,0 +1,53 @@
+import argparse
+import logging
+import shutil
+import tempfile
+import time
+
+import standins
+import dummydownloader
+
+FEED_TYPE = 'benchmark'
+
+
+def run(workers, file_count, file_size, s3client, mq_connection):
+    download_dir = tempfile.mkdtemp(prefix='edi_bench_')
+    try:
+        standins.write_edi_files(download_dir, file_count, file_size)
+        config = standins.make_feed_config(FEED_TYPE, download_dir, upload_workers=workers)
+        dummydownloader.feed_context.mq_connection = mq_connection
+
+        start = time.perf_counter()
+        result = dummydownloader.publish_files(mq_connection, s3client, FEED_TYPE, config)
+        elapsed = time.perf_counter() - start
+    finally:
+        shutil.rmtree(download_dir, ignore_errors=True)
+
+    return result, elapsed
+
+
+def main():
+    parser = argparse.ArgumentParser(description="S3 upload stage benchmark")
+    parser.add_argument('--files', type=int, default=2000, help='number of EDI files per run')
+    parser.add_argument('--size', type=int, default=1024, help='size of each EDI file in bytes')
+    parser.add_argument('--workers', type=int, nargs='+', default=[1, 4, 16], help='upload_workers values to run')
+    parser.add_argument('--latency-ms', type=float, default=20.0, help='simulated S3 round trip (fake backend only)')
+    parser.add_argument('--s3', choices=['fake', 'moto'], default='fake', help='S3 stand-in to upload to')
+    args = parser.parse_args()
+
+    dummydownloader.console.setLevel(logging.WARNING)
+
+    for workers in args.workers:
+        if args.s3 == 'moto':
+            s3client = standins.get_moto_s3_client('edi-benchmark')
+        else:
+            s3client = standins.FakeS3Client(latency=args.latency_ms / 1000.0)
+        mq_connection = standins.FakeMQConnection()
+
+        result, elapsed = run(workers, args.files, args.size, s3client, mq_connection)
+        print("workers=%-3d files=%d published=%d ok=%s elapsed=%.2fs files/sec=%.1f" % (
+            workers, args.files, len(mq_connection.published), result, elapsed, args.files / elapsed))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,121 @@
+import argparse
+import logging
+import shutil
+import sys
+import tempfile
+import time
+
+import standins
+import dummydownloader
+
+FEED_TYPE = 'benchmark'
+# the small files are a few KB, the large one tens of MB
+LARGE_FILE_THRESHOLD = 1024 * 1024
+
+# schedule settings of each run, on one SFTP session like the feeds run by default
+RUNS = (('fifo', {}),
+        ('size', {'schedule': 'size'}),
+        ('fifo + large lane', {'large_file_sessions': 1}),
+        ('priority + large lane', {'schedule': 'priority', 'priority_patterns': ['ACK_*'], 'large_file_sessions': 1}),
+        ('priority, strict order', {'schedule': 'priority', 'priority_patterns': ['ACK_*'], 'strict_order': True}))
+
+
+class PublishTimes(list):
+    # the published messages of FakeMQConnection, with the time each file's message was committed
+
+    def __init__(self):
+        super(PublishTimes, self).__init__()
+        self.times = {}
+
+    def append(self, message):
+        self.times[message[2]] = time.perf_counter()
+        super(PublishTimes, self).append(message)
+
+    def extend(self, messages):
+        for message in messages:
+            self.append(message)
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def run(ftp_client, args):
+    remote_root = tempfile.mkdtemp(prefix='edi_bench_remote_')
+    download_dir = tempfile.mkdtemp(prefix='edi_bench_')
+    try:
+        large = standins.write_edi_files(remote_root, 1, args.large_size, prefix='BATCH')
+        small = standins.write_edi_files(remote_root, args.files, args.size)
+        acks = standins.write_edi_files(remote_root, args.acks, args.size, prefix='ACK')
+        config = standins.make_feed_config(FEED_TYPE, download_dir, large_file_threshold=LARGE_FILE_THRESHOLD,
+                                           **ftp_client)
+        bandwidth = args.bandwidth_mb * 1024 * 1024
+        mq_connection = standins.FakeMQConnection(latency=args.latency_ms / 1000.0)
+        mq_connection.published = PublishTimes()
+        s3client = standins.FakeS3Client(latency=args.latency_ms / 1000.0, store=False, bandwidth=bandwidth)
+        dummydownloader.feed_context.mq_connection = mq_connection
+
+        def connect(sftp_dict):
+            return standins.FakeSFTPConnection(remote_root, latency=args.latency_ms / 1000.0, bandwidth=bandwidth)
+
+        sftp = connect(None)
+        # the server lists the big batch first, then the files in name order
+        entries = sorted(sftp.listdir_attr(), key=lambda entry: (entry.filename not in large, entry.filename))
+        start = time.perf_counter()
+        publish_queue = dummydownloader.PublishQueue(mq_connection, s3client, FEED_TYPE, config)
+        try:
+            def on_downloaded(entry):
+                publish_queue.put(entry.filename)
+                return publish_queue.drain(block=False)
+
+            downloader = dummydownloader.SFTPDownloader(sftp, FEED_TYPE, config, connect=connect)
+            result = downloader.download(entries, on_downloaded) and publish_queue.drain()
+        finally:
+            publish_queue.close()
+        elapsed = time.perf_counter() - start
+    finally:
+        shutil.rmtree(remote_root, ignore_errors=True)
+        shutil.rmtree(download_dir, ignore_errors=True)
+
+    # seconds from the start of the cycle to the commit of each file's message
+    latency = dict((file, published - start) for file, published in mq_connection.published.times.items())
+    published_order = [message[2] for message in mq_connection.published]
+    return result, elapsed, latency, published_order, large, small, acks
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Small-file latency behind a large file under each schedule")
+    parser.add_argument('--files', type=int, default=200, help='number of small EDI files')
+    parser.add_argument('--acks', type=int, default=20, help='number of small ACK files, the priority pattern')
+    parser.add_argument('--size', type=int, default=2048, help='size of each small file in bytes')
+    parser.add_argument('--large-size', type=int, default=32 * 1024 * 1024, help='size of the large file in bytes')
+    parser.add_argument('--bandwidth-mb', type=float, default=32.0, help='SFTP and S3 MB/s per connection')
+    parser.add_argument('--latency-ms', type=float, default=2.0, help='simulated SFTP, S3 and RabbitMQ round trip')
+    args = parser.parse_args()
+
+    dummydownloader.console.setLevel(logging.WARNING)
+
+    failed = False
+    for name, ftp_client in RUNS:
+        result, elapsed, latency, published_order, large, small, acks = run(ftp_client, args)
+        if not result or len(published_order) != len(large) + len(small) + len(acks):
+            print("%-24s not every file was published" % name)
+            failed = True
+            continue
+
+        small_latency = [latency[file] for file in small + acks]
+        print("%-24s elapsed=%.2fs small files p50=%.3fs p99=%.3fs ACK files p99=%.3fs large file=%.3fs" % (
+            name, elapsed, percentile(small_latency, 0.5), percentile(small_latency, 0.99),
+            percentile([latency[file] for file in acks], 0.99), latency[large[0]]))
+        if ftp_client.get('strict_order'):
+            expected = acks + large + small
+            if published_order != expected:
+                print("  files were not published in schedule order")
+                failed = True
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
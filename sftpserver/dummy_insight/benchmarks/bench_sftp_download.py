@@ -0,0 +1,66 @@
+import argparse
+import logging
+import shutil
+import tempfile
+import time
+
+import standins
+import dummydownloader
+
+FEED_TYPE = 'benchmark'
+
+
+def run(sessions, args):
+    remote_root = tempfile.mkdtemp(prefix='edi_bench_remote_')
+    download_dir = tempfile.mkdtemp(prefix='edi_bench_')
+    try:
+        standins.write_edi_files(remote_root, args.files, args.size)
+        standins.write_edi_files(remote_root, args.large_files, args.large_size, prefix='BATCH')
+        config = standins.make_feed_config(FEED_TYPE, download_dir, prefetch_threshold=args.prefetch_threshold)
+        config[FEED_TYPE]['sftp_server']['sessions'] = sessions
+
+        latency = args.latency_ms / 1000.0
+
+        def connect(sftp_dict):
+            return standins.FakeSFTPConnection(remote_root, latency=latency)
+
+        downloaded = []
+        start = time.perf_counter()
+        sftp = connect(config[FEED_TYPE]['sftp_server'])
+        with sftp.cd('.'):
+            entries = sftp.listdir_attr()
+            downloader = dummydownloader.SFTPDownloader(sftp, FEED_TYPE, config, connect=connect)
+            result = downloader.download(entries, lambda filename: downloaded.append(filename) or True)
+        elapsed = time.perf_counter() - start
+
+        total_bytes = sum(entry.st_size for entry in entries)
+        print("sessions=%-3d files=%d ok=%s elapsed=%.2fs files/sec=%.1f MB/s=%.2f" % (
+            sessions, len(downloaded), result, elapsed, len(downloaded) / elapsed,
+            total_bytes / elapsed / 1024 / 1024))
+        for stats in sorted(downloader.session_stats, key=lambda stats: stats.session):
+            print("    " + str(stats))
+    finally:
+        shutil.rmtree(remote_root, ignore_errors=True)
+        shutil.rmtree(download_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Multi-session SFTP download benchmark")
+    parser.add_argument('--files', type=int, default=500, help='number of small EDI files')
+    parser.add_argument('--size', type=int, default=2048, help='size of each small EDI file in bytes')
+    parser.add_argument('--large-files', type=int, default=4, help='number of large batch files')
+    parser.add_argument('--large-size', type=int, default=8 * 1024 * 1024, help='size of each large file in bytes')
+    parser.add_argument('--sessions', type=int, nargs='+', default=[1, 4, 8], help='SFTP session pool sizes to run')
+    parser.add_argument('--prefetch-threshold', type=int, default=dummydownloader.PREFETCH_THRESHOLD,
+                        help='files at least this big are read with prefetch')
+    parser.add_argument('--latency-ms', type=float, default=5.0, help='simulated SFTP round trip')
+    args = parser.parse_args()
+
+    dummydownloader.console.setLevel(logging.WARNING)
+
+    for sessions in args.sessions:
+        run(sessions, args)
+
+
+if __name__ == "__main__":
+    main()
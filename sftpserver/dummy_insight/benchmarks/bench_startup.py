@@ -0,0 +1,76 @@
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+DOWNLOADER = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'dummydownloader.py')
+
+# runs that never get to a transfer, they must not load any of the client libraries
+RUNS = (('help', ['--help']),
+        ('bad arguments', ['-s', 'dev']))
+
+# the modules that are only imported by the stage that needs them
+LAZY_MODULES = ('pika', 'boto3', 'botocore', 'pysftp', 'paramiko', 'cryptography', 'http.server', 'cProfile',
+                'pstats', 'asyncio', 'async_engine', 'asyncssh', 'aiobotocore', 'aio_pika', 'sqlite3', 'tarfile',
+                'zipfile')
+
+
+def parse_importtime(stderr):
+    # 'import time: self [us] | cumulative | imported package' lines of python -X importtime, nested imports are
+    # indented under the module that imported them
+    imports = []
+    for line in stderr.splitlines():
+        if not line.startswith('import time:') or 'imported package' in line:
+            continue
+        self_us, cumulative_us, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        imports.append((name.strip(), int(self_us), int(cumulative_us), depth))
+    return imports
+
+
+def run_startup(arguments):
+    start = time.perf_counter()
+    result = subprocess.run([sys.executable, '-X', 'importtime', DOWNLOADER] + arguments, stdout=subprocess.DEVNULL,
+                            stderr=subprocess.PIPE, universal_newlines=True)
+    elapsed = time.perf_counter() - start
+    return elapsed, parse_importtime(result.stderr)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Start-up time of dummydownloader.py up to argument checking")
+    parser.add_argument('--rounds', type=int, default=5, help='runs of each command line, the fastest counts')
+    parser.add_argument('--budget-ms', type=float, default=100.0,
+                        help='fail if the imports of a run take longer than this many milliseconds')
+    parser.add_argument('--top', type=int, default=5, help='number of slowest top-level imports listed')
+    args = parser.parse_args()
+
+    failed = False
+    for run_name, arguments in RUNS:
+        best = None
+        for _ in range(args.rounds):
+            elapsed, imports = run_startup(arguments)
+            import_ms = sum(cumulative for _, _, cumulative, depth in imports if depth == 0) / 1000.0
+            if best is None or import_ms < best[1]:
+                best = (elapsed, import_ms, imports)
+
+        elapsed, import_ms, imports = best
+        print("%s: wall=%.1fms imports=%.1fms modules=%d" % (run_name, elapsed * 1000, import_ms, len(imports)))
+        top_level = sorted((entry for entry in imports if entry[3] == 0), key=lambda entry: entry[2], reverse=True)
+        for name, _, cumulative, _ in top_level[:args.top]:
+            print("  %-24s %.1fms" % (name, cumulative / 1000.0))
+
+        loaded = set(name for name, _, _, _ in imports)
+        eager = [name for name in LAZY_MODULES if name in loaded]
+        if eager:
+            print("  imported before they are needed: " + ", ".join(eager))
+            failed = True
+        if import_ms > args.budget_ms:
+            print("  imports above the %.1fms budget" % args.budget_ms)
+            failed = True
+
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,82 @@
+import argparse
+import json
+import logging
+import os
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+import standins
+import dummydownloader
+
+FEED_TYPE = 'benchmark'
+
+
+def run_one(mode, size, latency):
+    # runs in its own process, so ru_maxrss is the peak of this one transfer
+    remote_root = tempfile.mkdtemp(prefix='edi_bench_remote_')
+    download_dir = tempfile.mkdtemp(prefix='edi_bench_')
+    try:
+        with open(os.path.join(remote_root, 'BATCH.edi'), 'wb') as f:
+            block = os.urandom(1024 * 1024)
+            for offset in range(0, size, len(block)):
+                f.write(block[:min(len(block), size - offset)])
+        config = standins.make_feed_config(FEED_TYPE, download_dir)
+        multipart = dummydownloader.get_multipart_config(FEED_TYPE, config)
+
+        sftp = standins.FakeSFTPConnection(remote_root, latency=latency)
+        s3client = standins.FakeS3Client(latency=latency, store=False)
+        baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+        start = time.perf_counter()
+        if mode == 'stream':
+            dummydownloader.stream_file_to_s3(sftp, 'BATCH.edi', size, s3client, 'edi-benchmark',
+                                              '2020/01/01/BATCH.edi', multipart['part_size'],
+                                              multipart['concurrency'])
+        else:
+            dummydownloader.download_file(sftp, 'BATCH.edi', os.path.join(download_dir, 'BATCH.edi'), size,
+                                          dummydownloader.PREFETCH_THRESHOLD)
+            date_prefix = dummydownloader.get_s3_date_prefix(download_dir, 'BATCH.edi')
+            dummydownloader.upload_file_to_s3(s3client, 'edi-benchmark', download_dir, 'BATCH.edi', date_prefix,
+                                              multipart=multipart)
+            os.remove(os.path.join(download_dir, 'BATCH.edi'))
+        elapsed = time.perf_counter() - start
+
+        # ru_maxrss is in KB on Linux
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        return {'mode': mode, 'size': size, 'seconds': elapsed, 'peak_rss_kb': peak,
+                'peak_rss_growth_kb': peak - baseline}
+    finally:
+        shutil.rmtree(remote_root, ignore_errors=True)
+        shutil.rmtree(download_dir, ignore_errors=True)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Streaming vs download-to-disk transfer benchmark")
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1024, 1024 * 1024, 64 * 1024 * 1024,
+                                                                 256 * 1024 * 1024],
+                        help='file sizes in bytes')
+    parser.add_argument('--latency-ms', type=float, default=1.0, help='simulated SFTP and S3 round trip')
+    parser.add_argument('--child', nargs=2, metavar=('MODE', 'SIZE'), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    dummydownloader.console.setLevel(logging.WARNING)
+
+    if args.child:
+        print(json.dumps(run_one(args.child[0], int(args.child[1]), args.latency_ms / 1000.0)))
+        return
+
+    for size in args.sizes:
+        for mode in ('disk', 'stream'):
+            output = subprocess.check_output([sys.executable, os.path.abspath(__file__), '--latency-ms',
+                                              str(args.latency_ms), '--child', mode, str(size)])
+            result = json.loads(output.decode().strip().splitlines()[-1])
+            print("%-6s size=%-10d seconds=%.3f peak_rss=%d KB (+%d KB)" % (
+                mode, size, result['seconds'], result['peak_rss_kb'], result['peak_rss_growth_kb']))
+
+
+if __name__ == "__main__":
+    main()
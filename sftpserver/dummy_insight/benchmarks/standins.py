@@ -0,0 +1,553 @@
+import asyncio
+import base64
+import hashlib
+import os
+import shutil
+import sys
+import threading
+import time
+
+# the benchmarks run the real dummydownloader code against these local stand-ins
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def simulate_round_trip(latency):
+    if latency:
+        time.sleep(latency)
+
+
+def check_content_md5(body, kwargs):
+    # like S3, a request whose body does not match its Content-MD5 is rejected
+    if 'ContentMD5' in kwargs and base64.b64encode(hashlib.md5(body).digest()).decode('ascii') != kwargs['ContentMD5']:
+        raise ValueError("BadDigest: the Content-MD5 you specified did not match what was received")
+
+
+def simulate_transfer(nbytes, bandwidth):
+    # bandwidth in bytes per second of one connection, None for unlimited
+    if bandwidth and nbytes:
+        time.sleep(nbytes / float(bandwidth))
+
+
+class FakeS3Client(object):
+    """
+    Thread-safe in-memory stand-in for the boto3 S3 client calls used by dummydownloader.
+    Every request sleeps for 'latency' seconds to stand in for the HTTPS round trip, plus the time its body
+    takes at 'bandwidth' bytes per second.
+    """
+
+    def __init__(self, latency=0.0, fail_at_request=None, store=True, bandwidth=None):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        # with store=False only the size of the objects is kept, so memory benchmarks do not measure the stand-in
+        self.store = store
+        self.objects = {}
+        self.multipart_uploads = {}
+        self.upload_count = 0
+        self.request_count = 0
+        self.bytes_received = 0
+        # the request with this number fails, to test interrupted uploads
+        self.fail_at_request = fail_at_request
+        self.lock = threading.Lock()
+
+    def _request(self, body_size=0):
+        simulate_round_trip(self.latency)
+        simulate_transfer(body_size, self.bandwidth)
+        with self.lock:
+            self.request_count += 1
+            if self.request_count == self.fail_at_request:
+                raise ConnectionError("simulated S3 connection failure at request " + str(self.request_count))
+            self.bytes_received += body_size
+
+    def upload_file(self, Filename, Bucket, Key, ExtraArgs=None, Callback=None, Config=None):
+        # read in 8 MB chunks like boto3's transfer manager does
+        size = 0
+        chunks = []
+        with open(Filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(8 * 1024 * 1024), b''):
+                size += len(chunk)
+                if self.store:
+                    chunks.append(chunk)
+        self._request(size)
+        with self.lock:
+            self.objects[(Bucket, Key)] = b''.join(chunks) if self.store else size
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        body = Body if isinstance(Body, bytes) else Body.read()
+        check_content_md5(body, kwargs)
+        self._request(len(body))
+        with self.lock:
+            self.objects[(Bucket, Key)] = body if self.store else len(body)
+        return {'ETag': '"%x"' % (hash(body) & 0xffffffff)}
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        self._request()
+        with self.lock:
+            self.upload_count += 1
+            upload_id = 'upload-%d' % self.upload_count
+            self.multipart_uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, PartNumber, UploadId, Body, **kwargs):
+        body = Body if isinstance(Body, bytes) else Body.read()
+        check_content_md5(body, kwargs)
+        self._request(len(body))
+        with self.lock:
+            if UploadId not in self.multipart_uploads:
+                raise KeyError("NoSuchUpload " + UploadId)
+            self.multipart_uploads[UploadId][PartNumber] = body if self.store else len(body)
+        return {'ETag': '"%x"' % (hash(body) & 0xffffffff)}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        self._request()
+        with self.lock:
+            parts = self.multipart_uploads.pop(UploadId)
+            if self.store:
+                body = b''.join(parts[part['PartNumber']] for part in MultipartUpload['Parts'])
+            else:
+                body = sum(parts.values())
+            self.objects[(Bucket, Key)] = body
+        return {'ETag': '"%x-%d"' % (hash(body) & 0xffffffff, len(parts))}
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self._request()
+        with self.lock:
+            self.multipart_uploads.pop(UploadId, None)
+
+    def head_object(self, Bucket, Key):
+        self._request()
+        with self.lock:
+            body = self.objects[(Bucket, Key)]
+        size = body if isinstance(body, int) else len(body)
+        return {'ContentLength': size, 'ETag': '"%x"' % (hash(body) & 0xffffffff)}
+
+
+def get_moto_s3_client(bucket):
+    # moto >= 5 exposes mock_aws, older releases mock_s3
+    import boto3
+    try:
+        from moto import mock_aws as mock
+    except ImportError:
+        from moto import mock_s3 as mock
+
+    mock().start()
+    s3client = boto3.client('s3', region_name='us-east-1',
+                            aws_access_key_id='testing', aws_secret_access_key='testing')
+    s3client.create_bucket(Bucket=bucket)
+    return s3client
+
+
+class FakeMQChannel(object):
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.confirming = False
+        self.transactional = False
+        self.pending = []
+        self.is_open = True
+
+    def exchange_declare(self, exchange, exchange_type='direct', durable=False, **kwargs):
+        self.connection.round_trip()
+
+    def confirm_delivery(self):
+        self.connection.round_trip()
+        self.confirming = True
+
+    def tx_select(self):
+        self.connection.round_trip()
+        self.transactional = True
+
+    def tx_commit(self):
+        self.connection.round_trip()
+        self.connection.published.extend(self.pending)
+        self.pending = []
+
+    def tx_rollback(self):
+        self.connection.round_trip()
+        self.pending = []
+
+    def basic_publish(self, exchange, routing_key, body, properties=None, mandatory=False):
+        if self.transactional:
+            self.pending.append((exchange, routing_key, body, properties))
+            return
+        if self.confirming:
+            # a confirmed publish on a BlockingChannel waits for the broker's ack
+            self.connection.round_trip()
+        self.connection.published.append((exchange, routing_key, body, properties))
+
+    def close(self):
+        self.is_open = False
+
+
+class FakeMQConnection(object):
+    """
+    Stand-in for pika.BlockingConnection. Every synchronous AMQP method (channel open, declare, confirmed
+    publish, commit) sleeps for 'latency' seconds to stand in for the broker round trip.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.published = []
+        self.round_trips = 0
+        self.is_open = True
+
+    def round_trip(self):
+        simulate_round_trip(self.latency)
+        self.round_trips += 1
+
+    def channel(self):
+        self.round_trip()
+        return FakeMQChannel(self)
+
+    def process_data_events(self, time_limit=0):
+        pass
+
+    def close(self):
+        self.is_open = False
+
+
+class FakeBasicProperties(object):
+    # stand-in for pika.BasicProperties, all of pika the publish path needs once its connection is a
+    # FakeMQConnection
+
+    def __init__(self, content_type=None, headers=None, delivery_mode=None):
+        self.content_type = content_type
+        self.headers = headers
+        self.delivery_mode = delivery_mode
+
+
+class FakeSFTPAttributes(object):
+
+    def __init__(self, filename, st_size, st_mtime, st_mode=0o100644):
+        self.filename = filename
+        self.st_size = st_size
+        self.st_mtime = st_mtime
+        self.st_mode = st_mode
+
+
+class FakeSFTPFile(object):
+    """
+    Remote file of FakeSFTPConnection. Without prefetch every read request of up to 32 KB waits for a round
+    trip, after prefetch() the whole file arrives after a single one, like paramiko's pipelined reads.
+    """
+
+    MAX_REQUEST_SIZE = 32768
+
+    def __init__(self, connection, path):
+        self.connection = connection
+        self.path = path
+        self.file = open(path, 'rb')
+        self.prefetched = False
+        self.sent = False
+
+    def prefetch(self, file_size=None):
+        self.connection.round_trip()
+        self.prefetched = True
+
+    def seek(self, offset, whence=0):
+        self.file.seek(offset, whence)
+
+    def readv(self, chunks):
+        # pipelined like paramiko's readv: one round trip for the whole list of blocks
+        self.connection.round_trip()
+        for offset, length in chunks:
+            self.file.seek(offset)
+            data = self.connection.transfer(self.file.read(length))
+            if self.file.tell() >= os.fstat(self.file.fileno()).st_size:
+                self.sent = True
+            yield data
+
+    def read(self, size=-1):
+        if not self.prefetched:
+            self.connection.round_trip()
+            if size < 0 or size > self.MAX_REQUEST_SIZE:
+                size = self.MAX_REQUEST_SIZE
+        block = self.file.read(size)
+        data = self.connection.transfer(block)
+        if len(data) < len(block):
+            # the connection dropped part way through the block, the rest of it was never sent
+            self.file.seek(len(data) - len(block), os.SEEK_CUR)
+        if not data:
+            self.sent = True
+        return data
+
+    def close(self):
+        self.file.close()
+        if self.sent and os.path.exists(self.path):
+            os.remove(self.path)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class FakeSFTPConnection(object):
+    """
+    Stand-in for pysftp.Connection serving the files of a local directory, every SFTP request sleeps
+    for 'latency' seconds and file data arrives at 'bandwidth' bytes per second. Like the simulated server,
+    a file is removed once it has been read to the end.
+    """
+
+    def __init__(self, root, latency=0.0, fail_after_bytes=None, bandwidth=None):
+        self.root = root
+        self.cwd_path = root
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.round_trips = 0
+        self.bytes_sent = 0
+        # the connection drops once this many bytes have been sent, to test interrupted downloads
+        self.fail_after_bytes = fail_after_bytes
+        self.lock = threading.Lock()
+        self.round_trip()
+
+    def round_trip(self):
+        simulate_round_trip(self.latency)
+        with self.lock:
+            self.round_trips += 1
+
+    def transfer(self, data):
+        with self.lock:
+            if self.fail_after_bytes is not None and self.bytes_sent + len(data) > self.fail_after_bytes:
+                data = data[:self.fail_after_bytes - self.bytes_sent]
+                if not data:
+                    raise EOFError("simulated SFTP connection drop after " + str(self.bytes_sent) + " bytes")
+            self.bytes_sent += len(data)
+        simulate_transfer(len(data), self.bandwidth)
+        return data
+
+    @property
+    def sftp_client(self):
+        return self
+
+    def get_channel(self):
+        return self
+
+    def get_transport(self):
+        return self
+
+    def is_active(self):
+        return True
+
+    def cwd(self, path):
+        self.round_trip()
+        self.cwd_path = os.path.join(self.root, path)
+
+    chdir = cwd
+
+    def cd(self, path):
+        connection = self
+        previous = self.cwd_path
+
+        class ChangeDirectory(object):
+            def __enter__(self):
+                connection.cwd(path)
+
+            def __exit__(self, *exc):
+                connection.cwd_path = previous
+
+        return ChangeDirectory()
+
+    def listdir_attr(self, path='.'):
+        self.round_trip()
+        directory = os.path.join(self.cwd_path, path)
+        entries = []
+        for entry in os.scandir(directory):
+            file_stats = entry.stat()
+            entries.append(FakeSFTPAttributes(entry.name, file_stats.st_size, int(file_stats.st_mtime),
+                                              file_stats.st_mode))
+        return entries
+
+    def listdir(self, path='.'):
+        return [entry.filename for entry in self.listdir_attr(path)]
+
+    def stat(self, path):
+        self.round_trip()
+        file_stats = os.stat(os.path.join(self.cwd_path, path))
+        return FakeSFTPAttributes(os.path.basename(path), file_stats.st_size, int(file_stats.st_mtime))
+
+    def open(self, path, mode='rb'):
+        self.round_trip()
+        return FakeSFTPFile(self, os.path.join(self.cwd_path, path))
+
+    def get(self, remotepath, localpath, callback=None, preserve_mtime=False):
+        self.stat(remotepath)
+        with self.open(remotepath) as remote_file, open(localpath, 'wb') as local_file:
+            remote_file.prefetch()
+            shutil.copyfileobj(remote_file, local_file)
+
+    def close(self):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class AsyncFakeS3Client(object):
+    """
+    Stand-in for an aiobotocore S3 client, on the objects of a FakeS3Client. Every request awaits 'latency'
+    seconds plus the time its body takes at 'bandwidth' bytes per second, S3 requests go over connections of
+    their own.
+    """
+
+    def __init__(self, latency=0.0, store=True, bandwidth=None):
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.s3 = FakeS3Client(store=store)
+
+    @property
+    def objects(self):
+        return self.s3.objects
+
+    @property
+    def request_count(self):
+        return self.s3.request_count
+
+    async def _request(self, body=b''):
+        await asyncio.sleep(self.latency + (len(body) / float(self.bandwidth) if self.bandwidth else 0.0))
+
+    async def put_object(self, **kwargs):
+        await self._request(kwargs['Body'])
+        return self.s3.put_object(**kwargs)
+
+    async def create_multipart_upload(self, **kwargs):
+        await self._request()
+        return self.s3.create_multipart_upload(**kwargs)
+
+    async def upload_part(self, **kwargs):
+        await self._request(kwargs['Body'])
+        return self.s3.upload_part(**kwargs)
+
+    async def complete_multipart_upload(self, **kwargs):
+        await self._request()
+        return self.s3.complete_multipart_upload(**kwargs)
+
+    async def abort_multipart_upload(self, **kwargs):
+        await self._request()
+        return self.s3.abort_multipart_upload(**kwargs)
+
+
+class AsyncFakeMQPublisher(object):
+    """
+    Stand-in for async_engine.AsyncMQPublisher: publish() awaits 'latency' seconds for the broker's confirm,
+    'published' holds (body, headers) of every confirmed message.
+    """
+
+    def __init__(self, latency=0.0):
+        self.latency = latency
+        self.published = []
+
+    async def publish(self, body, headers):
+        await asyncio.sleep(self.latency)
+        self.published.append((body, headers))
+
+
+class AsyncFakeSFTPName(object):
+
+    def __init__(self, filename, attrs):
+        self.filename = filename
+        self.attrs = attrs
+
+
+class AsyncFakeSFTPAttrs(object):
+
+    def __init__(self, size, mtime, permissions):
+        self.size = size
+        self.mtime = mtime
+        self.permissions = permissions
+
+
+class AsyncFakeSFTPFile(object):
+
+    def __init__(self, client, path):
+        self.client = client
+        self.path = path
+        self.file = open(path, 'rb')
+        self.sent = False
+
+    async def read(self, size=-1):
+        # one round trip per read whatever its size, like asyncssh's pipelined requests
+        await self.client.round_trip()
+        data = self.file.read(size)
+        await self.client.transfer(len(data))
+        if not data:
+            self.sent = True
+        return data
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc):
+        self.file.close()
+        if self.sent and os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class AsyncFakeSFTPClient(object):
+    """
+    Stand-in for an asyncssh SFTPClient serving the files of a local directory. Every request awaits 'latency'
+    seconds, the reads of all files share the one connection's 'bandwidth'. Like FakeSFTPConnection, a file is
+    removed once it has been read to the end.
+    """
+
+    def __init__(self, root, latency=0.0, bandwidth=None):
+        self.root = root
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.round_trips = 0
+        # when the connection has sent what it has been asked for so far
+        self.link_free = 0.0
+
+    async def round_trip(self):
+        self.round_trips += 1
+        await asyncio.sleep(self.latency)
+
+    async def transfer(self, nbytes):
+        if self.bandwidth and nbytes:
+            now = time.monotonic()
+            self.link_free = max(now, self.link_free) + nbytes / float(self.bandwidth)
+            await asyncio.sleep(self.link_free - now)
+
+    async def readdir(self, path='.'):
+        await self.round_trip()
+        names = []
+        for entry in os.scandir(os.path.join(self.root, path)):
+            file_stats = entry.stat()
+            names.append(AsyncFakeSFTPName(entry.name, AsyncFakeSFTPAttrs(file_stats.st_size, int(file_stats.st_mtime),
+                                                                          file_stats.st_mode)))
+        return names
+
+    def open(self, path, mode='rb'):
+        # opening costs the round trip of the first read
+        return AsyncFakeSFTPFile(self, os.path.join(self.root, path))
+
+
+def write_edi_files(directory, count, size, prefix='EDI'):
+    body = (b'ISA*00*          *00*          *ZZ*SENDER         *ZZ*RECEIVER       ~' * (size // 80 + 1))[:size]
+    names = []
+    for i in range(count):
+        name = '%s_%08d.edi' % (prefix, i)
+        with open(os.path.join(directory, name), 'wb') as f:
+            f.write(body)
+        names.append(name)
+    return names
+
+
+def make_feed_config(feed_type, download_dir, **ftp_client):
+    ftp_client_config = {'download_dir': download_dir, 's3_bucket': 'edi-benchmark'}
+    ftp_client_config.update(ftp_client)
+    return {
+        's3': {'aws_access_key_id': 'testing', 'aws_secret_access_key': 'testing'},
+        feed_type: {
+            'rabbitmq': {'host': 'localhost', 'port': 5672, 'virtual_host': '/', 'user_name': 'guest',
+                         'password': 'guest', 'exchange': 'edi', 'exchange_type': 'direct',
+                         'routing_key': feed_type, 'exception_exchange': 'edi.exception',
+                         'exception_key': feed_type},
+            'ftp_client': ftp_client_config,
+            'sftp_server': {'host': 'localhost', 'port': 2222, 'user_name': 'dummy', 'password': '12345',
+                            'source_dir': '.'},
+        }
+    }
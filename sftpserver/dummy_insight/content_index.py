@@ -0,0 +1,73 @@
+import os
+import threading
+import time
+
+# what happens to a downloaded file whose content is already in S3: 'pointer' publishes its message with the
+# S3 key of the earlier copy, 'skip' publishes nothing, 'publish' uploads and publishes it like any other file
+DUPLICATE_ACTIONS = ('pointer', 'skip', 'publish')
+
+
+class ContentIndex(object):
+    """
+    On-disk index (SQLite) of the content uploaded to S3 by a feed: the MD5 of every file, as raw 16 bytes,
+    with its size and the S3 key it was uploaded under, and for a file uploaded in a batch the offset of its
+    bytes in the batch's archive. A file downloaded with the same MD5 and size is a duplicate of that key.
+    Entries older than 'retention_days' are pruned when the index is opened, so pointers are not published
+    to objects the bucket's lifecycle rules may have expired.
+    """
+
+    def __init__(self, path, retention_days=30, duplicates='pointer'):
+        if duplicates not in DUPLICATE_ACTIONS:
+            raise ValueError("unknown duplicates action '" + str(duplicates) + "', expected one of " +
+                             str(list(DUPLICATE_ACTIONS)))
+        self.path = path
+        self.duplicates = duplicates
+        self.lock = threading.Lock()
+        import sqlite3
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS contents ("
+                            "md5 BLOB NOT NULL, size INTEGER NOT NULL, s3_key TEXT NOT NULL, "
+                            "updated REAL NOT NULL, PRIMARY KEY (md5, size)) WITHOUT ROWID")
+            # indexes created before batches were indexed have no batch_offset column
+            columns = [column[1] for column in self.db.execute("PRAGMA table_info(contents)")]
+            if 'batch_offset' not in columns:
+                self.db.execute("ALTER TABLE contents ADD COLUMN batch_offset INTEGER")
+            if retention_days:
+                self.db.execute("DELETE FROM contents WHERE updated < ?",
+                                (time.time() - retention_days * 86400,))
+
+    def get(self, content_md5, size):
+        # (s3_key, batch_offset) of the content with this hex MD5 and size, or None. batch_offset is None
+        # for a file uploaded as an object of its own.
+        with self.lock:
+            return self.db.execute("SELECT s3_key, batch_offset FROM contents WHERE md5 = ? AND size = ?",
+                                   (bytes.fromhex(content_md5), size)).fetchone()
+
+    def add(self, content_md5, size, s3_key, batch_offset=None):
+        # the latest upload of a content is the one pointers go to
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO contents (md5, size, s3_key, batch_offset, updated) "
+                            "VALUES (?, ?, ?, ?, ?)",
+                            (bytes.fromhex(content_md5), size, s3_key, batch_offset, time.time()))
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def open_content_index(feed_type, config, home):
+    # opt-in per feed with 'content_index_file' in ftp_client, relative paths are under the home directory
+    # like download_dir
+    ftp_client = config[feed_type]['ftp_client']
+    if not ftp_client.get('content_index_file'):
+        return None
+
+    path = os.path.join(home, ftp_client['content_index_file'])
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    return ContentIndex(path, ftp_client.get('content_index_retention_days', 30),
+                        ftp_client.get('duplicates', 'pointer'))
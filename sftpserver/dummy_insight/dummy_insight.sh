@@ -4,7 +4,11 @@ now=$(date +"%T")
 echo ">>>>> Current time : $now"
 
 source "/home/ubuntu/VENV/fdxedi/bin/activate"
-python3 /home/ubuntu/dummy/dummydownloader.py
+# the arguments of dummy_insight_daemon.sh, every feed of the production system by default
+if [ $# -eq 0 ]; then
+    set -- -s production --all-feeds
+fi
+python3 /home/ubuntu/dummy_insight/dummydownloader.py "$@"
 
 now=$(date +"%T")
 echo "<<<<< Finished at : $now"
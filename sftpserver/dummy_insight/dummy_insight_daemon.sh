@@ -0,0 +1,17 @@
+#!/bin/bash
+
+# Long-running alternative to dummy_insight.sh: the downloader keeps its connections open and polls
+# by itself (see --interval/--jitter), so there is no "sleep 5m" and no restart between passes.
+# exec hands the process over to python, so the SIGTERM sent by "supervisorctl stop" reaches it directly.
+# Usage in the supervisor program: command=/home/ubuntu/dummy_insight/dummy_insight_daemon.sh -s production --all-feeds
+
+now=$(date +"%T")
+echo ">>>>> Current time : $now"
+
+# every feed of the production system by default, like dummy_insight.sh
+if [ $# -eq 0 ]; then
+    set -- -s production --all-feeds
+fi
+
+source "/home/ubuntu/VENV/fdxedi/bin/activate"
+exec python3 /home/ubuntu/dummy_insight/dummydownloader.py --daemon "$@"
@@ -2,25 +2,83 @@ import logging
 import os
 import sys
 import argparse
+import base64
+import collections
+import concurrent.futures
+import hashlib
+import json
+import queue
+import random
+import signal
+import threading
 
-import pika
 import time
-import boto3
 from datetime import datetime
 
 import shutil
 import pathlib
+import posixpath
 import stat
-import pysftp
 
+import content_index
+import error_reporter
+import file_batches
+import pipeline_metrics
+import pipeline_trace
+import rate_limits
+import remote_listing
+import transfer_manifest
+import transfer_schedule
+
+# pika, boto3 and pysftp (which brings in paramiko and cryptography) are imported by the first function that needs
+# them, not here: a run that only parses its arguments, or a feed cycle that has nothing to download, does not pay
+# for loading them. benchmarks/bench_startup.py keeps this in check. So is async_engine, only --engine async
+# needs it.
 
 
 LOG_TIME_FORMAT = '%d/%b/%Y %H:%M:%S'
 
-mq_connection = None
+# the RabbitMQ connection that error messages of the feed running on the current thread go to
+feed_context = threading.local()
+mq_error_channels = {}
+
+# files at least this big are read with paramiko's prefetch (pipelined reads), can be set per feed
+PREFETCH_THRESHOLD = 256 * 1024
+DOWNLOAD_BUFFER_SIZE = 256 * 1024
+# downloads in progress are written to <name>.part, which the start-up scan of download_dir ignores
+PARTIAL_SUFFIX = '.part'
+# seconds a download session waits for room under its server's adaptive limit before closing its connection
+SESSION_IDLE = 1.0
+
+# files at least MULTIPART_THRESHOLD big are uploaded in checkpointed, resumable multipart uploads
+MULTIPART_THRESHOLD = 64 * 1024 * 1024
+MULTIPART_PART_SIZE = 16 * 1024 * 1024
+MULTIPART_CONCURRENCY = 4
+
+# file messages are committed to RabbitMQ in batches of this many messages, or this many milliseconds
+MQ_PUBLISH_BATCH_SIZE = 50
+MQ_PUBLISH_BATCH_MS = 200
+
+# daemon mode polls every DAEMON_POLL_INTERVAL +/- DAEMON_POLL_JITTER seconds until SIGTERM
+DAEMON_POLL_INTERVAL = 300
+DAEMON_POLL_JITTER = 30
+# idle connections get their RabbitMQ heartbeats serviced this often while waiting for the next poll
+KEEP_ALIVE_INTERVAL = 10
+shutdown_event = threading.Event()
+
+# marks a PublishQueue entry whose upload was recorded in the transfer manifest by an earlier run
+ALREADY_UPLOADED = object()
+# marks a PublishQueue entry whose content is already in S3 under another key, according to the content index
+DUPLICATE = object()
 
 # set up logging to file
 logfileName = os.path.join(os.path.dirname(__file__), os.path.basename(__file__)[:-3] + '.log')
+# default file of the --profile trace, next to the log
+TRACE_FILE = os.path.join(os.path.dirname(__file__), os.path.basename(__file__)[:-3] + '.trace.json')
+# error messages that could not be sent to RabbitMQ, replayed once the broker is back
+ERROR_SPILL_FILE = os.path.join(os.path.dirname(__file__), os.path.basename(__file__)[:-3] + '.errors.jsonl')
+# default -c configuration, dummydownloader_config.example.json shows its layout
+CONFIG_FILE = os.path.join(os.path.dirname(__file__), os.path.basename(__file__)[:-3] + '_config.json')
 
 # create module logger
 top_logger_name = os.path.basename(__file__)[:-3]
@@ -30,7 +88,7 @@ logger.setLevel(logging.DEBUG)
 # file handler
 file_handler = logging.FileHandler(logfileName, 'w')
 file_handler.setLevel(logging.DEBUG)
-formatter = logging.Formatter('[%(asctime)s][%(levelname)s][%(module)s][%(funcName)s][%(lineno)d] %(message)s',
+formatter = logging.Formatter('[%(asctime)s][%(levelname)s][%(threadName)s][%(module)s][%(funcName)s][%(lineno)d] %(message)s',
                               LOG_TIME_FORMAT)
 file_handler.setFormatter(formatter)
 logger.addHandler(file_handler)
@@ -41,7 +99,7 @@ console.setLevel(logging.INFO)
 
 # # set a format which is simpler for console use
 # formatter = logging.Formatter('%(name)-12s: %(levelname)-8s %(message)s')
-formatter = logging.Formatter('[%(asctime)s][%(levelname)s] %(message)s', LOG_TIME_FORMAT)
+formatter = logging.Formatter('[%(asctime)s][%(levelname)s][%(threadName)s] %(message)s', LOG_TIME_FORMAT)
 
 # tell the handler to use this format
 console.setFormatter(formatter)
@@ -51,46 +109,74 @@ console.setFormatter(formatter)
 logger.addHandler(console)
 
 
+def get_current_mq_connection():
+    return getattr(feed_context, 'mq_connection', None)
+
+
 def get_log_time(level):
     # LOG_TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
 
     return "[{0}][{1}] ".format(datetime.now().strftime(LOG_TIME_FORMAT), level)
 
 
+def get_error_channel(mq_connection):
+    # error messages share one channel per connection instead of opening a new one for every message
+    cached = mq_error_channels.get(id(mq_connection))
+    if cached is None or cached[0] is not mq_connection or not cached[1].is_open:
+        cached = (mq_connection, mq_connection.channel())
+        mq_error_channels[id(mq_connection)] = cached
+
+    return cached[1]
+
+
+def send_error_message(mq_connection, exchange, routing_key, error_message):
+    # raises on failure
+    import pika
+
+    mq_channel = get_error_channel(mq_connection)
+
+    properties = pika.BasicProperties(content_type='text/plain',
+                                      delivery_mode=2)
+
+    mq_channel.basic_publish(exchange=exchange, routing_key=routing_key,
+                             body=error_message, properties=properties)
+
+
 def publish_error_to_rabbitmq(mq_connection, exchange, routing_key, error_message):
+    # on a feed's thread the message is queued for the background error reporter, which has its own connection
+    # to the feed's broker, so a failing broker never stalls the transfer. Outside of a feed cycle it is
+    # published right away on mq_connection.
+    feed_type = getattr(feed_context, 'feed_type', None)
+    if feed_type is not None:
+        error_reports.report(feed_type, exchange, routing_key, error_message)
+        return True
+
     result = False
 
     try:
-        mq_channel = mq_connection.channel()
-
-        properties = pika.BasicProperties(content_type='text/plain',
-                                          delivery_mode=2)
-
-        try:
-            mq_channel.basic_publish(exchange=exchange, routing_key=routing_key,
-                                     body=error_message, properties=properties)
-            result = True
-        except Exception as err:
-            result = False
-            message = "error message '" + error_message + "' failed to be published to exchange " + exchange + ". " + str(
-                err)
-            logger.error(message)
-    except Exception as e:
-        message = "RabbitMQ error before publishing the error message. " + error_message
+        send_error_message(mq_connection, exchange, routing_key, error_message)
+        result = True
+    except Exception as err:
+        result = False
+        message = "error message '" + error_message + "' failed to be published to exchange " + exchange + ". " + str(
+            err)
         logger.error(message)
 
     return result
 
 
 def get_mq_connection(feed_type, config):
+    import pika
+
     mq_connection = None
 
     mq = config[feed_type]['rabbitmq']
     try:
         mq_credentials = pika.PlainCredentials(mq['user_name'], mq['password'])
-        mq_connection = pika.BlockingConnection(pika.ConnectionParameters(
-            host=mq['host'], port=mq['port'], virtual_host=mq['virtual_host'],
-            credentials=mq_credentials))
+        with pipeline_trace.span('rabbitmq_connect', 'connect', feed=feed_type):
+            mq_connection = pika.BlockingConnection(pika.ConnectionParameters(
+                host=mq['host'], port=mq['port'], virtual_host=mq['virtual_host'],
+                credentials=mq_credentials))
     except Exception as e:
         message = "RabbitMQ connection creation error." + str(e)
         logger.error(message)
@@ -98,19 +184,55 @@ def get_mq_connection(feed_type, config):
     return mq_connection
 
 
+def get_mq_broker_key(feed_type, config):
+    mq = config[feed_type]['rabbitmq']
+    return mq['host'], mq['port'], mq['virtual_host'], mq['user_name']
+
+
+class MQErrorReporter(error_reporter.ErrorReporter):
+    """
+    ErrorReporter on connections of its own to the brokers in the feeds' rabbitmq config.
+    """
+
+    def connect(self, feed_type, config):
+        return get_mq_connection(feed_type, config)
+
+    def broker_key(self, feed_type, config):
+        return get_mq_broker_key(feed_type, config)
+
+    def send(self, connection, exchange, routing_key, message):
+        send_error_message(connection, exchange, routing_key, message)
+
+
+# the error messages of every feed of this process
+error_reports = MQErrorReporter(ERROR_SPILL_FILE)
+
+# the limits of the servers and buckets go out with the metrics of the feeds
+pipeline_metrics.registry.limits = rate_limits.registry
+
+
+def get_s3_config(feed_type, config):
+    # a feed can have its own S3 credentials, otherwise the system-wide ones are used
+    return config[feed_type].get('s3', config['s3'])
+
+
 def get_s3_client(feed_type, config):
+    import boto3
+
     try:
-        s3client = boto3.client('s3',
-                                aws_access_key_id=config['s3']['aws_access_key_id'],
-                                aws_secret_access_key=config['s3']['aws_secret_access_key']
-                                )
+        s3 = get_s3_config(feed_type, config)
+        with pipeline_trace.span('s3_client', 'connect', feed=feed_type):
+            s3client = boto3.client('s3',
+                                    aws_access_key_id=s3['aws_access_key_id'],
+                                    aws_secret_access_key=s3['aws_secret_access_key']
+                                    )
     except Exception as e:
 
         s3client = None
         message = "S3 client creation error. " + str(e)
         logger.error(message)
         mq = config[feed_type]['rabbitmq']
-        publish_error_to_rabbitmq(mq_connection, mq['exception_exchange'], mq['exception_key'],
+        publish_error_to_rabbitmq(get_current_mq_connection(), mq['exception_exchange'], mq['exception_key'],
                                   get_log_time("ERROR") + message)
     return s3client
 
@@ -139,35 +261,123 @@ def get_s3_client(feed_type, config):
 #     return sftp
 
 
-def publish_to_rabbitmq(mq_connection, exchange, exchange_type, routing_key, source_dir, file_name, feed_type,
-                        s3_bucket, date_prefix, config):
+class MQPublisher(object):
+    """
+    Long-lived publisher of the file messages of one feed. The channel is opened and each exchange declared only
+    once. The channel is transactional: published messages are committed to the broker in batches, one round
+    trip for up to 'batch_size' messages, or for whatever was published in the last 'batch_ms' milliseconds.
+    flush() returns the items of the messages the broker has taken over.
+    """
+
+    def __init__(self, mq_connection, batch_size=1, batch_ms=0):
+        self.mq_connection = mq_connection
+        self.batch_size = batch_size
+        self.batch_ms = batch_ms
+        self.channel = None
+        self.declared = set()
+        self.pending = []
+        self.batch_started = 0.0
+
+    def get_channel(self):
+        if self.channel is None or not self.channel.is_open:
+            # an uncommitted batch is rolled back by the broker when its channel closes
+            self.pending = []
+            self.declared = set()
+            with pipeline_trace.span('mq_channel', 'rabbitmq'):
+                self.channel = self.mq_connection.channel()
+                self.channel.tx_select()
+
+        return self.channel
+
+    def publish(self, exchange, exchange_type, routing_key, body, properties, item):
+        channel = self.get_channel()
+
+        if exchange not in self.declared:
+            with pipeline_trace.span('exchange_declare', 'rabbitmq', exchange=exchange):
+                channel.exchange_declare(exchange=exchange,
+                                         exchange_type=exchange_type,
+                                         durable=True)
+            self.declared.add(exchange)
+
+        channel.basic_publish(exchange=exchange, routing_key=routing_key,
+                              body=body, properties=properties)
+        if not self.pending:
+            self.batch_started = time.monotonic()
+        self.pending.append(item)
+
+    def batch_due(self):
+        if not self.pending:
+            return False
+
+        return len(self.pending) >= self.batch_size or \
+            (time.monotonic() - self.batch_started) * 1000 >= self.batch_ms
+
+    def flush(self):
+        items = self.pending
+        self.pending = []
+        if items:
+            self.channel.tx_commit()
+
+        return items
+
+    def close(self):
+        if self.channel is not None and self.channel.is_open:
+            try:
+                self.channel.close()
+            except Exception:
+                pass
+        self.channel = None
+        self.pending = []
+
+
+def get_mq_publisher(mq_connection, feed_type, config):
+    mq = config[feed_type]['rabbitmq']
+
+    return MQPublisher(mq_connection, int(mq.get('publish_batch_size', MQ_PUBLISH_BATCH_SIZE)),
+                       float(mq.get('publish_batch_ms', MQ_PUBLISH_BATCH_MS)))
+
+
+def publish_to_rabbitmq(mq_publisher, exchange, exchange_type, routing_key, source_dir, file_name, feed_type,
+                        s3_bucket, date_prefix, config, file_size=None, content_md5=None, s3_key=None, batch=None,
+                        s3_offset=None):
+    # the message is only part of the publisher's open batch, it is confirmed by mq_publisher.flush().
+    # file_size is given for streamed files and batches, which have no local copy to take it from. s3_key is
+    # given for a duplicate, whose message points to the object of the earlier copy instead of one of its own,
+    # with s3_offset when that copy is a member of a batch's archive.
+    # The message of a FileBatch lists its files with their offsets in the archive.
+    import pika
+
     result = False
+    mq_connection = mq_publisher.mq_connection
 
     try:
-        mq_channel = mq_connection.channel()
-
-        local_filename = os.path.join(os.path.normpath(source_dir), file_name)
+        if file_size is None:
+            file_size = os.path.getsize(os.path.join(os.path.normpath(source_dir), file_name))
 
         headers = {
             "data.type": "*stream",
             # "data.source": file_name,
-            "data.size": os.path.getsize(local_filename),
+            "data.size": file_size,
             "data.s3bucket": s3_bucket,
             "data.s3keyprefix": date_prefix
         }
+        if content_md5:
+            headers["data.md5"] = content_md5
+        if s3_key:
+            headers["data.s3key"] = s3_key
+        if s3_offset is not None:
+            headers["data.s3offset"] = s3_offset
+        if batch:
+            headers["data.batch.format"] = batch.format
+            headers["data.batch.members"] = batch.index
 
         properties = pika.BasicProperties(content_type='text/plain',
                                           headers=headers,
                                           delivery_mode=2)
 
         try:
-            mq_channel.exchange_declare(exchange=exchange,
-                                        exchange_type=exchange_type,
-                                        durable=True)
-
-            mq_channel.basic_publish(exchange=exchange, routing_key=routing_key,
-                                     # body=body, properties=properties)
-                                     body=file_name, properties=properties)
+            with pipeline_trace.span('mq_publish', 'rabbitmq', file=file_name):
+                mq_publisher.publish(exchange, exchange_type, routing_key, file_name, properties, file_name)
             result = True
             message = "File name " + file_name + " in " + source_dir + " is pushed to exchange " + exchange + "."
             logger.info(message)
@@ -189,29 +399,212 @@ def publish_to_rabbitmq(mq_connection, exchange, exchange_type, routing_key, sou
     return result
 
 
+def get_s3_date_prefix_from_mtime(mtime):
+    return time.strftime("%Y/%m/%d/", time.localtime(mtime))
+
+
 def get_s3_date_prefix(dir, file_name):
     local_file_name = os.path.join(os.path.normpath(dir), file_name)
     file_stats = os.stat(local_file_name)
-    date_prefix = time.strftime("%Y/%m/%d/", time.localtime(file_stats[stat.ST_MTIME]))
+    date_prefix = get_s3_date_prefix_from_mtime(file_stats[stat.ST_MTIME])
 
     return date_prefix
 
 
-def upload_to_s3(s3client, s3_bucket, source_dir, file_name, date_prefix, feed_type, config):
-    result = True
+def new_content_hash():
+    # MD5, because it is what S3 checks a Content-MD5 against: the one hash taken while downloading serves the
+    # integrity check of the upload, the content index and the message header
+    return hashlib.md5()
+
+
+def get_content_md5(content_hash):
+    # Content-MD5 header value, the base64 of the raw digest
+    return base64.b64encode(content_hash.digest()).decode('ascii')
+
+
+def update_content_hash(content_hash, local_filename):
+    with open(local_filename, 'rb') as f:
+        for block in iter(lambda: f.read(DOWNLOAD_BUFFER_SIZE), b''):
+            content_hash.update(block)
+    return content_hash
 
+
+def get_multipart_config(feed_type, config):
+    ftp_client = config[feed_type]['ftp_client']
+    download_dir = get_download_dir(feed_type, config)
+
+    return {
+        'threshold': int(ftp_client.get('multipart_threshold', MULTIPART_THRESHOLD)),
+        'part_size': int(ftp_client.get('multipart_part_size', MULTIPART_PART_SIZE)),
+        'concurrency': int(ftp_client.get('multipart_concurrency', MULTIPART_CONCURRENCY)),
+        'checkpoint_dir': os.path.join(str(pathlib.Path.home()),
+                                       ftp_client.get('checkpoint_dir', download_dir + '.checkpoints'))
+    }
+
+
+def load_checkpoint(checkpoint_file):
     try:
-        s3client.upload_file(os.path.join(os.path.normpath(source_dir), file_name), s3_bucket, date_prefix + file_name)
+        with open(checkpoint_file) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def save_checkpoint(checkpoint_file, checkpoint):
+    # write and rename, so an interruption never leaves a half written checkpoint behind
+    with open(checkpoint_file + '.tmp', 'w') as f:
+        json.dump(checkpoint, f)
+    os.replace(checkpoint_file + '.tmp', checkpoint_file)
+
+
+def upload_file_multipart(s3client, s3_bucket, local_filename, key, multipart, content_md5=None, limit=None):
+    # multipart upload whose upload ID and completed part ETags are checkpointed after every part, so an
+    # interrupted upload of the same file continues with the parts still missing. Every part is sent with its
+    # Content-MD5, the MD5 of the whole file goes into the object's metadata. With a RateLimit, every part
+    # waits for its bytes.
+    file_stats = os.stat(local_filename)
+    file_size = file_stats.st_size
+    file_mtime = int(file_stats.st_mtime)
+    part_size = multipart['part_size']
+    pathlib.Path(multipart['checkpoint_dir']).mkdir(parents=True, exist_ok=True)
+    checkpoint_file = os.path.join(multipart['checkpoint_dir'], os.path.basename(local_filename) + '.json')
+
+    checkpoint = load_checkpoint(checkpoint_file)
+    if checkpoint and (checkpoint['bucket'], checkpoint['key'], checkpoint['size'], checkpoint['mtime'],
+                       checkpoint['part_size']) != (s3_bucket, key, file_size, file_mtime, part_size):
+        checkpoint = None
+    if checkpoint is None:
+        metadata = {'content-md5': content_md5} if content_md5 else {}
+        upload_id = s3client.create_multipart_upload(Bucket=s3_bucket, Key=key, Metadata=metadata)['UploadId']
+        checkpoint = {'bucket': s3_bucket, 'key': key, 'size': file_size, 'mtime': file_mtime,
+                      'part_size': part_size, 'upload_id': upload_id, 'parts': {}}
+        save_checkpoint(checkpoint_file, checkpoint)
+    else:
+        message = "Resuming the upload of " + local_filename + " with " + str(len(checkpoint['parts'])) + \
+                  " parts already in S3."
+        logger.info(message)
+
+    part_count = max(1, (file_size + part_size - 1) // part_size)
+    lock = threading.Lock()
+
+    def upload_part(part_number):
+        with open(local_filename, 'rb') as f:
+            f.seek((part_number - 1) * part_size)
+            body = f.read(part_size)
+        if limit is not None:
+            limit.take(len(body))
+        etag = s3client.upload_part(Bucket=s3_bucket, Key=key, PartNumber=part_number,
+                                    UploadId=checkpoint['upload_id'], Body=body,
+                                    ContentMD5=get_content_md5(hashlib.md5(body)))['ETag']
+        with lock:
+            checkpoint['parts'][str(part_number)] = etag
+            save_checkpoint(checkpoint_file, checkpoint)
+
+    missing = [part_number for part_number in range(1, part_count + 1) if str(part_number) not in checkpoint['parts']]
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=multipart['concurrency']) as executor:
+            for future in [executor.submit(upload_part, part_number) for part_number in missing]:
+                future.result()
+    except Exception as e:
+        if 'NoSuchUpload' in str(e):
+            # the upload has expired or been aborted on the S3 side, start over next time
+            os.remove(checkpoint_file)
+        raise
+
+    parts = [{'ETag': checkpoint['parts'][str(part_number)], 'PartNumber': part_number}
+             for part_number in range(1, part_count + 1)]
+    response = s3client.complete_multipart_upload(Bucket=s3_bucket, Key=key, UploadId=checkpoint['upload_id'],
+                                                  MultipartUpload={'Parts': parts})
+    os.remove(checkpoint_file)
+
+    return response['ETag']
+
+
+def upload_file_to_s3(s3client, s3_bucket, source_dir, file_name, date_prefix, get_etag=False, multipart=None,
+                      content_md5=None, limit=None):
+    # raises on failure, safe to run on an upload worker thread (boto3 clients are thread-safe).
+    # content_md5 is the hex MD5 taken while the file was downloaded, S3 rejects the upload if the bytes it
+    # receives do not match it. limit is the bucket's RateLimit, below the multipart threshold the whole file
+    # waits for its bytes before it is sent.
+    local_filename = os.path.join(os.path.normpath(source_dir), file_name)
+    file_size = os.path.getsize(local_filename)
+
+    if multipart and file_size >= multipart['threshold']:
+        etag = upload_file_multipart(s3client, s3_bucket, local_filename, date_prefix + file_name, multipart,
+                                     content_md5, limit)
         message = "File " + file_name + " in " + source_dir + " is uploaded to S3 bucket " + s3_bucket + "/" + date_prefix
         logger.info(message)
+        return etag
+
+    if limit is not None:
+        limit.take(file_size)
+    if content_md5:
+        # upload_file's managed transfer does not take a Content-MD5, below the multipart threshold a single
+        # put_object does the same
+        with open(local_filename, 'rb') as f:
+            etag = s3client.put_object(Bucket=s3_bucket, Key=date_prefix + file_name, Body=f,
+                                       ContentMD5=base64.b64encode(bytes.fromhex(content_md5)).decode('ascii'),
+                                       Metadata={'content-md5': content_md5})['ETag']
+        message = "File " + file_name + " in " + source_dir + " is uploaded to S3 bucket " + s3_bucket + "/" + date_prefix
+        logger.info(message)
+        return etag
+
+    s3client.upload_file(local_filename, s3_bucket, date_prefix + file_name)
+    message = "File " + file_name + " in " + source_dir + " is uploaded to S3 bucket " + s3_bucket + "/" + date_prefix
+    logger.info(message)
+
+    if get_etag:
+        # upload_file does not return the ETag, it is only needed for the transfer manifest
+        return s3client.head_object(Bucket=s3_bucket, Key=date_prefix + file_name)['ETag']
+    return None
+
+
+def upload_batch_file_to_s3(s3client, s3_bucket, batch, limit=None):
+    # raises on failure like upload_file_to_s3, the packed archive is uploaded from memory
+    if limit is not None:
+        limit.take(len(batch.body))
+    etag = s3client.put_object(Bucket=s3_bucket, Key=batch.date_prefix + batch.name, Body=batch.body,
+                               ContentMD5=base64.b64encode(bytes.fromhex(batch.content_md5)).decode('ascii'),
+                               Metadata={'content-md5': batch.content_md5})['ETag']
+    message = "Batch " + batch.name + " of " + str(len(batch)) + " files is uploaded to S3 bucket " + s3_bucket + \
+              "/" + batch.date_prefix
+    logger.info(message)
+    return etag
+
+
+def report_upload_error(s3_bucket, source_dir, file_name, error, feed_type, config):
+    message = "File " + file_name + " in " + source_dir + " failed to be uploaded to S3 bucket " + s3_bucket + ". " + str(
+        error)
+    logger.error(message)
+    mq = config[feed_type]['rabbitmq']
+    publish_error_to_rabbitmq(get_current_mq_connection(), mq['exception_exchange'], mq['exception_key'],
+                              get_log_time("ERROR") + message)
+
+
+def upload_to_s3(s3client, s3_bucket, source_dir, file_name, date_prefix, feed_type, config, manifest=None,
+                 content_md5=None, limit=None, manifest_key=None):
+    # manifest_key is the key of the file's manifest entry, as returned by mark_downloaded
+    result = True
+
+    try:
+        etag = upload_file_to_s3(s3client, s3_bucket, source_dir, file_name, date_prefix, manifest is not None,
+                                 get_multipart_config(feed_type, config), content_md5, limit)
+        if manifest and manifest_key:
+            manifest.mark_uploaded(manifest_key, date_prefix + file_name, etag)
     except Exception as e:
         result = False
-        message = "File " + file_name + " in " + source_dir + " failed to be uploaded to S3 bucket " + s3_bucket + ". " + str(
-            e)
-        logger.error(message)
-        mq = config[feed_type]['rabbitmq']
-        publish_error_to_rabbitmq(mq_connection, mq['exception_exchange'], mq['exception_key'],
-                                  get_log_time("ERROR") + message)
+        report_upload_error(s3_bucket, source_dir, file_name, e, feed_type, config)
+    return result
+
+
+def upload_batch_to_s3(s3client, s3_bucket, batch, feed_type, config, limit=None):
+    result = True
+
+    try:
+        upload_batch_file_to_s3(s3client, s3_bucket, batch, limit)
+    except Exception as e:
+        result = False
+        report_upload_error(s3_bucket, "batch", batch.name, e, feed_type, config)
     return result
 
 
@@ -228,7 +621,7 @@ def copy_file(source_dir, dest_dir, file, feed_type, config):
         message = "File " + file + " in " + source_dir + " failed to be copied to " + dest_dir + ". " + str(e)
         logger.error(message)
         mq = config[feed_type]['rabbitmq']
-        publish_error_to_rabbitmq(mq_connection, mq['exception_exchange'], mq['exception_key'],
+        publish_error_to_rabbitmq(get_current_mq_connection(), mq['exception_exchange'], mq['exception_key'],
                                   get_log_time("ERROR") + message)
 
     return result
@@ -247,63 +640,1059 @@ def delete_file(dir, file, feed_type, config):
         message = "File " + file + " in " + dir + " failed to be deleted. " + str(e)
         logger.error(message)
         mq = config[feed_type]['rabbitmq']
+        publish_error_to_rabbitmq(get_current_mq_connection(), mq['exception_exchange'], mq['exception_key'],
+                                  get_log_time("ERROR") + message)
+
+    return result
+
+
+def get_download_dir(feed_type, config):
+    # download_and_publish creates the download directory under the home directory, every stage has to
+    # resolve it the same way
+    return os.path.normpath(os.path.join(str(pathlib.Path.home()), config[feed_type]['ftp_client']['download_dir']))
+
+
+def delete_published_file(mq_connection, download_dir, file, feed_type, config):
+    # delete the file after publishing successfully
+    result = delete_file(download_dir, file, feed_type, config)
+
+    if not result:
+        # failed to delete the file in download_dir
+        message = "File " + file + " in " + download_dir + " needs to be removed manually. "
+        logger.error(message)
+        mq = config[feed_type]['rabbitmq']
         publish_error_to_rabbitmq(mq_connection, mq['exception_exchange'], mq['exception_key'],
                                   get_log_time("ERROR") + message)
 
     return result
 
 
-def publish_files(mq_connection, s3client, feed_type, config):
-    result = True
+class PublishQueue(object):
+    """
+    In-memory work queue of the files in download_dir that still need to be uploaded to S3 and published.
+    Files are published in the order they are put on the queue. A file that fails stays at the head of the
+    queue (and in download_dir), so it is picked up again by the start-up scan of the next run.
+
+    With 'upload_workers' > 1 in the feed's ftp_client config, S3 uploads run on a bounded pool of worker
+    threads sharing the one S3 client, while publishing to RabbitMQ and deleting stay on the calling thread,
+    in queue order.
+
+    Messages are committed in batches by the feed's MQPublisher ('publish_batch_size' / 'publish_batch_ms' in
+    the rabbitmq config), a file is deleted only once the batch holding its message is committed.
+
+    With a TransferManifest, the upload (with its ETag) and the publish of every file are recorded in it, under
+    the key of the file's entry that is put on the queue with it.
+
+    With a large-file lane in the feed's TransferSchedule, files of at least 'large_file_threshold' bytes are
+    uploaded by an S3 worker of their own and kept on a queue of their own, published in order among themselves
+    once uploaded, so the small files behind them do not wait for their uploads.
+
+    Every file is uploaded with the Content-MD5 of its content and published with it in 'data.md5'. With a
+    ContentIndex, a file whose content is already in S3 (or queued ahead of it) is not uploaded again: it is
+    published with 'data.s3key' pointing to the earlier copy, or only deleted, as the index's 'duplicates' says.
+
+    With a FileBatcher ('batch_format' in the ftp_client config), files below 'batch_threshold' bytes are held
+    in a batch per S3 date prefix instead. A batch goes on the queue as one archive, uploaded in one request and
+    published in one message listing its files, once it is full or old enough, and at the end of every cycle.
+    Its files are deleted once that message is committed. Feeds with 'strict_order' are not batched. Once a batch
+    is uploaded its files go into the ContentIndex under the batch's S3 key, and a later duplicate of one of them
+    is published with 'data.s3offset' as well, the offset of its bytes in the archive. A batch is only named
+    when it is packed, so a duplicate of a file still waiting in a batch is batched again rather than pointed to.
+
+    Every upload goes through the RateLimit of the S3 bucket, shared with the other feeds uploading to it
+    ('bucket_limits' in the s3 config): it waits for its bytes, and for a free slot when the limit is adaptive.
+    """
+
+    def __init__(self, mq_connection, s3client, feed_type, config, manifest=None, index=None):
+        self.mq_connection = mq_connection
+        self.manifest = manifest
+        self.index = index
+        self.s3client = s3client
+        self.feed_type = feed_type
+        self.config = config
+        self.download_dir = get_download_dir(feed_type, config)
+        self.s3_bucket = config[feed_type]['ftp_client']['s3_bucket']
+        self.exchange = config[feed_type]['rabbitmq']['exchange']
+        self.exchange_type = config[feed_type]['rabbitmq']['exchange_type']
+        self.routing_key = config[feed_type]['rabbitmq']['routing_key']
+        self.upload_workers = int(config[feed_type]['ftp_client'].get('upload_workers', 1))
+        # uploads allowed to be in flight before put() has to wait for the head of the queue
+        self.max_pending = self.upload_workers * 4
+        self.executor = None
+        if self.upload_workers > 1:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.upload_workers,
+                                                                  thread_name_prefix=feed_type + "-s3")
+        # (file, date_prefix, upload future or None)
+        self.files = collections.deque()
+        self.schedule = transfer_schedule.get_transfer_schedule(feed_type, config)
+        self.large_files = collections.deque()
+        self.large_executor = None
+        if self.schedule.has_large_lane:
+            self.large_executor = concurrent.futures.ThreadPoolExecutor(max_workers=1,
+                                                                        thread_name_prefix=feed_type + "-s3-large")
+        self.mq_publisher = get_mq_publisher(mq_connection, feed_type, config)
+        self.multipart = get_multipart_config(feed_type, config)
+        # size of the files streamed to S3 without a local copy
+        self.streamed = {}
+        # size of every file on the queue, for the metrics
+        self.sizes = {}
+        # hex MD5 of every file on the queue
+        self.hashes = {}
+        # (MD5, size): S3 key of the files on the queue that are not in the content index yet
+        self.queued = {}
+        # (S3 key, offset in a batch or None) of the earlier copy of every duplicate on the queue
+        self.duplicates = {}
+        # manifest key of every file on the queue that has a manifest entry
+        self.keys = {}
+        self.batcher = file_batches.get_file_batcher(feed_type, config)
+        if self.schedule.strict_order:
+            # a batch is published once it is full, not in the order of its files
+            self.batcher = None
+        # name: packed FileBatch, of the batches on the queue
+        self.batches = {}
+        self.s3_limit = rate_limits.get_bucket_limit(self.s3_bucket, get_s3_config(feed_type, config),
+                                                     self.upload_workers)
+        self.metrics = pipeline_metrics.registry.feed(feed_type)
+        self.metrics.publish_queue = self
+        self.metrics.download_dir = self.download_dir
+
+    def __len__(self):
+        waiting = len(self.files) + len(self.large_files)
+        if self.batcher:
+            waiting += sum(len(batch) for batch in self.batcher.batches.values())
+        return waiting
+
+    def put(self, file, uploaded_key=None, streamed_size=None, content_md5=None, manifest_key=None):
+        # a file already uploaded by an earlier run only needs to be published, under its recorded S3 key.
+        # So does a file streamed straight to S3, which also has no local copy to delete.
+        # content_md5 is the MD5 taken while downloading, the files found in download_dir at start-up are
+        # hashed here. manifest_key is the key of the file's manifest entry.
+        local_filename = os.path.join(self.download_dir, file)
+        if manifest_key:
+            self.keys[file] = manifest_key
+        if uploaded_key:
+            if streamed_size is not None:
+                self.streamed[file] = streamed_size
+                self.sizes[file] = streamed_size
+            else:
+                self.sizes[file] = os.path.getsize(local_filename)
+                if content_md5 is None:
+                    content_md5 = update_content_hash(new_content_hash(), local_filename).hexdigest()
+            self.hashes[file] = content_md5
+            self.files.append((file, uploaded_key[:-len(file)], ALREADY_UPLOADED))
+            return
+
+        file_stats = os.stat(local_filename)
+        self.sizes[file] = file_stats.st_size
+        if content_md5 is None:
+            content_md5 = update_content_hash(new_content_hash(), local_filename).hexdigest()
+        self.hashes[file] = content_md5
+        date_prefix = get_s3_date_prefix_from_mtime(file_stats.st_mtime)
+
+        content = (content_md5, file_stats.st_size)
+        if self.index and self.index.duplicates != 'publish':
+            location = (self.queued[content], None) if content in self.queued else self.index.get(*content)
+            if location:
+                # same content, same size, same lane: the earlier copy is published (or has failed) first
+                self.duplicates[file] = location
+                s3_key = location[0]
+                files = self.large_files if self.schedule.is_large(file_stats.st_size) else self.files
+                files.append((file, s3_key[:s3_key.rfind('/') + 1], DUPLICATE))
+                return
+
+        if self.batcher and self.batcher.accepts(file_stats.st_size):
+            batch = self.batcher.add(file_batches.BatchMember(file, file_stats.st_size, file_stats.st_mtime,
+                                                              content_md5), date_prefix)
+            if batch:
+                self.put_batch(batch)
+            return
+
+        if self.index and self.index.duplicates != 'publish':
+            self.queued[content] = date_prefix + file
+
+        if self.schedule.is_large(file_stats.st_size):
+            self.large_files.append((file, date_prefix, self.large_executor.submit(self.upload_file, file,
+                                                                                   date_prefix)))
+            return
+        upload = None
+        if self.executor:
+            upload = self.executor.submit(self.upload_file, file, date_prefix)
+        self.files.append((file, date_prefix, upload))
+
+    def put_batch(self, batch):
+        # the batch is published like a streamed file: no local copy of its own, its size and MD5 are known
+        batch.pack(self.download_dir)
+        self.batches[batch.name] = batch
+        self.sizes[batch.name] = len(batch.body)
+        self.streamed[batch.name] = len(batch.body)
+        self.hashes[batch.name] = batch.content_md5
+        upload = None
+        if self.executor:
+            upload = self.executor.submit(self.upload_file, batch.name, batch.date_prefix)
+        self.files.append((batch.name, batch.date_prefix, upload))
+
+    def upload_file(self, file, date_prefix):
+        # runs on an upload worker thread
+        started = self.s3_limit.acquire()
+        error = True
+        try:
+            start = time.perf_counter()
+            with pipeline_trace.span('s3_upload', 's3', file=file):
+                if file in self.batches:
+                    etag = upload_batch_file_to_s3(self.s3client, self.s3_bucket, self.batches[file], self.s3_limit)
+                else:
+                    etag = upload_file_to_s3(self.s3client, self.s3_bucket, self.download_dir, file, date_prefix,
+                                             self.manifest is not None, self.multipart, self.hashes.get(file),
+                                             self.s3_limit)
+            error = False
+        finally:
+            self.s3_limit.release(started, error, self.sizes.get(file, 0))
+        self.metrics.record('s3_upload', 1, self.sizes.get(file, 0), time.perf_counter() - start)
+        return etag
+
+    def drain(self, block=True):
+        # with block=False only the files whose uploads have already finished are published, unless too many
+        # uploads are in flight. The batches that are old enough go on the queue first, with block=True all of
+        # them do.
+        if self.batcher:
+            for batch in self.batcher.flush() if block else self.batcher.due():
+                self.put_batch(batch)
+
+        result = self.drain_lane(self.files, block)
+        if result and self.large_files:
+            result = self.drain_lane(self.large_files, block)
+
+        # the messages published before a failure are still committed, so their files can go
+        if self.mq_publisher.pending and (block or not result or self.mq_publisher.batch_due()):
+            confirmed = self.confirm()
+            result = result and confirmed
+
+        return result
+
+    def drain_lane(self, files, block):
+        result = True
+
+        while files:
+            file, date_prefix, upload = files[0]
+
+            if upload is DUPLICATE:
+                self.metrics.record('duplicate', 1, self.sizes.get(file, 0), 0.0)
+                if self.index.duplicates == 'skip':
+                    result = self.skip_duplicate(file)
+                    if not result:
+                        break
+                    files.popleft()
+                    continue
+            elif upload is None:
+                started = self.s3_limit.acquire()
+                start = time.perf_counter()
+                with pipeline_trace.span('s3_upload', 's3', file=file):
+                    if file in self.batches:
+                        result = upload_batch_to_s3(self.s3client, self.s3_bucket, self.batches[file],
+                                                    self.feed_type, self.config, self.s3_limit)
+                    else:
+                        result = upload_to_s3(self.s3client, self.s3_bucket, self.download_dir, file, date_prefix,
+                                              self.feed_type, self.config, self.manifest, self.hashes.get(file),
+                                              self.s3_limit, self.keys.get(file))
+                self.s3_limit.release(started, not result, self.sizes.get(file, 0))
+                if result:
+                    self.metrics.record('s3_upload', 1, self.sizes.get(file, 0), time.perf_counter() - start)
+            elif upload is not ALREADY_UPLOADED:
+                if not block and not upload.done() and len(files) < self.max_pending:
+                    break
+                try:
+                    etag = upload.result()
+                    # the files of a batch stay recorded as downloaded, a run interrupted before the batch's
+                    # message is committed packs them again
+                    if self.manifest and file in self.keys:
+                        self.manifest.mark_uploaded(self.keys[file], date_prefix + file, etag)
+                except Exception as e:
+                    result = False
+                    report_upload_error(self.s3_bucket, self.download_dir, file, e, self.feed_type, self.config)
+
+            if result and file in self.batches:
+                self.add_batch_to_index(self.batches[file])
+            elif result and upload is not DUPLICATE:
+                self.add_to_index(file, date_prefix)
+            if result:
+                s3_key, s3_offset = self.duplicates.get(file, (None, None))
+                result = publish_to_rabbitmq(self.mq_publisher, self.exchange, self.exchange_type,
+                                             self.routing_key, self.download_dir, file, self.feed_type,
+                                             self.s3_bucket, date_prefix, self.config, self.streamed.get(file),
+                                             self.hashes.get(file), s3_key, self.batches.get(file), s3_offset)
+            if not result:
+                break
+            files.popleft()
+
+            if self.mq_publisher.batch_due():
+                result = self.confirm()
+                if not result:
+                    break
+
+        return result
+
+    def add_to_index(self, file, date_prefix):
+        # the content of a file in S3 is what later duplicates point to
+        content_md5 = self.hashes.get(file)
+        if self.index and content_md5:
+            content = (content_md5, self.sizes.get(file, 0))
+            self.index.add(content_md5, content[1], date_prefix + file)
+            if self.queued.get(content) == date_prefix + file:
+                del self.queued[content]
+
+    def add_batch_to_index(self, batch):
+        # a file uploaded in a batch is found at its offset in the batch's object
+        if self.index:
+            for member in batch.index:
+                self.index.add(member['md5'], member['size'], batch.date_prefix + batch.name, member['offset'])
+
+    def skip_duplicate(self, file):
+        # nothing to upload or publish, the file is done once it is deleted
+        s3_key, s3_offset = self.duplicates[file]
+        message = "File " + file + " in " + self.download_dir + " has the same content as " + s3_key + \
+                  ("" if s3_offset is None else " at offset " + str(s3_offset)) + ", skipping it."
+        logger.info(message)
+        key = self.keys.pop(file, None)
+        if self.manifest and key:
+            self.manifest.mark_published([key])
+        self.sizes.pop(file, None)
+        self.hashes.pop(file, None)
+        del self.duplicates[file]
+        return delete_published_file(self.mq_connection, self.download_dir, file, self.feed_type, self.config)
+
+    def confirm(self):
+        result = True
+
+        start = time.perf_counter()
+        try:
+            with pipeline_trace.span('mq_commit', 'rabbitmq', files=len(self.mq_publisher.pending)):
+                files = self.mq_publisher.flush()
+        except Exception as e:
+            # the uncommitted messages are dropped by the broker, their files stay in download_dir
+            message = "RabbitMQ failed to confirm the published files. " + str(e)
+            logger.error(message)
+            mq = self.config[self.feed_type]['rabbitmq']
+            publish_error_to_rabbitmq(self.mq_connection, mq['exception_exchange'], mq['exception_key'],
+                                      get_log_time("ERROR") + message)
+            return False
+
+        if files:
+            self.metrics.record('mq_publish', len(files), sum(self.sizes.get(file, 0) for file in files),
+                                time.perf_counter() - start)
+
+        # the message of a batch publishes all of its files
+        published = []
+        for file in files:
+            batch = self.batches.pop(file, None)
+            if batch:
+                self.sizes.pop(file, None)
+                self.hashes.pop(file, None)
+                self.streamed.pop(file, None)
+                published.extend(member.filename for member in batch.members)
+            else:
+                published.append(file)
+
+        if self.manifest:
+            self.manifest.mark_published([self.keys[file] for file in published if file in self.keys])
+
+        for file in published:
+            self.keys.pop(file, None)
+            size = self.sizes.pop(file, 0)
+            self.hashes.pop(file, None)
+            self.duplicates.pop(file, None)
+            if self.streamed.pop(file, None) is not None:
+                continue
+            start = time.perf_counter()
+            with pipeline_trace.span('delete', 'local', file=file):
+                deleted = delete_published_file(self.mq_connection, self.download_dir, file, self.feed_type,
+                                                self.config)
+            if deleted:
+                self.metrics.record('delete', 1, size, time.perf_counter() - start)
+            else:
+                result = False
 
-    # date_prefix = datetime.now().strftime("%Y/%m/%d/")
+        return result
+
+    def close(self):
+        # wait for the uploads still in flight, their files stay in download_dir if they were not published
+        for executor in (self.executor, self.large_executor):
+            if executor:
+                executor.shutdown(wait=True)
+        self.executor = None
+        self.large_executor = None
+        self.mq_publisher.close()
 
-    download_dir = os.path.normpath(config[feed_type]['ftp_client']['download_dir'])
-    # 2018-05-12
-    # s3failed_dir = os.path.normpath(config[feed_type]['ftp_client']['s3failed_dir'])
-    exchange = config[feed_type]['rabbitmq']['exchange']
-    exchange_type = config[feed_type]['rabbitmq']['exchange_type']
-    routing_key = config[feed_type]['rabbitmq']['routing_key']
 
-    s3_bucket = config[feed_type]['ftp_client']['s3_bucket']
+def publish_files(mq_connection, s3client, feed_type, config, publish_queue=None):
+    # full scan of download_dir, only done once at start-up to recover the files left by the previous run,
+    # and of the manifest for the streamed files it left uploaded but not published.
+    # Newly downloaded files go straight onto the publish queue instead.
+    if publish_queue is None:
+        publish_queue = PublishQueue(mq_connection, s3client, feed_type, config)
+        try:
+            return publish_files(mq_connection, s3client, feed_type, config, publish_queue)
+        finally:
+            publish_queue.close()
+
+    download_dir = publish_queue.download_dir
 
     # upload file to S3
-    # file_count = len(os.listdir(download_dir))
-    files = [file for file in os.listdir(download_dir) if os.path.isfile(os.path.join(download_dir, file))]
+    with pipeline_trace.span('scan_download_dir', 'local'):
+        files = []
+        for entry in os.scandir(download_dir):
+            if entry.is_file() and not entry.name.endswith(PARTIAL_SUFFIX):
+                file_stats = entry.stat()
+                files.append(transfer_schedule.LocalFile(entry.name, file_stats.st_size, file_stats.st_mtime))
     file_count = len(files)
     message = "Start to publish " + str(file_count) + " files in " + download_dir
     logger.info(message)
 
-    for file in sorted(files):
-        date_prefix = get_s3_date_prefix(download_dir, file)
-        result = upload_to_s3(s3client, s3_bucket, download_dir, file, date_prefix, feed_type, config)
+    manifest = publish_queue.manifest
+
+    # name order, unless the feed's schedule says otherwise
+    files = sorted(files, key=lambda local_file: local_file.filename)
+    files = [local_file.filename for local_file in publish_queue.schedule.order(files)]
+    # manifest keys of the files found in download_dir
+    recovered = set()
+    for file in files:
+        if manifest:
+            unfinished = manifest.get_unfinished(file)
+            if unfinished is None and manifest.is_published(file):
+                # published by an earlier run which then failed to delete it
+                if not delete_published_file(mq_connection, download_dir, file, feed_type, config):
+                    return False
+                continue
+            if unfinished:
+                recovered.add(unfinished[3])
+            if unfinished and unfinished[0] >= transfer_manifest.UPLOADED:
+                message = "File " + file + " in " + download_dir + " was uploaded by an earlier run, publishing only."
+                logger.info(message)
+                publish_queue.put(file, unfinished[1], manifest_key=unfinished[3])
+            else:
+                publish_queue.put(file, manifest_key=unfinished and unfinished[3])
+        else:
+            publish_queue.put(file)
+        if not publish_queue.drain(block=False):
+            return False
+
+    if manifest:
+        # a file streamed to S3 has no local copy for the scan to find, a run that stopped between its upload
+        # and its publish left it recorded as uploaded
+        for file, s3_key, size, key in manifest.get_uploaded():
+            if key in recovered:
+                continue
+            if file in publish_queue.sizes:
+                # another remote file of that name is on the queue, the queue holds one file per name
+                if not publish_queue.drain():
+                    return False
+            message = "File " + file + " was streamed to S3 by an earlier run, publishing " + s3_key + " only."
+            logger.info(message)
+            publish_queue.put(file, s3_key, size, manifest_key=key)
+            if not publish_queue.drain(block=False):
+                return False
+
+    return publish_queue.drain()
 
-        if not result:
-            break
 
-        if publish_to_rabbitmq(mq_connection, exchange, exchange_type, routing_key, download_dir, file, feed_type,
-                               s3_bucket, date_prefix, config):
-            # delete the file after publishing successfully
-            delete_result = delete_file(download_dir, file, feed_type, config)
+def open_sftp_connection(sftp_dict):
+    import pysftp
 
-            if not delete_result:
-                # failed to delete the file in download_dir
+    cnopts = pysftp.CnOpts()
+    cnopts.hostkeys = None
+
+    with pipeline_trace.span('sftp_connect', 'connect', host=sftp_dict['host']):
+        return pysftp.Connection(host=sftp_dict['host'], username=sftp_dict['user_name'], port=sftp_dict['port'],
+                                 password=sftp_dict['password'], cnopts=cnopts)
+
+
+def download_file(sftp, filename, local_filename, file_size, prefetch_threshold, content_hash=None, limit=None):
+    # the file is written to <name>.part and renamed once complete. A .part file left by an interrupted
+    # download is continued from its size instead of starting over. content_hash is updated with every block
+    # on its way to disk, so the file is never read back to hash it (only the part of a resumed download
+    # that is already on disk is). limit is the server's RateLimit, every block waits for its bytes.
+    partial_filename = local_filename + PARTIAL_SUFFIX
+    offset = 0
+    if os.path.exists(partial_filename):
+        offset = os.path.getsize(partial_filename)
+        if offset > file_size:
+            offset = 0
+        else:
+            message = "Resuming the download of " + filename + " at byte " + str(offset) + " of " + str(file_size)
+            logger.info(message)
+            if content_hash is not None:
+                update_content_hash(content_hash, partial_filename)
+
+    # sftp.get() stats the remote file again before reading it, the size is already known from the listing
+    with sftp.sftp_client.open(filename, 'rb') as remote_file:
+        if offset:
+            remote_file.seek(offset)
+        if file_size - offset >= prefetch_threshold and not (limit and limit.limited):
+            # keep the read requests for the rest of the file in flight instead of one round trip per block.
+            # Not under a byte rate limit, prefetching would pull the file in at full speed whatever the limit.
+            remote_file.prefetch(file_size)
+        with open(partial_filename, 'ab' if offset else 'wb') as local_file:
+            if content_hash is None and limit is None:
+                shutil.copyfileobj(remote_file, local_file, DOWNLOAD_BUFFER_SIZE)
+            else:
+                for block in iter(lambda: remote_file.read(DOWNLOAD_BUFFER_SIZE), b''):
+                    if limit is not None:
+                        limit.take(len(block))
+                    if content_hash is not None:
+                        content_hash.update(block)
+                    local_file.write(block)
+
+    os.replace(partial_filename, local_filename)
+
+    return file_size - offset
+
+
+def read_remote_block(remote_file, offset, length):
+    # readv pipelines the read requests of just this block, so memory stays bounded by the block size
+    return b''.join(remote_file.readv([(offset, length)]))
+
+
+def stream_file_to_s3(sftp, filename, file_size, s3client, s3_bucket, key, part_size, concurrency,
+                      content_hash=None):
+    # copies the remote file to S3 without a local copy: at most 'concurrency' parts are in flight plus the one
+    # being read. Every request goes with the Content-MD5 of its body, content_hash is updated with the parts
+    # in file order as they are read.
+    if content_hash is None:
+        content_hash = new_content_hash()
+    with sftp.sftp_client.open(filename, 'rb') as remote_file:
+        if file_size <= part_size:
+            body = read_remote_block(remote_file, 0, file_size) if file_size else b''
+            content_hash.update(body)
+            return s3client.put_object(Bucket=s3_bucket, Key=key, Body=body,
+                                       ContentMD5=get_content_md5(content_hash),
+                                       Metadata={'content-md5': content_hash.hexdigest()})['ETag']
+
+        upload_id = s3client.create_multipart_upload(Bucket=s3_bucket, Key=key)['UploadId']
+        in_flight = threading.BoundedSemaphore(concurrency)
+
+        def upload_part(part_number, body):
+            try:
+                return s3client.upload_part(Bucket=s3_bucket, Key=key, PartNumber=part_number, UploadId=upload_id,
+                                            Body=body, ContentMD5=get_content_md5(hashlib.md5(body)))['ETag']
+            finally:
+                in_flight.release()
+
+        try:
+            with concurrent.futures.ThreadPoolExecutor(max_workers=concurrency) as executor:
+                uploads = []
+                for offset in range(0, file_size, part_size):
+                    in_flight.acquire()
+                    body = read_remote_block(remote_file, offset, min(part_size, file_size - offset))
+                    content_hash.update(body)
+                    uploads.append(executor.submit(upload_part, len(uploads) + 1, body))
+                parts = [{'ETag': upload.result(), 'PartNumber': part_number}
+                         for part_number, upload in enumerate(uploads, 1)]
+
+            response = s3client.complete_multipart_upload(Bucket=s3_bucket, Key=key, UploadId=upload_id,
+                                                          MultipartUpload={'Parts': parts})
+        except Exception:
+            try:
+                s3client.abort_multipart_upload(Bucket=s3_bucket, Key=key, UploadId=upload_id)
+            except Exception:
+                pass
+            raise
+
+    return response['ETag']
+
+
+class S3StreamTransfer(object):
+    """
+    SFTPDownloader transfer of the 'stream' transfer_mode: every remote file goes straight into S3, in parts of
+    'multipart_part_size', instead of through download_dir. The S3 date prefix comes from the remote mtime of
+    the file. 'uploaded' holds the S3 key, ETag and MD5 of every streamed file.
+    """
+
+    def __init__(self, s3client, feed_type, config):
+        multipart = get_multipart_config(feed_type, config)
+        self.s3client = s3client
+        self.s3_bucket = config[feed_type]['ftp_client']['s3_bucket']
+        self.part_size = multipart['part_size']
+        self.concurrency = multipart['concurrency']
+        self.uploaded = {}
+
+    def __call__(self, sftp, entry):
+        date_prefix = get_s3_date_prefix_from_mtime(entry.st_mtime)
+        key = date_prefix + entry.filename
+        content_hash = new_content_hash()
+        etag = stream_file_to_s3(sftp, entry.filename, entry.st_size, self.s3client, self.s3_bucket, key,
+                                 self.part_size, self.concurrency, content_hash)
+        self.uploaded[entry.filename] = key, etag, content_hash.hexdigest()
+
+        message = "File " + entry.filename + " is streamed to S3 bucket " + self.s3_bucket + "/" + date_prefix
+        logger.info(message)
+
+        return entry.st_size
+
+
+class SFTPSessionStats(object):
+
+    def __init__(self, session):
+        self.session = session
+        self.files = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def add(self, file_size, seconds):
+        self.files += 1
+        self.bytes += file_size
+        self.seconds += seconds
+
+    def __str__(self):
+        rate = self.bytes / self.seconds / 1024 if self.seconds else 0.0
+        return "SFTP session " + str(self.session) + ": " + str(self.files) + " files, " + str(self.bytes) + \
+               " bytes in " + "%.2f" % self.seconds + " s (" + "%.1f" % rate + " KB/s)"
+
+
+class SFTPDownloader(object):
+    """
+    Downloads the files of one remote listing into download_dir. With 'sessions' > 1 in the feed's sftp_server
+    config, the files are spread across a pool of SFTP sessions to the same server: the already open connection
+    plus 'sessions' - 1 more opened with 'connect'. The listing entry of every downloaded file is handed to
+    'on_downloaded' on the calling thread, which returns False to stop the download. 'transfer' replaces the
+    download into download_dir, it is called with the session and the entry and returns the bytes transferred.
+    'content_md5' holds the MD5 taken while each file was downloaded, until on_downloaded takes it.
+
+    The files are taken in the order of the feed's TransferSchedule. With a large-file lane, the large files
+    get 'large_file_sessions' sessions of their own, which help with the small files once the large ones are
+    done; the small-file sessions never pick up a large file.
+
+    Every download goes through the RateLimit of the server, shared with the other feeds on it: it waits for
+    its bytes ('max_bytes_per_second') and, with 'adaptive_sessions', for a free slot. The adaptive limit
+    then decides how many of the sessions transfer at once: a session only opens its connection once it gets
+    a slot and the server's open connections are below the limit, and closes it again when it has waited
+    SESSION_IDLE seconds for a slot.
+    """
+
+    def __init__(self, sftp, feed_type, config, connect=None, transfer=None):
+        self.sftp = sftp
+        self.transfer = transfer
+        self.feed_type = feed_type
+        self.config = config
+        self.connect = connect or open_sftp_connection
+        self.sftp_dict = config[feed_type]['sftp_server']
+        self.sessions = int(self.sftp_dict.get('sessions', 1))
+        self.schedule = transfer_schedule.get_transfer_schedule(feed_type, config)
+        if self.schedule.strict_order:
+            # a file is only downloaded once the one before it has been handed over
+            self.sessions = 1
+        self.prefetch_threshold = int(config[feed_type]['ftp_client'].get('prefetch_threshold',
+                                                                          PREFETCH_THRESHOLD))
+        self.download_dir = get_download_dir(feed_type, config)
+        self.session_stats = []
+        self.content_md5 = {}
+        self.limit = rate_limits.get_sftp_limit(self.sftp_dict)
+        self.metrics = pipeline_metrics.registry.feed(feed_type)
+
+    def _download(self, sftp, entry, stats):
+        local_filename = os.path.join(self.download_dir, entry.filename)
+        stage = 's3_stream' if self.transfer else 'sftp_get'
+        start = time.perf_counter()
+        with pipeline_trace.span(stage, 'sftp', file=entry.filename, size=entry.st_size):
+            if self.transfer:
+                transferred = self.transfer(sftp, entry)
+            else:
+                content_hash = new_content_hash()
+                transferred = download_file(sftp, entry.filename, local_filename, entry.st_size,
+                                            self.prefetch_threshold, content_hash, self.limit)
+                self.content_md5[entry.filename] = content_hash.hexdigest()
+        seconds = time.perf_counter() - start
+        stats.add(transferred, seconds)
+        self.metrics.record(stage, 1, transferred, seconds)
+
+    def download(self, entries, on_downloaded):
+        self.session_stats = []
+        entries, large_entries = self.schedule.split(entries)
+
+        if large_entries or (self.sessions > 1 and len(entries) > 1):
+            result = self._download_parallel(entries, large_entries, on_downloaded)
+        else:
+            stats = SFTPSessionStats(0)
+            self.session_stats.append(stats)
+            result = True
+            for entry in entries:
+                if shutdown_event.is_set():
+                    # the files not downloaded yet stay on the server
+                    break
+                started = self.limit.acquire()
+                error = True
+                try:
+                    self._download(self.sftp, entry, stats)
+                    error = False
+                finally:
+                    self.limit.release(started, error, entry.st_size)
+                if not on_downloaded(entry):
+                    result = False
+                    break
+
+        for stats in sorted(self.session_stats, key=lambda stats: stats.session):
+            logger.info(str(stats))
+
+        return result
+
+    def _session_worker(self, session, lanes, done, stop):
+        stats = SFTPSessionStats(session)
+        self.session_stats.append(stats)
+        sftp = None
+        if session == 0:
+            sftp = self.sftp
+            self.limit.open_session(force=True)
+        try:
+            while not stop.is_set() and not shutdown_event.is_set():
+                started = self.limit.acquire(SESSION_IDLE)
+                if started is None:
+                    # the server's limit has no room for this session at the moment
+                    if sftp is not None and sftp is not self.sftp:
+                        close_sftp_session(sftp)
+                        self.limit.close_session()
+                        sftp = None
+                    if all(work.empty() for work in lanes):
+                        break
+                    continue
+
+                error = True
+                entry = None
+                try:
+                    if sftp is None:
+                        if all(work.empty() for work in lanes):
+                            error = False
+                            break
+                        if not self.limit.open_session():
+                            # the idle connections of other sessions have to be closed first
+                            error = False
+                            stop.wait(SESSION_IDLE / 10)
+                            continue
+                        try:
+                            sftp = self.connect(self.sftp_dict)
+                            sftp.cwd(self.sftp_dict['source_dir'])
+                        except Exception:
+                            self.limit.close_session()
+                            raise
+                    entry = get_next_entry(lanes)
+                    if entry is None:
+                        error = False
+                        break
+                    try:
+                        self._download(sftp, entry, stats)
+                    except Exception as e:
+                        done.put((entry, e))
+                        break
+                    error = False
+                    done.put((entry, None))
+                finally:
+                    self.limit.release(started, error, entry.st_size if entry and not error else None)
+        except Exception as e:
+            # the other sessions keep going without this one
+            message = "SFTP session " + str(session) + " could not be opened. " + str(e)
+            logger.error(message)
+        finally:
+            if sftp is not None:
+                if sftp is not self.sftp:
+                    close_sftp_session(sftp)
+                self.limit.close_session()
+            done.put(None)
+
+    def _download_parallel(self, entries, large_entries, on_downloaded):
+        result = True
+
+        work = queue.Queue()
+        for entry in entries:
+            work.put(entry)
+        large_work = queue.Queue()
+        for entry in large_entries:
+            large_work.put(entry)
+        done = queue.Queue()
+        stop = threading.Event()
+
+        # the small-file sessions come first, so the connection already open goes to the small files
+        lanes = [(work,)] * min(self.sessions, len(entries)) + \
+                [(large_work, work)] * min(self.schedule.large_file_sessions, len(large_entries))
+        workers = []
+        for session, session_lanes in enumerate(lanes):
+            worker = threading.Thread(target=self._session_worker, args=(session, session_lanes, done, stop),
+                                      name=self.feed_type + "-sftp-" + str(session))
+            worker.start()
+            workers.append(worker)
+
+        running = len(workers)
+        while running:
+            item = done.get()
+            if item is None:
+                running -= 1
+                continue
+
+            entry, error = item
+            if error is not None:
                 result = False
-                message = "File " + file + " in " + download_dir + " needs to be removed manually. "
+                stop.set()
+                message = entry.filename + " failed to be downloaded to " + self.download_dir + ". " + str(error)
                 logger.error(message)
-                mq = config[feed_type]['rabbitmq']
-                publish_error_to_rabbitmq(mq_connection, mq['exception_exchange'], mq['exception_key'],
+                mq = self.config[self.feed_type]['rabbitmq']
+                publish_error_to_rabbitmq(get_current_mq_connection(), mq['exception_exchange'], mq['exception_key'],
                                           get_log_time("ERROR") + message)
+            elif result and not on_downloaded(entry):
+                result = False
+                stop.set()
 
-                break
-        else:
-            result = False
-            break
+        for worker in workers:
+            worker.join()
 
-    return result
+        # files not taken by any session are picked up by the next run
+        return result and ((work.empty() and large_work.empty()) or shutdown_event.is_set())
+
+
+def close_sftp_session(sftp):
+    try:
+        sftp.close()
+    except Exception:
+        pass
+
+
+def get_next_entry(lanes):
+    # the first file waiting in the session's lanes, in the order the lanes are given
+    for work in lanes:
+        try:
+            return work.get_nowait()
+        except queue.Empty:
+            pass
+    return None
+
+
+def get_remote_path(source_dir, filename):
+    return posixpath.join(source_dir, filename)
+
+
+def skip_processed_files(manifest, source_dir, files, download_dir, listing=None):
+    # files the server still lists although an earlier run has already published them, or that are
+    # still waiting in download_dir, are not downloaded again. They are marked done in the listing cache,
+    # so the next cycles skip them without asking the manifest again.
+    remaining = []
+    for entry in files:
+        recorded = manifest.get(get_remote_path(source_dir, entry.filename), entry.st_size, entry.st_mtime)
+        if recorded and (recorded[1] == transfer_manifest.PUBLISHED or
+                         os.path.exists(os.path.join(download_dir, recorded[0]))):
+            message = entry.filename + " was already processed, skipping it."
+            logger.info(message)
+            if listing:
+                listing.mark_done(entry.filename)
+            continue
+        remaining.append(entry)
+
+    return remaining
+
+
+# feed type: ListingCache, kept from one cycle to the next in daemon and --all-feeds mode
+listing_caches = {}
+
+
+def get_listing_cache(feed_type, config):
+    # saved next to download_dir unless the feed has a 'listing_cache_file'
+    listing = listing_caches.get(feed_type)
+    if listing is None:
+        listing = listing_caches[feed_type] = remote_listing.open_listing_cache(
+            feed_type, config, str(pathlib.Path.home()), get_download_dir(feed_type, config) + '.listing.json')
+    return listing
+
+
+def is_sftp_alive(sftp):
+    try:
+        return sftp.sftp_client.get_channel().get_transport().is_active()
+    except Exception:
+        return False
+
+
+class SerializedMQConnection(object):
+    """
+    pika's BlockingConnection is not thread-safe. Feeds sharing a broker connection use it through this wrapper,
+    which holds the connection's lock for every call on the connection and on its channels.
+    """
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.lock = threading.RLock()
+
+    @property
+    def is_open(self):
+        return self.connection.is_open
+
+    def channel(self):
+        with self.lock:
+            return SerializedMQChannel(self.connection.channel(), self.lock)
+
+    def process_data_events(self, time_limit=0):
+        with self.lock:
+            self.connection.process_data_events(time_limit=time_limit)
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+class SerializedMQChannel(object):
+
+    def __init__(self, channel, lock):
+        self.channel = channel
+        self.lock = lock
+
+    def __getattr__(self, name):
+        attribute = getattr(self.channel, name)
+        if not callable(attribute):
+            return attribute
+
+        def call(*args, **kwargs):
+            with self.lock:
+                return attribute(*args, **kwargs)
+
+        return call
+
+
+class SharedConnections(object):
+    """
+    RabbitMQ connections and S3 clients shared by the feeds of one process: one RabbitMQ connection per broker
+    (host, port, virtual host and user) and one S3 client per set of credentials.
+    """
 
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.mq_connections = {}
+        self.s3_clients = {}
+
+    def get_mq_connection(self, feed_type, config):
+        key = get_mq_broker_key(feed_type, config)
+
+        with self.lock:
+            mq_connection = self.mq_connections.get(key)
+            if mq_connection is not None and not mq_connection.is_open:
+                mq_connection = None
+            if mq_connection is None:
+                connection = get_mq_connection(feed_type, config)
+                if connection:
+                    mq_connection = SerializedMQConnection(connection)
+                    self.mq_connections[key] = mq_connection
+
+        return mq_connection
+
+    def get_s3_client(self, feed_type, config):
+        s3 = get_s3_config(feed_type, config)
+        key = s3['aws_access_key_id'], s3['aws_secret_access_key']
+
+        with self.lock:
+            s3_client = self.s3_clients.get(key)
+            if s3_client is None:
+                s3_client = get_s3_client(feed_type, config)
+                if s3_client:
+                    self.s3_clients[key] = s3_client
+
+        return s3_client
+
+    def close(self):
+        with self.lock:
+            for mq_connection in self.mq_connections.values():
+                try:
+                    mq_connection.close()
+                except Exception:
+                    pass
+            self.mq_connections = {}
+
+
+class FeedConnections(object):
+    """
+    The RabbitMQ, S3 and SFTP connections of one feed. A connection is opened on first use and kept open
+    between download cycles, one that has been found broken is dropped and opened again on next use.
+    With 'shared', the RabbitMQ connection and the S3 client come from the process-wide SharedConnections
+    and are closed by it.
+    """
+
+    def __init__(self, feed_type, config, shared=None):
+        self.feed_type = feed_type
+        self.config = config
+        self.shared = shared
+        self.mq_connection = None
+        self.s3_client = None
+        self.sftp = None
+        self.reconnects = {'rabbitmq': 0, 's3': 0, 'sftp': 0}
+        pipeline_metrics.registry.feed(feed_type).reconnects = self.reconnects
+
+    def get_mq_connection(self):
+        if self.mq_connection is not None and not self.mq_connection.is_open:
+            message = "RabbitMQ connection is closed, reconnecting."
+            logger.warning(message)
+            self.mq_connection = None
+            self.reconnects['rabbitmq'] += 1
+        if self.mq_connection is None:
+            if self.shared:
+                self.mq_connection = self.shared.get_mq_connection(self.feed_type, self.config)
+            else:
+                self.mq_connection = get_mq_connection(self.feed_type, self.config)
+
+        return self.mq_connection
+
+    def get_s3_client(self):
+        # boto3 re-establishes its own HTTPS connections, the client only has to be created once
+        if self.s3_client is None:
+            if self.shared:
+                self.s3_client = self.shared.get_s3_client(self.feed_type, self.config)
+            else:
+                self.s3_client = get_s3_client(self.feed_type, self.config)
+
+        return self.s3_client
+
+    def keep_alive(self):
+        # BlockingConnection only answers the broker's heartbeats while it is being called
+        if self.mq_connection is not None and self.mq_connection.is_open:
+            try:
+                self.mq_connection.process_data_events(time_limit=0)
+            except Exception as e:
+                message = "RabbitMQ connection failed while idle. " + str(e)
+                logger.warning(message)
+
+    def get_sftp_connection(self):
+        if self.sftp is not None and not is_sftp_alive(self.sftp):
+            message = "SFTP connection is broken, reconnecting."
+            logger.warning(message)
+            self.close_sftp_connection()
+            self.reconnects['sftp'] += 1
+        if self.sftp is None:
+            self.sftp = open_sftp_connection(self.config[self.feed_type]['sftp_server'])
+            message = "Connection to an SFTP server established successfully."
+            logger.info(message)
+
+        return self.sftp
+
+    def close_sftp_connection(self):
+        if self.sftp:
+            message = "Closing FTP connection"
+            logger.info(message)
+
+            try:
+                self.sftp.close()
+            except Exception:
+                pass
+        self.sftp = None
+
+    def close(self):
+        self.close_sftp_connection()
+
+        if self.mq_connection and not self.shared:
+            message = "Closing RabbitMQ Connection."
+            logger.info(message)
+            try:
+                self.mq_connection.close()
+            except Exception:
+                pass
+        self.mq_connection = None
+
+
+def download_and_publish(feed_type, config, connections=None):
+    # connections are kept open for the next cycle when they are passed in (daemon mode),
+    # a single run opens and closes its own
+    own_connections = connections is None
+    if own_connections:
+        connections = FeedConnections(feed_type, config)
 
-def download_and_publish(feed_type, config):
     # 2018-05-12
     result = os.EX_UNAVAILABLE
     # result = 69
@@ -312,7 +1701,7 @@ def download_and_publish(feed_type, config):
     logger.info(message)
 
     # create directory if it is not exist...
-    download_dir = os.path.join(str(pathlib.Path.home()), config[feed_type]['ftp_client']['download_dir'])
+    download_dir = get_download_dir(feed_type, config)
     # 2018-05-12
     # s3failed_dir = os.path.join(str(pathlib.Path.home()), config[feed_type]['ftp_client']['s3failed_dir'])
     # create directories if not existing
@@ -325,15 +1714,18 @@ def download_and_publish(feed_type, config):
     logger.info(message)
 
     s3_client = None
-    sftp = None
 
-    global mq_connection
-    mq_connection = get_mq_connection(feed_type, config)
+    # error messages of this feed go through the background error reporter from here on
+    feed_context.feed_type = feed_type
+    error_reports.register(feed_type, config)
+
+    mq_connection = connections.get_mq_connection()
+    feed_context.mq_connection = mq_connection
     if mq_connection:
-        s3_client = get_s3_client(feed_type, config)
+        s3_client = connections.get_s3_client()
         if s3_client:
             message = "Successfully connected to S3 storage."
-            logger.error(message)
+            logger.info(message)
             result = os.EX_OK
         else:
             message = "Failed to connect to S3 storage, ftp download is not performed."
@@ -357,80 +1749,132 @@ def download_and_publish(feed_type, config):
             # the previously failed stays in download directory, the process stops if it fails again
 
             # process the files left (if any) from previous run due to error
-            result = publish_files(mq_connection, s3_client, feed_type, config)
-
-            if result:
-                # files left from previous run were published successfully,
-                # download new files
-                message = "Start to download new files."
-                logger.info(message)
-
-                try:
-                    cnopts = pysftp.CnOpts()
-                    cnopts.hostkeys = None
-
-                    sftp_dict = config[feed_type]['sftp_server']
-                    hostname = sftp_dict['host']
-                    username = sftp_dict['user_name']
-                    portnumber = sftp_dict['port']
-                    passwordvalue = sftp_dict['password']
-
-                    with pysftp.Connection(host=hostname, username=username, port=portnumber, password=passwordvalue, cnopts=cnopts) as sftp:
-                        message = "Connection to an SFTP server established successfully."
-                        logger.info(message)
+            # the upload executors and the SQLite handles are released however the cycle ends, a daemon or
+            # --all-feeds process keeps running after a cycle that raised
+            manifest = None
+            index = None
+            publish_queue = None
+            try:
+                manifest = transfer_manifest.open_manifest(feed_type, config, str(pathlib.Path.home()))
+                index = content_index.open_content_index(feed_type, config, str(pathlib.Path.home()))
+                publish_queue = PublishQueue(mq_connection, s3_client, feed_type, config, manifest, index)
+                published = publish_files(mq_connection, s3_client, feed_type, config, publish_queue)
+
+                if published:
+                    # files left from previous run were published successfully,
+                    # download new files
+                    message = "Start to download new files."
+                    logger.info(message)
+
+                    try:
+                        sftp_dict = config[feed_type]['sftp_server']
+                        sftp = connections.get_sftp_connection()
 
                         with sftp.cd(sftp_dict['source_dir']):
-                            directory_structure = sftp.listdir()
-                            files = directory_structure
+                            # the attributes come with the listing, so no extra stat per file is needed later
+                            with pipeline_trace.span('listdir_attr', 'sftp', feed=feed_type):
+                                files = sftp.listdir_attr()
+
+                            # only the files that are new since the last cycle and have stopped growing are
+                            # left, those that are done are skipped without a manifest lookup
+                            listing = get_listing_cache(feed_type, config)
+                            listed = len(files)
+                            files = listing.select(files)
+                            message = str(listed) + " entries listed, " + str(listing.skipped) + \
+                                      " already processed, " + str(listing.waiting) + " still changing."
+                            logger.info(message)
 
-                            # sort the file names if requested in config file
-                            # files list will be modified
+                            if manifest:
+                                with pipeline_trace.span('skip_processed_files', 'local', feed=feed_type):
+                                    files = skip_processed_files(manifest, sftp_dict['source_dir'], files,
+                                                                 download_dir, listing)
 
                             message = str(len(files)) + " files to be downloaded."
                             logger.info(message)
 
-                            i = 0
-                            for filename in files:
-                                local_filename = os.path.join(os.path.normpath(download_dir), filename)
-                                sftp.get(filename, local_filename)
-                                i = i + 1
-                                message = str(i) + ", " + filename + " is downloaded to " + download_dir
-                                logger.info(message)
-
-                                # publish downloadwed file
-                                # file_count = len(os.listdir(download_dir))
-                                # message = "Start to publish " + str(file_count) + " new files."
-                                # sys.stdout.write(get_log_time("INFO") + "[" + str(lineno()) + "] " + message + "\n")
+                            downloaded = [0]
+                            stream_transfer = None
+                            if config[feed_type]['ftp_client'].get('transfer_mode') == 'stream':
+                                stream_transfer = S3StreamTransfer(s3_client, feed_type, config)
 
-                                result = publish_files(mq_connection, s3_client, feed_type, config)
+                            downloader = SFTPDownloader(sftp, feed_type, config, transfer=stream_transfer)
 
-                                if result:
-                                    message = "Downloaded file is published successfully."
-                                    logger.info(message)
+                            def on_downloaded(entry):
+                                downloaded[0] += 1
+                                listing.mark_done(entry.filename)
+                                if stream_transfer:
+                                    message = str(downloaded[0]) + ", " + entry.filename + " is streamed to S3"
                                 else:
-                                    message = "Error occurred when publishing downloaded file,"
-                                    logger.error(message)
-                                    mq = config[feed_type]['rabbitmq']
-                                    publish_error_to_rabbitmq(mq_connection, mq['exception_exchange'],
-                                                              mq['exception_key'], get_log_time("ERROR") + message)
+                                    message = str(downloaded[0]) + ", " + entry.filename + " is downloaded to " + \
+                                              download_dir
+                                logger.info(message)
 
-                                    break
-                except Exception as e:
-                    sftp = None
-                    message = "ftp connection creation error."
+                                manifest_key = None
+                                if manifest:
+                                    manifest_key = manifest.mark_downloaded(
+                                        get_remote_path(sftp_dict['source_dir'], entry.filename), entry.st_size,
+                                        entry.st_mtime, entry.filename)
+
+                                if stream_transfer:
+                                    key, etag, content_md5 = stream_transfer.uploaded.pop(entry.filename)
+                                    if manifest:
+                                        manifest.mark_uploaded(manifest_key, key, etag)
+                                    publish_queue.put(entry.filename, key, entry.st_size, content_md5, manifest_key)
+                                else:
+                                    # publish downloaded file, no need to rescan download_dir for it
+                                    publish_queue.put(entry.filename,
+                                                      content_md5=downloader.content_md5.pop(entry.filename),
+                                                      manifest_key=manifest_key)
+                                return publish_queue.drain(block=False)
+
+                            try:
+                                published = downloader.download(files, on_downloaded)
+                            finally:
+                                try:
+                                    listing.save()
+                                except OSError as e:
+                                    message = "Listing cache could not be saved. " + str(e)
+                                    logger.warning(message)
+
+                            # wait for the uploads still in flight
+                            if published:
+                                published = publish_queue.drain()
+
+                            if published:
+                                message = "Downloaded files are published successfully."
+                                logger.info(message)
+                            else:
+                                message = "Error occurred when publishing downloaded file,"
+                                logger.error(message)
+                                mq = config[feed_type]['rabbitmq']
+                                publish_error_to_rabbitmq(mq_connection, mq['exception_exchange'],
+                                                          mq['exception_key'], get_log_time("ERROR") + message)
+                    except Exception as e:
+                        published = False
+                        # reconnect on the next cycle
+                        connections.close_sftp_connection()
+                        message = "ftp connection creation error. " + str(e)
+                        logger.error(message)
+                        mq = config[feed_type]['rabbitmq']
+                        publish_error_to_rabbitmq(mq_connection, mq['exception_exchange'], mq['exception_key'],
+                                                  get_log_time("ERROR") + message)
+
+                else:
+                    message = "Error occurred when publishing previously failed files, ftp download is not performed."
                     logger.error(message)
                     mq = config[feed_type]['rabbitmq']
                     publish_error_to_rabbitmq(mq_connection, mq['exception_exchange'], mq['exception_key'],
                                               get_log_time("ERROR") + message)
-
-
-
-            else:
-                message = "Error occurred when publishing previously failed files, ftp download is not performed."
-                logger.error(message)
-                mq = config[feed_type]['rabbitmq']
-                publish_error_to_rabbitmq(mq_connection, mq['exception_exchange'], mq['exception_key'],
-                                          get_log_time("ERROR") + message)
+            finally:
+                if publish_queue is not None:
+                    publish_queue.close()
+                if manifest:
+                    manifest.close()
+                if index:
+                    index.close()
+
+            if not published:
+                result = os.EX_SOFTWARE
         else:
             message = "Connection error, ftp download is not performed."
             logger.error(message)
@@ -447,23 +1891,276 @@ def download_and_publish(feed_type, config):
 
     # close all
     #  connections
-    if sftp:
-        message = "Closing FTP connection"
+    if own_connections:
+        connections.close()
+
+    return result
+
+
+def get_feed_engine(feed_type, config, engine):
+    # the engine the feed's cycles run on: a feed with settings the async engine does not support falls back
+    # to the blocking engine
+    if engine != 'async':
+        return engine
+
+    import async_engine
+
+    unsupported = async_engine.get_unsupported_settings(feed_type, config)
+    if unsupported:
+        message = "Feed " + feed_type + " sets " + ", ".join(unsupported) + \
+                  ", which the async engine does not support, its cycles run on the blocking engine."
+        logger.warning(message)
+        return 'blocking'
+    return engine
+
+
+def download_and_publish_async(feed_type, config):
+    # the cycle of --engine async: async_engine.AsyncFeedCycle on an event loop of its own, with connections
+    # opened for the cycle and closed after it. Same result codes as download_and_publish.
+    import asyncio
+    import async_engine
+
+    download_dir = get_download_dir(feed_type, config)
+    pathlib.Path(download_dir).mkdir(parents=True, exist_ok=True)
+
+    feed_context.feed_type = feed_type
+    feed_context.mq_connection = None
+    error_reports.register(feed_type, config)
+    mq = config[feed_type]['rabbitmq']
+    sftp_dict = config[feed_type]['sftp_server']
+
+    def report_error(message):
+        publish_error_to_rabbitmq(None, mq['exception_exchange'], mq['exception_key'],
+                                  get_log_time("ERROR") + message)
+
+    manifest = transfer_manifest.open_manifest(feed_type, config, str(pathlib.Path.home()))
+    listing = get_listing_cache(feed_type, config)
+
+    def select(files):
+        listed = len(files)
+        files = listing.select(files)
+        message = str(listed) + " entries listed, " + str(listing.skipped) + " already processed, " + \
+                  str(listing.waiting) + " still changing."
         logger.info(message)
+        if manifest:
+            files = skip_processed_files(manifest, sftp_dict['source_dir'], files, download_dir, listing)
+        return files
+
+    def on_downloaded(entry):
+        listing.mark_done(entry.filename)
 
+    cycle = async_engine.AsyncFeedCycle(feed_type, config, download_dir, get_multipart_config(feed_type, config),
+                                        manifest, select, on_downloaded, report_error, shutdown_event)
+    try:
+        published = asyncio.run(async_engine.run_cycle(cycle, sftp_dict, get_s3_config(feed_type, config), mq))
+        result = os.EX_OK if published else os.EX_SOFTWARE
+    except Exception as e:
+        result = os.EX_UNAVAILABLE
+        message = "Connection error, ftp download is not performed. " + str(e)
+        logger.error(message)
+        report_error(message)
+    finally:
         try:
-            sftp.quit()
-        except:
-            sftp.close()
+            listing.save()
+        except OSError as e:
+            message = "Listing cache could not be saved. " + str(e)
+            logger.warning(message)
+        if manifest:
+            manifest.close()
 
-    if mq_connection:
-        message = "Closing RabbitMQ Connection."
+    return result
+
+
+def handle_shutdown_signal(signum, frame):
+    message = "Signal " + str(signum) + " received, stopping after the current file."
+    logger.info(message)
+    shutdown_event.set()
+
+
+class FeedStats(object):
+
+    def __init__(self, feed_type):
+        self.feed_type = feed_type
+        self.cycles = 0
+        self.failures = 0
+        self.last_result = None
+        self.last_started = None
+        self.last_duration = 0.0
+        self.total_duration = 0.0
+        self.next_run = None
+
+    def record(self, result, started, duration):
+        self.cycles += 1
+        if result != os.EX_OK:
+            self.failures += 1
+        self.last_result = result
+        self.last_started = started
+        self.last_duration = duration
+        self.total_duration += duration
+
+    def as_dict(self):
+        return {
+            'feed_type': self.feed_type,
+            'cycles': self.cycles,
+            'failures': self.failures,
+            'last_result': self.last_result,
+            'last_started': self.last_started,
+            'last_duration': self.last_duration,
+            'average_duration': self.total_duration / self.cycles if self.cycles else 0.0,
+            'next_run': self.next_run
+        }
+
+    def __str__(self):
+        average = self.total_duration / self.cycles if self.cycles else 0.0
+        next_run = datetime.fromtimestamp(self.next_run).strftime(LOG_TIME_FORMAT) if self.next_run else "-"
+        return "Feed " + self.feed_type + ": " + str(self.cycles) + " cycles, " + str(self.failures) + \
+               " failed, last result " + str(self.last_result) + ", last " + "%.1f" % self.last_duration + \
+               " s, average " + "%.1f" % average + " s, next run " + next_run
+
+
+class FeedScheduler(object):
+    """
+    Runs the download/publish cycles of several feeds of one system concurrently in one process, each feed on its
+    own thread so a slow or broken feed does not hold up the others. Feeds on the same broker share one RabbitMQ
+    connection and feeds with the same credentials one S3 client. With 'daemon' every feed is polled every
+    'interval' +/- 'jitter' seconds until SIGTERM/SIGINT, otherwise every feed runs a single cycle.
+    SIGUSR1 logs the per-feed scheduling stats. With engine='async' every cycle runs on download_and_publish_async,
+    which opens its own connections, except for the feeds get_feed_engine puts on the blocking engine.
+    """
+
+    def __init__(self, feed_types, config, daemon=False, interval=DAEMON_POLL_INTERVAL, jitter=DAEMON_POLL_JITTER,
+                 engine='blocking'):
+        self.feed_types = feed_types
+        self.config = config
+        self.daemon = daemon
+        self.interval = interval
+        self.jitter = jitter
+        self.engine = engine
+        self.shared = SharedConnections()
+        self.feed_stats = collections.OrderedDict((feed_type, FeedStats(feed_type)) for feed_type in feed_types)
+
+    def stats(self):
+        return [feed_stats.as_dict() for feed_stats in self.feed_stats.values()]
+
+    def log_stats(self, signum=None, frame=None):
+        for feed_stats in self.feed_stats.values():
+            logger.info(str(feed_stats))
+        for limit in rate_limits.registry:
+            logger.info(str(limit))
+
+    def wait(self, connections, delay):
+        deadline = time.monotonic() + delay
+        while not shutdown_event.is_set():
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            shutdown_event.wait(min(remaining, KEEP_ALIVE_INTERVAL))
+            connections.keep_alive()
+
+    def run_feed(self, feed_type):
+        feed_stats = self.feed_stats[feed_type]
+        connections = FeedConnections(feed_type, self.config, self.shared)
+        engine = get_feed_engine(feed_type, self.config, self.engine)
+
+        try:
+            while not shutdown_event.is_set():
+                started = time.time()
+                try:
+                    with pipeline_trace.span('cycle', 'feed', feed=feed_type):
+                        if engine == 'async':
+                            result = download_and_publish_async(feed_type, self.config)
+                        else:
+                            result = download_and_publish(feed_type, self.config, connections)
+                except Exception as e:
+                    # keep the other feeds and the next cycles of this one going
+                    result = os.EX_SOFTWARE
+                    message = "Feed " + feed_type + " cycle failed. " + str(e)
+                    logger.exception(message)
+                feed_stats.record(result, started, time.time() - started)
+
+                if not self.daemon:
+                    break
+
+                delay = max(0.0, self.interval + random.uniform(-self.jitter, self.jitter))
+                feed_stats.next_run = time.time() + delay
+                logger.info(str(feed_stats))
+
+                self.wait(connections, delay)
+        finally:
+            connections.close()
+
+    def run(self):
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, handle_shutdown_signal)
+            signal.signal(signal.SIGINT, handle_shutdown_signal)
+            if hasattr(signal, 'SIGUSR1'):
+                signal.signal(signal.SIGUSR1, self.log_stats)
+
+        workers = []
+        for feed_type in self.feed_types:
+            worker = threading.Thread(target=self.run_feed, args=(feed_type,), name=feed_type)
+            worker.start()
+            workers.append(worker)
+
+        try:
+            # join with a timeout so the signal handlers keep running on the main thread
+            for worker in workers:
+                while worker.is_alive():
+                    worker.join(1.0)
+        finally:
+            self.shared.close()
+
+        self.log_stats()
+
+        failed = [feed_stats for feed_stats in self.feed_stats.values() if feed_stats.last_result != os.EX_OK]
+        return failed[0].last_result if failed else os.EX_OK
+
+
+def get_feed_types(system_config):
+    # every entry with an sftp_server section is a feed, 's3' holds the shared S3 credentials
+    return [feed_type for feed_type, feed_config in system_config.items()
+            if isinstance(feed_config, dict) and 'sftp_server' in feed_config]
+
+
+def run_daemon(feed_type, config, interval, jitter, engine='blocking'):
+    # replaces the supervisor restart loop: connections stay open and the feed is polled every
+    # 'interval' +/- 'jitter' seconds until SIGTERM/SIGINT
+    return FeedScheduler([feed_type], config, daemon=True, interval=interval, jitter=jitter, engine=engine).run()
+
+
+def finish_run(args, result, profiles=None):
+    # hands the queued error messages to RabbitMQ (or the spill file), then writes the metrics JSON, the trace
+    # and the cProfile dump asked for on the command line
+    error_reports.close()
+    if error_reports.sent or error_reports.merged or error_reports.spilled:
+        message = "Error messages: " + str(error_reports.sent) + " sent, " + str(error_reports.merged) + \
+                  " merged into repeat counts, " + str(error_reports.spilled) + " spilled to " + ERROR_SPILL_FILE
         logger.info(message)
-        mq_connection.close()
 
+    reports = [(args.metricsFile, pipeline_metrics.registry.dump_json),
+               (args.profile, pipeline_trace.tracer.write)]
+    if profiles:
+        reports.append((args.cprofile, profiles.write))
+
+    for report_file, write in reports:
+        if not report_file:
+            continue
+        try:
+            write(report_file)
+            message = "Run report written to " + report_file
+            logger.info(message)
+        except (OSError, ValueError) as e:
+            message = "Run report could not be written to " + report_file + ". " + str(e)
+            logger.error(message)
     return result
 
 
+def read_config(filename):
+    # the systems ('dev', 'production'), each with its feeds and the shared 's3' credentials
+    with open(filename) as json_data_file:
+        return json.load(json_data_file)
+
+
 def main(argv):
     program_name = os.path.basename(argv[0])
     message = program_name + " starts."
@@ -473,17 +2170,76 @@ def main(argv):
 
     parser.add_argument('-s', dest='devORproduction', required=True, action='store', choices=['dev', 'production'],
                         help='Specify which system (dev or production) to download EDI files from')
-    parser.add_argument('-t', dest='ediFeedType', required=True, action='store', help='Specify which kind of EDI feed to download')
+    parser.add_argument('-t', dest='ediFeedType', action='store', help='Specify which kind of EDI feed to download')
+    parser.add_argument('-c', dest='configFile', default=CONFIG_FILE,
+                        help='JSON configuration of the dev and production systems (default: %(default)s)')
+    parser.add_argument('--all-feeds', dest='allFeeds', action='store_true',
+                        help='Download every EDI feed of the system concurrently in this one process')
+    parser.add_argument('--daemon', dest='daemon', action='store_true',
+                        help='Keep running and poll for new files instead of doing a single pass')
+    parser.add_argument('--interval', dest='interval', type=float, default=DAEMON_POLL_INTERVAL,
+                        help='Seconds between two polls in daemon mode')
+    parser.add_argument('--jitter', dest='jitter', type=float, default=DAEMON_POLL_JITTER,
+                        help='Maximum random number of seconds added to or taken off the poll interval')
+    parser.add_argument('--metrics-port', dest='metricsPort', type=int,
+                        help='Serve the pipeline metrics in the Prometheus text format on this local port')
+    parser.add_argument('--metrics-file', dest='metricsFile',
+                        help='Write the pipeline metrics to this JSON file when the run ends')
+    parser.add_argument('--profile', dest='profile', nargs='?', const=TRACE_FILE,
+                        help='Record a span per file and stage and write them as a Chrome trace (Perfetto) JSON file')
+    parser.add_argument('--cprofile', dest='cprofile',
+                        help='Also profile every thread with cProfile and write the merged pstats to this file')
+    parser.add_argument('--engine', dest='engine', choices=['blocking', 'async'], default='blocking',
+                        help='Transfer files with blocking threads, or concurrently on an asyncio event loop '
+                             '(needs asyncssh, aiobotocore and aio-pika)')
+
+    args = parser.parse_args(argv[1:])
+    if not args.ediFeedType and not args.allFeeds:
+        parser.error("one of -t or --all-feeds is required")
 
-    args = parser.parse_args()
     system = args.devORproduction
-    system_config = CONFIG_DATA[system]
+    try:
+        system_config = read_config(args.configFile)[system]
+    except (OSError, ValueError, KeyError) as e:
+        message = "The configuration of system " + system + " could not be read from " + args.configFile + ". " + \
+                  str(e)
+        logger.error(message)
+        return os.EX_CONFIG
+
+    if args.metricsPort:
+        pipeline_metrics.start_metrics_server(args.metricsPort)
+        message = "Metrics are served on port " + str(args.metricsPort)
+        logger.info(message)
+
+    if args.profile:
+        pipeline_trace.tracer.start()
+    profiles = None
+    if args.cprofile:
+        profiles = pipeline_trace.ThreadProfiles()
+        profiles.start()
+
+    if args.allFeeds:
+        feed_types = get_feed_types(system_config)
+        message = "system: " + system + ", feed types: " + str(feed_types)
+        logger.info(message)
+
+        return finish_run(args, FeedScheduler(feed_types, system_config, daemon=args.daemon, interval=args.interval,
+                                              jitter=args.jitter, engine=args.engine).run(), profiles)
 
     if args.ediFeedType in [*system_config]:
         message = "system: " + system + ", feed type: " + args.ediFeedType
         logger.info(message)
 
-        return download_and_publish(args.ediFeedType, system_config)
+        if args.daemon:
+            return finish_run(args, run_daemon(args.ediFeedType, system_config, args.interval, args.jitter,
+                                               args.engine), profiles)
+
+        with pipeline_trace.span('cycle', 'feed', feed=args.ediFeedType):
+            if get_feed_engine(args.ediFeedType, system_config, args.engine) == 'async':
+                result = download_and_publish_async(args.ediFeedType, system_config)
+            else:
+                result = download_and_publish(args.ediFeedType, system_config)
+        return finish_run(args, result, profiles)
     else:
         message = "'" + args.ediFeedType + "'" + " is not one of the supported EDI feed types: " + str([*system_config])
         logger.error(message)
@@ -0,0 +1,226 @@
+import json
+import logging
+import os
+import queue
+import re
+import threading
+import time
+
+# error messages waiting for the sender, past this the caller spills them to the file itself
+ERROR_QUEUE_SIZE = 10000
+# identical errors within this many seconds are sent once, followed by one message with the repeat count
+DEDUPE_WINDOW = 60
+# seconds between two attempts to reach a broker that is down, and to replay the spill file
+RETRY_INTERVAL = 30
+# seconds the sender waits for new errors before it flushes the repeat counts and services its connections
+SENDER_TICK = 1.0
+
+# get_log_time() prefix of the error messages, left out when comparing them
+LOG_TIME_PREFIX = re.compile(r'^\[[^\]]*\]\[[A-Z]+\] ')
+
+logger = logging.getLogger(__name__)
+
+
+class ErrorReporter(object):
+    """
+    Sends error messages to RabbitMQ from a background thread, so reporting an error never holds up a transfer.
+    report() only puts the message on a bounded queue. The sender publishes it over its own connection to the
+    feed's broker; repeats of the same error within DEDUPE_WINDOW seconds are merged into one message with a
+    count. While a broker cannot be reached, its errors are appended to 'spill_file' (JSON lines) and replayed
+    once it is back. Subclasses provide the broker connection: connect(), broker_key() and send().
+    """
+
+    def __init__(self, spill_file, queue_size=ERROR_QUEUE_SIZE, dedupe_window=DEDUPE_WINDOW,
+                 retry_interval=RETRY_INTERVAL):
+        self.spill_file = spill_file
+        self.dedupe_window = dedupe_window
+        self.retry_interval = retry_interval
+        self.errors = queue.Queue(queue_size)
+        self.spill_lock = threading.Lock()
+        self.start_lock = threading.Lock()
+        self.thread = None
+        self.stopping = threading.Event()
+        # feed type: config, registered by the feeds so spilled errors can be replayed
+        self.configs = {}
+        # broker key: open connection, and when a broker that is down may be tried again
+        self.connections = {}
+        self.retry_at = {}
+        # (feed type, exchange, routing key, message without its time): [first seen, repeats, message]
+        self.recent = {}
+        self.next_replay = 0.0
+        self.sent = 0
+        self.merged = 0
+        self.spilled = 0
+
+    def connect(self, feed_type, config):
+        raise NotImplementedError
+
+    def broker_key(self, feed_type, config):
+        raise NotImplementedError
+
+    def send(self, connection, exchange, routing_key, message):
+        # publishes one message, raises on failure
+        raise NotImplementedError
+
+    def register(self, feed_type, config):
+        self.configs[feed_type] = config
+        self.start()
+
+    def start(self):
+        with self.start_lock:
+            if self.thread is None:
+                self.stopping.clear()
+                self.thread = threading.Thread(target=self.run, name='error-reporter', daemon=True)
+                self.thread.start()
+
+    def report(self, feed_type, exchange, routing_key, message):
+        # never blocks: with the queue full the message goes straight to the spill file
+        self.start()
+        try:
+            self.errors.put_nowait((feed_type, exchange, routing_key, message))
+        except queue.Full:
+            self.spill([(feed_type, exchange, routing_key, message)])
+
+    def run(self):
+        while not (self.stopping.is_set() and self.errors.empty()):
+            try:
+                error = self.errors.get(timeout=SENDER_TICK)
+            except queue.Empty:
+                error = None
+            if error is not None:
+                self.handle(*error)
+            self.flush_repeats()
+            if time.monotonic() >= self.next_replay:
+                self.next_replay = time.monotonic() + self.retry_interval
+                self.replay()
+            self.keep_alive()
+        self.flush_repeats(force=True)
+        self.close_connections()
+
+    def handle(self, feed_type, exchange, routing_key, message):
+        key = (feed_type, exchange, routing_key, LOG_TIME_PREFIX.sub('', message))
+        now = time.monotonic()
+        seen = self.recent.get(key)
+        if seen is not None and now - seen[0] < self.dedupe_window:
+            seen[1] += 1
+            self.merged += 1
+            return
+        self.recent[key] = [now, 0, message]
+        self.deliver(feed_type, exchange, routing_key, message)
+
+    def flush_repeats(self, force=False):
+        now = time.monotonic()
+        for key, (first_seen, repeats, message) in list(self.recent.items()):
+            if force or now - first_seen >= self.dedupe_window:
+                del self.recent[key]
+                if repeats:
+                    feed_type, exchange, routing_key = key[:3]
+                    self.deliver(feed_type, exchange, routing_key, message + " (repeated " + str(repeats) +
+                                 " more times within " + str(self.dedupe_window) + " s)")
+
+    def get_connection(self, feed_type):
+        config = self.configs.get(feed_type)
+        if config is None:
+            return None
+        key = self.broker_key(feed_type, config)
+        connection = self.connections.get(key)
+        if connection is not None and connection.is_open:
+            return connection
+        self.connections.pop(key, None)
+        if time.monotonic() < self.retry_at.get(key, 0):
+            # still down, no point in waiting for another connection timeout
+            return None
+        connection = self.connect(feed_type, config)
+        if connection is None:
+            self.retry_at[key] = time.monotonic() + self.retry_interval
+            return None
+        self.connections[key] = connection
+        return connection
+
+    def deliver(self, feed_type, exchange, routing_key, message):
+        connection = self.get_connection(feed_type)
+        if connection is not None:
+            try:
+                self.send(connection, exchange, routing_key, message)
+                self.sent += 1
+                return True
+            except Exception as e:
+                logger.warning("Error message could not be sent to RabbitMQ. " + str(e))
+                self.drop_connection(feed_type)
+        self.spill([(feed_type, exchange, routing_key, message)])
+        return False
+
+    def drop_connection(self, feed_type):
+        key = self.broker_key(feed_type, self.configs[feed_type])
+        connection = self.connections.pop(key, None)
+        self.retry_at[key] = time.monotonic() + self.retry_interval
+        if connection is not None:
+            try:
+                connection.close()
+            except Exception:
+                pass
+
+    def spill(self, errors):
+        with self.spill_lock:
+            with open(self.spill_file, 'a') as f:
+                for feed_type, exchange, routing_key, message in errors:
+                    f.write(json.dumps({'feed_type': feed_type, 'exchange': exchange, 'routing_key': routing_key,
+                                        'message': message}) + "\n")
+            self.spilled += len(errors)
+
+    def replay(self):
+        # the spill file is moved aside first, whatever still cannot be sent is spilled again
+        replaying = self.spill_file + '.replay'
+        if not (os.path.exists(self.spill_file) or os.path.exists(replaying)):
+            return
+        if not any(self.get_connection(feed_type) is not None for feed_type in list(self.configs)):
+            # every broker is still down
+            return
+        with self.spill_lock:
+            if not os.path.exists(replaying):
+                if not os.path.exists(self.spill_file):
+                    return
+                os.replace(self.spill_file, replaying)
+
+        with open(replaying) as f:
+            for line in f:
+                try:
+                    error = json.loads(line)
+                except ValueError:
+                    continue
+                self.deliver(error['feed_type'], error['exchange'], error['routing_key'], error['message'])
+        os.remove(replaying)
+
+    def keep_alive(self):
+        for key, connection in list(self.connections.items()):
+            try:
+                connection.process_data_events(time_limit=0)
+            except Exception:
+                self.connections.pop(key, None)
+
+    def close_connections(self):
+        for connection in self.connections.values():
+            try:
+                connection.close()
+            except Exception:
+                pass
+        self.connections = {}
+
+    def close(self, timeout=10.0):
+        # the sender gets 'timeout' seconds to deliver what is queued, whatever is left after that is spilled
+        with self.start_lock:
+            thread = self.thread
+            self.thread = None
+        if thread is None:
+            return
+        self.stopping.set()
+        thread.join(timeout)
+        if thread.is_alive():
+            leftover = []
+            while True:
+                try:
+                    leftover.append(self.errors.get_nowait())
+                except queue.Empty:
+                    break
+            if leftover:
+                self.spill(leftover)
@@ -0,0 +1,144 @@
+import collections
+import hashlib
+import io
+import os
+import time
+
+# archives a batch can be packed into: an uncompressed tar or zip, or the files one after the other, each followed
+# by a newline. Members are never compressed, so the offsets of the batch's index address them in the object.
+BATCH_FORMATS = ('tar', 'zip', 'lines')
+
+# files smaller than BATCH_THRESHOLD are batched, a batch is uploaded and published once it holds BATCH_MAX_FILES
+# files or BATCH_MAX_BYTES bytes, or its oldest file is BATCH_MAX_AGE seconds old. The index of a batch travels
+# in its message's headers, which have to fit in one AMQP frame (128 KB by default): that caps BATCH_MAX_FILES.
+BATCH_THRESHOLD = 4 * 1024
+BATCH_MAX_FILES = 500
+BATCH_MAX_BYTES = 8 * 1024 * 1024
+BATCH_MAX_AGE = 60
+
+# a file waiting in an open batch
+BatchMember = collections.namedtuple('BatchMember', ('filename', 'st_size', 'st_mtime', 'content_md5'))
+
+
+class FileBatch(object):
+    """
+    Files of one S3 date prefix waiting to be packed together. pack() reads them from download_dir into one
+    archive in memory and names it after its MD5, so packing the same files again gives the same S3 key.
+    """
+
+    def __init__(self, batch_format, date_prefix):
+        self.format = batch_format
+        self.date_prefix = date_prefix
+        self.members = []
+        self.bytes = 0
+        self.oldest = None
+        self.name = None
+        self.body = None
+        # per member: name, offset and size of its bytes in the archive, and its MD5
+        self.index = []
+        self.content_md5 = None
+
+    def __len__(self):
+        return len(self.members)
+
+    def add(self, member):
+        self.members.append(member)
+        self.bytes += member.st_size
+        self.oldest = member.st_mtime if self.oldest is None else min(self.oldest, member.st_mtime)
+
+    def pack(self, download_dir):
+        # tarfile and zipfile are only imported once a batch is packed, they slow the downloader's start-up
+        import tarfile
+        import zipfile
+
+        buffer = io.BytesIO()
+        if self.format == 'tar':
+            archive = tarfile.open(fileobj=buffer, mode='w')
+        elif self.format == 'zip':
+            archive = zipfile.ZipFile(buffer, 'w', zipfile.ZIP_STORED)
+        else:
+            archive = None
+
+        for member in self.members:
+            with open(os.path.join(download_dir, member.filename), 'rb') as f:
+                data = f.read()
+            if self.format == 'tar':
+                info = tarfile.TarInfo(member.filename)
+                info.size = len(data)
+                info.mtime = member.st_mtime
+                archive.addfile(info, io.BytesIO(data))
+                # the data ends the archive so far, padded to the 512 byte tar block
+                offset = archive.offset - (len(data) + tarfile.BLOCKSIZE - 1) // tarfile.BLOCKSIZE * tarfile.BLOCKSIZE
+            elif self.format == 'zip':
+                archive.writestr(zipfile.ZipInfo(member.filename, time.localtime(member.st_mtime)[:6]), data)
+                offset = buffer.tell() - len(data)
+            else:
+                offset = buffer.tell()
+                buffer.write(data)
+                buffer.write(b'\n')
+            self.index.append({'name': member.filename, 'offset': offset, 'size': len(data),
+                               'md5': member.content_md5})
+
+        if archive is not None:
+            archive.close()
+        self.body = buffer.getvalue()
+        content_hash = hashlib.md5(self.body)
+        self.content_md5 = content_hash.hexdigest()
+        self.name = 'batch-' + self.content_md5 + '.' + ('txt' if self.format == 'lines' else self.format)
+        return self
+
+
+class FileBatcher(object):
+    """
+    The open batches of a feed, one per S3 date prefix, from the 'batch_format', 'batch_threshold',
+    'batch_max_files', 'batch_max_bytes' and 'batch_max_age' of its ftp_client config. add() and due() hand
+    back the batches ready to be packed, flush() all of them.
+    """
+
+    def __init__(self, batch_format='tar', threshold=BATCH_THRESHOLD, max_files=BATCH_MAX_FILES,
+                 max_bytes=BATCH_MAX_BYTES, max_age=BATCH_MAX_AGE):
+        if batch_format not in BATCH_FORMATS:
+            raise ValueError("unknown batch_format '" + str(batch_format) + "', expected one of " +
+                             str(list(BATCH_FORMATS)))
+        self.format = batch_format
+        self.threshold = threshold
+        self.max_files = max_files
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        # date prefix: FileBatch
+        self.batches = collections.OrderedDict()
+
+    def accepts(self, file_size):
+        return file_size < self.threshold
+
+    def add(self, member, date_prefix):
+        batch = self.batches.get(date_prefix)
+        if batch is None:
+            batch = self.batches[date_prefix] = FileBatch(self.format, date_prefix)
+        batch.add(member)
+        if len(batch) >= self.max_files or batch.bytes >= self.max_bytes:
+            return self.batches.pop(date_prefix)
+        return None
+
+    def due(self, now=None):
+        # a file's age is that of its copy in download_dir, so files left by an earlier run count from then
+        now = time.time() if now is None else now
+        return [self.batches.pop(date_prefix) for date_prefix, batch in list(self.batches.items())
+                if now - batch.oldest >= self.max_age]
+
+    def flush(self):
+        batches = list(self.batches.values())
+        self.batches.clear()
+        return batches
+
+
+def get_file_batcher(feed_type, config):
+    # opt-in per feed with 'batch_format' in ftp_client
+    ftp_client = config[feed_type]['ftp_client']
+    if not ftp_client.get('batch_format'):
+        return None
+
+    return FileBatcher(ftp_client['batch_format'], int(ftp_client.get('batch_threshold', BATCH_THRESHOLD)),
+                       int(ftp_client.get('batch_max_files', BATCH_MAX_FILES)),
+                       int(ftp_client.get('batch_max_bytes', BATCH_MAX_BYTES)),
+                       float(ftp_client.get('batch_max_age', BATCH_MAX_AGE)))
@@ -0,0 +1,240 @@
+import bisect
+import collections
+import json
+import os
+import threading
+
+# stages a file goes through: SFTP download (or straight SFTP-to-S3 stream), S3 upload, RabbitMQ publish
+# and delete from download_dir. 'duplicate' counts the files whose upload was saved because their content was
+# already in S3.
+STAGES = ('sftp_get', 's3_stream', 's3_upload', 'duplicate', 'mq_publish', 'delete')
+
+# upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0,
+                   10.0, 30.0, 60.0, 120.0)
+
+
+class Histogram(object):
+
+    def __init__(self, bounds=LATENCY_BUCKETS):
+        self.bounds = bounds
+        # the last bucket is +Inf
+        self.counts = [0] * (len(bounds) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def cumulative(self):
+        total = 0
+        buckets = []
+        for bound, count in zip(self.bounds + (float('inf'),), self.counts):
+            total += count
+            buckets.append((bound, total))
+        return buckets
+
+    def quantile(self, q):
+        # estimate, interpolated within the bucket the quantile falls into
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        lower = 0.0
+        seen = 0
+        for bound, count in zip(self.bounds, self.counts):
+            if count and seen + count >= rank:
+                return lower + (bound - lower) * (rank - seen) / count
+            seen += count
+            lower = bound
+        return self.bounds[-1]
+
+    def as_dict(self):
+        return {
+            'count': self.count,
+            'sum': self.sum,
+            'p50': self.quantile(0.5),
+            'p99': self.quantile(0.99),
+            'buckets': collections.OrderedDict(('+Inf' if bound == float('inf') else str(bound), count)
+                                               for bound, count in self.cumulative())
+        }
+
+
+class FeedMetrics(object):
+    """
+    Counters of one feed. record() is all the transfer loop pays for, a lock and a few additions. The publish
+    queue depth, the reconnect counts and the download_dir backlog are only read when the metrics are.
+    """
+
+    def __init__(self, feed_type):
+        self.feed_type = feed_type
+        self.lock = threading.Lock()
+        self.files = dict((stage, 0) for stage in STAGES)
+        self.bytes = dict((stage, 0) for stage in STAGES)
+        self.latency = dict((stage, Histogram()) for stage in STAGES)
+        self.publish_queue = None
+        self.reconnects = {}
+        self.download_dir = None
+
+    def record(self, stage, files, nbytes, seconds):
+        with self.lock:
+            self.files[stage] += files
+            self.bytes[stage] += nbytes
+            self.latency[stage].observe(seconds)
+
+    def get_backlog(self):
+        # files waiting in download_dir, partial downloads included
+        files = 0
+        nbytes = 0
+        if self.download_dir and os.path.isdir(self.download_dir):
+            for entry in os.scandir(self.download_dir):
+                if entry.is_file():
+                    files += 1
+                    nbytes += entry.stat().st_size
+        return files, nbytes
+
+    def as_dict(self):
+        backlog_files, backlog_bytes = self.get_backlog()
+        with self.lock:
+            return {
+                'stages': collections.OrderedDict((stage, {'files': self.files[stage], 'bytes': self.bytes[stage],
+                                                           'latency': self.latency[stage].as_dict()})
+                                                  for stage in STAGES),
+                'queue_depth': len(self.publish_queue) if self.publish_queue is not None else 0,
+                'reconnects': dict(self.reconnects),
+                'backlog_files': backlog_files,
+                'backlog_bytes': backlog_bytes
+            }
+
+
+class NullFeedMetrics(object):
+    # stands in for FeedMetrics when metrics are disabled
+
+    publish_queue = None
+    reconnects = {}
+    download_dir = None
+
+    def record(self, stage, files, nbytes, seconds):
+        pass
+
+
+class MetricsRegistry(object):
+    """
+    FeedMetrics of every feed of the process, rendered in the Prometheus text format or as JSON. 'limits' is
+    the RateLimits of the servers and buckets the feeds transfer to, rendered along with them when set.
+    """
+
+    def __init__(self):
+        self.enabled = True
+        self.lock = threading.Lock()
+        self.feeds = collections.OrderedDict()
+        self.limits = None
+
+    def feed(self, feed_type):
+        if not self.enabled:
+            return NullFeedMetrics()
+        with self.lock:
+            feed_metrics = self.feeds.get(feed_type)
+            if feed_metrics is None:
+                feed_metrics = self.feeds[feed_type] = FeedMetrics(feed_type)
+        return feed_metrics
+
+    def as_dict(self):
+        with self.lock:
+            feeds = list(self.feeds.values())
+        return collections.OrderedDict((feed_metrics.feed_type, feed_metrics.as_dict()) for feed_metrics in feeds)
+
+    def render_prometheus(self):
+        feeds = self.as_dict()
+        lines = []
+
+        def metric(name, metric_type, help_text, samples):
+            lines.append("# HELP " + name + " " + help_text)
+            lines.append("# TYPE " + name + " " + metric_type)
+            for labels, value in samples:
+                label_text = ",".join('%s="%s"' % (key, value) for key, value in labels)
+                lines.append(name + "{" + label_text + "} " + repr(value))
+
+        metric('edi_stage_files_total', 'counter', 'Files through each stage of the pipeline',
+               [((('feed', feed), ('stage', stage)), values['files'])
+                for feed, data in feeds.items() for stage, values in data['stages'].items()])
+        metric('edi_stage_bytes_total', 'counter', 'Bytes through each stage of the pipeline',
+               [((('feed', feed), ('stage', stage)), values['bytes'])
+                for feed, data in feeds.items() for stage, values in data['stages'].items()])
+
+        lines.append("# HELP edi_stage_latency_seconds Time spent per file (per batch for mq_publish) in each stage")
+        lines.append("# TYPE edi_stage_latency_seconds histogram")
+        for feed, data in feeds.items():
+            for stage, values in data['stages'].items():
+                labels = 'feed="%s",stage="%s"' % (feed, stage)
+                latency = values['latency']
+                for bound, count in latency['buckets'].items():
+                    lines.append('edi_stage_latency_seconds_bucket{%s,le="%s"} %d' % (labels, bound, count))
+                lines.append('edi_stage_latency_seconds_sum{%s} %r' % (labels, latency['sum']))
+                lines.append('edi_stage_latency_seconds_count{%s} %d' % (labels, latency['count']))
+
+        metric('edi_publish_queue_depth', 'gauge', 'Files downloaded and waiting to be uploaded and published',
+               [((('feed', feed),), data['queue_depth']) for feed, data in feeds.items()])
+        metric('edi_reconnects_total', 'counter', 'Connections found broken and opened again',
+               [((('feed', feed), ('connection', connection)), count)
+                for feed, data in feeds.items() for connection, count in sorted(data['reconnects'].items())])
+        metric('edi_download_dir_backlog_files', 'gauge', 'Files in download_dir',
+               [((('feed', feed),), data['backlog_files']) for feed, data in feeds.items()])
+        metric('edi_download_dir_backlog_bytes', 'gauge', 'Bytes in download_dir',
+               [((('feed', feed),), data['backlog_bytes']) for feed, data in feeds.items()])
+
+        limits = self.limits.as_dict() if self.limits is not None else {}
+        metric('edi_rate_limit_bytes_per_second', 'gauge', 'Byte rate limit of each server and bucket, 0 for none',
+               [((('limit', name),), data['rate_limit']) for name, data in limits.items()])
+        metric('edi_rate_bytes_per_second', 'gauge', 'Bytes per second to each server and bucket lately',
+               [((('limit', name),), data['rate']) for name, data in limits.items()])
+        metric('edi_rate_limit_wait_seconds_total', 'counter', 'Time transfers waited for the byte rate limit',
+               [((('limit', name),), data['waited_seconds']) for name, data in limits.items()])
+        metric('edi_concurrency_in_use', 'gauge', 'Transfers in progress to each server and bucket',
+               [((('limit', name),), data['in_use']) for name, data in limits.items()])
+        metric('edi_concurrency_limit', 'gauge', 'Transfers the adaptive limit currently allows at once',
+               [((('limit', name),), data['concurrency_limit']) for name, data in limits.items()
+                if 'concurrency_limit' in data])
+
+        return "\n".join(lines) + "\n"
+
+    def dump_json(self, path):
+        # the feeds under 'feeds', any name is a valid feed type, and the limits under 'rate_limits' when set
+        data = collections.OrderedDict([('feeds', self.as_dict())])
+        if self.limits is not None:
+            data['rate_limits'] = self.limits.as_dict()
+        with open(path, 'w') as f:
+            json.dump(data, f, indent=2)
+
+
+# the metrics of every feed of this process
+registry = MetricsRegistry()
+
+
+def start_metrics_server(port, host='127.0.0.1'):
+    # Prometheus endpoint on a local port, served from a daemon thread. http.server is only loaded when the
+    # endpoint is asked for, it costs more start-up time than the rest of the downloader's own modules
+    import http.server
+
+    class MetricsRequestHandler(http.server.BaseHTTPRequestHandler):
+
+        def do_GET(self):
+            if self.path.split('?')[0] not in ('/', '/metrics'):
+                self.send_error(404)
+                return
+            body = registry.render_prometheus().encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            # scrapes are not worth a line each on stderr
+            pass
+
+    server = http.server.ThreadingHTTPServer((host, port), MetricsRequestHandler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name='metrics', daemon=True).start()
+    return server
@@ -0,0 +1,125 @@
+import json
+import os
+import threading
+import time
+
+
+class Span(object):
+
+    def __init__(self, tracer, name, cat, args):
+        self.tracer = tracer
+        self.name = name
+        self.cat = cat
+        self.args = args
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is not None:
+            self.args['error'] = str(exc_value)
+        self.tracer.add(self.name, self.cat, self.start, time.perf_counter(), self.args)
+        return False
+
+
+class NullSpan(object):
+    # what span() hands out while tracing is off
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+NULL_SPAN = NullSpan()
+
+
+class Tracer(object):
+    """
+    Spans of one run in the Chrome trace event format, which chrome://tracing and ui.perfetto.dev open: one
+    complete event per file per stage and per connection set-up, on the thread that did the work.
+    """
+
+    def __init__(self):
+        self.enabled = False
+        self.events = []
+        self.thread_names = {}
+        self.pid = os.getpid()
+        self.started = time.perf_counter()
+
+    def start(self):
+        self.events = []
+        self.thread_names = {}
+        self.started = time.perf_counter()
+        self.enabled = True
+
+    def span(self, name, cat, **args):
+        if not self.enabled:
+            return NULL_SPAN
+        return Span(self, name, cat, args)
+
+    def add(self, name, cat, start, end, args):
+        thread = threading.current_thread()
+        self.thread_names[thread.ident] = thread.name
+        # list.append is atomic, spans come from every feed, session and upload worker thread
+        self.events.append({'name': name, 'cat': cat, 'ph': 'X', 'pid': self.pid, 'tid': thread.ident,
+                            'ts': (start - self.started) * 1000000, 'dur': (end - start) * 1000000,
+                            'args': args})
+
+    def write(self, path):
+        metadata = [{'name': 'thread_name', 'ph': 'M', 'pid': self.pid, 'tid': tid, 'args': {'name': name}}
+                    for tid, name in self.thread_names.items()]
+        with open(path, 'w') as f:
+            json.dump({'traceEvents': metadata + self.events, 'displayTimeUnit': 'ms'}, f)
+
+
+# the trace of this process, off unless --profile is given
+tracer = Tracer()
+
+
+def span(name, cat, **args):
+    return tracer.span(name, cat, **args)
+
+
+class ThreadProfiles(object):
+    """
+    cProfile only sees the thread it is enabled on. Every thread started after start() gets its own profile,
+    write() merges them all into one pstats dump, it raises ValueError when no thread recorded anything.
+    """
+
+    def __init__(self):
+        self.profiles = []
+        self.lock = threading.Lock()
+
+    def start(self):
+        threading.setprofile(self.start_thread_profile)
+        self.start_thread_profile()
+
+    def start_thread_profile(self, *args):
+        # runs as the new thread's first profile hook, enabling the profile replaces the hook
+        import cProfile
+
+        profile = cProfile.Profile()
+        with self.lock:
+            self.profiles.append(profile)
+        profile.enable()
+
+    def write(self, path):
+        import pstats
+
+        threading.setprofile(None)
+        with self.lock:
+            profiles = list(self.profiles)
+        recorded = []
+        for profile in profiles:
+            profile.create_stats()
+            if profile.stats:
+                recorded.append(profile)
+        if not recorded:
+            # pstats cannot build, or read back, a dump without any
+            raise ValueError("no thread recorded a profile")
+        stats = pstats.Stats(*recorded)
+        stats.dump_stats(path)
@@ -0,0 +1,305 @@
+import collections
+import threading
+import time
+
+# seconds of transfers the current rate of a limit is measured over
+RATE_WINDOW = 10.0
+# the adaptive controller looks at the throughput of windows of at least this many seconds
+ADAPTIVE_WINDOW = 2.0
+# throughput a window must gain over the one before for the controller to keep adding transfers
+ADAPTIVE_GAIN = 0.05
+# a window whose median transfer time is this many times that of the window before counts as a latency spike
+LATENCY_FACTOR = 3.0
+# windows the controller holds its limit for after an increase that did not pay off, before it probes again
+HOLD_WINDOWS = 5
+# windows without errors after which the controller tries again the limit that last failed
+PROBE_WINDOWS = 30
+
+
+class TokenBucket(object):
+    """
+    Byte rate limit shared by every thread (or task) transferring to one server or bucket: 'rate' bytes per
+    second, in bursts of up to 'burst' bytes, 0 means no limit. reserve() takes the tokens for a block and
+    returns the seconds to wait before sending it, tokens can go into debt so the waits of concurrent callers
+    queue up behind each other. The bytes of every call are counted for the current rate either way.
+    """
+
+    def __init__(self, rate=0, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or max(self.rate, 64 * 1024))
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+        self.bytes = 0
+        self.waited = 0.0
+        # (time, bytes) of the last RATE_WINDOW seconds
+        self.recent = collections.deque()
+
+    def reserve(self, nbytes):
+        with self.lock:
+            now = time.monotonic()
+            self.bytes += nbytes
+            self.recent.append((now, nbytes))
+            while self.recent[0][0] < now - RATE_WINDOW:
+                self.recent.popleft()
+            if not self.rate:
+                return 0.0
+
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= nbytes
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0.0
+            self.waited += delay
+            return delay
+
+    def take(self, nbytes):
+        delay = self.reserve(nbytes)
+        if delay:
+            time.sleep(delay)
+
+    def current_rate(self):
+        with self.lock:
+            cutoff = time.monotonic() - RATE_WINDOW
+            return sum(nbytes for when, nbytes in self.recent if when >= cutoff) / RATE_WINDOW
+
+
+class AIMDController(object):
+    """
+    Number of transfers allowed at once to one server or bucket, between 'minimum' and 'maximum'. It starts at
+    'minimum' and, every window of ADAPTIVE_WINDOW seconds, adds one while the throughput keeps improving by
+    ADAPTIVE_GAIN. An increase that did not pay off is taken back and the limit held for HOLD_WINDOWS windows.
+    A failed transfer, or a window whose median transfer time is LATENCY_FACTOR times the previous window's,
+    halves the limit, at most once per window. The limit then grows back to one below where it failed, and only
+    tries that again after PROBE_WINDOWS windows without errors.
+    """
+
+    def __init__(self, minimum=1, maximum=8, window=ADAPTIVE_WINDOW):
+        self.minimum = max(1, minimum)
+        self.maximum = max(self.minimum, maximum)
+        self.limit = self.minimum
+        self.window = window
+        self.condition = threading.Condition()
+        self.in_use = 0
+        self.increases = 0
+        self.decreases = 0
+        self.throughput = 0.0
+        self._start_window(time.monotonic())
+        # throughput of the window before the last increase, median transfer time of the last window
+        self.previous_throughput = None
+        self.previous_median = None
+        self.hold = 0
+        # the limit stays below ceiling until PROBE_WINDOWS windows have gone by without errors
+        self.ceiling = self.maximum
+        self.clean_windows = 0
+
+    def _start_window(self, now):
+        self.window_started = now
+        self.window_bytes = 0
+        self.window_seconds = []
+        self.window_decreased = False
+
+    def acquire(self, timeout=None):
+        # False when no transfer could start within timeout
+        with self.condition:
+            if not self.condition.wait_for(lambda: self.in_use < self.limit, timeout):
+                return False
+            self.in_use += 1
+            return True
+
+    def release(self, error, nbytes, seconds):
+        # nbytes None frees the slot without counting a transfer
+        with self.condition:
+            self.in_use -= 1
+            now = time.monotonic()
+            if error:
+                self._decrease()
+            elif nbytes is not None:
+                self.window_bytes += nbytes
+                self.window_seconds.append(seconds)
+                if now - self.window_started >= self.window and len(self.window_seconds) >= self.limit:
+                    self._end_window(now)
+            self.condition.notify_all()
+
+    def _decrease(self):
+        if self.window_decreased:
+            return
+        limit = max(self.minimum, int(self.limit * 0.5))
+        if limit < self.limit:
+            self.decreases += 1
+        self.ceiling = max(self.minimum, self.limit - 1)
+        self.clean_windows = 0
+        self.limit = limit
+        self.previous_throughput = None
+        self.window_decreased = True
+
+    def _end_window(self, now):
+        self.throughput = self.window_bytes / (now - self.window_started)
+        median = sorted(self.window_seconds)[len(self.window_seconds) // 2]
+        decreased = self.window_decreased
+        self._start_window(now)
+
+        previous_median = self.previous_median
+        self.previous_median = median
+        if decreased:
+            return
+        if previous_median is not None and median > previous_median * LATENCY_FACTOR:
+            self._decrease()
+            return
+        self.clean_windows += 1
+        if self.clean_windows >= PROBE_WINDOWS:
+            self.ceiling = self.maximum
+
+        improved = self.previous_throughput is None or \
+            self.throughput >= self.previous_throughput * (1 + ADAPTIVE_GAIN)
+        if self.hold:
+            self.hold -= 1
+        elif not improved:
+            # the last increase did not pay off
+            self.limit = max(self.minimum, self.limit - 1)
+            self.previous_throughput = None
+            self.hold = HOLD_WINDOWS
+        elif self.limit < self.ceiling:
+            self.previous_throughput = self.throughput
+            self.limit += 1
+            self.increases += 1
+
+
+class RateLimit(object):
+    """
+    The TokenBucket and, when adaptive, the AIMDController of one server or bucket. Without a controller
+    acquire() never waits, the number of transfers is then whatever the feeds are configured for. 'sessions'
+    counts the connections open to a server, open_session() keeps them within the adaptive limit as well, so
+    the connections left idle by a decrease are closed before new ones are opened.
+    """
+
+    def __init__(self, name, rate=0, burst=None, controller=None):
+        self.name = name
+        self.bucket = TokenBucket(rate, burst)
+        self.controller = controller
+        self.lock = threading.Lock()
+        self.in_use = 0
+        self.errors = 0
+        self.sessions = 0
+
+    def open_session(self, force=False):
+        # False when the connection must not be opened yet
+        with self.lock:
+            if not force and self.controller and self.sessions >= self.controller.limit:
+                return False
+            self.sessions += 1
+            return True
+
+    def close_session(self):
+        with self.lock:
+            self.sessions -= 1
+
+    def acquire(self, timeout=None):
+        # the start time of the transfer, None when the controller let none start within timeout
+        if self.controller and not self.controller.acquire(timeout):
+            return None
+        with self.lock:
+            self.in_use += 1
+        return time.monotonic()
+
+    def release(self, started, error=False, nbytes=None):
+        with self.lock:
+            self.in_use -= 1
+            if error:
+                self.errors += 1
+        if self.controller:
+            self.controller.release(error, nbytes, time.monotonic() - started)
+
+    @property
+    def limited(self):
+        return bool(self.bucket.rate)
+
+    def take(self, nbytes):
+        self.bucket.take(nbytes)
+
+    def reserve(self, nbytes):
+        return self.bucket.reserve(nbytes)
+
+    def as_dict(self):
+        data = collections.OrderedDict([
+            ('rate_limit', self.bucket.rate),
+            ('burst', self.bucket.burst),
+            ('rate', self.bucket.current_rate()),
+            ('bytes', self.bucket.bytes),
+            ('waited_seconds', self.bucket.waited),
+            ('in_use', self.in_use),
+            ('sessions', self.sessions),
+            ('errors', self.errors)
+        ])
+        if self.controller:
+            data['concurrency_limit'] = self.controller.limit
+            data['concurrency_min'] = self.controller.minimum
+            data['concurrency_max'] = self.controller.maximum
+            data['throughput'] = self.controller.throughput
+            data['increases'] = self.controller.increases
+            data['decreases'] = self.controller.decreases
+        return data
+
+    def __str__(self):
+        text = "Limit " + self.name + ": " + "%.1f" % (self.bucket.current_rate() / 1024) + " KB/s of " + \
+               ("%.1f KB/s" % (self.bucket.rate / 1024) if self.bucket.rate else "unlimited") + ", " + \
+               str(self.in_use) + " transfers"
+        if self.controller:
+            text += " of " + str(self.controller.limit) + " allowed (" + str(self.controller.minimum) + "-" + \
+                    str(self.controller.maximum) + ")"
+        return text + ", " + str(self.errors) + " errors, " + "%.1f" % self.bucket.waited + " s throttled"
+
+
+class RateLimits(object):
+    """
+    The RateLimit of every SFTP server and S3 bucket of the process, shared by all the feeds using it. A limit is
+    set up by the config of the first feed that uses it.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.limits = collections.OrderedDict()
+
+    def get(self, name, settings, concurrency):
+        # 'max_bytes_per_second', 'burst_bytes' and, with 'adaptive', 'min_concurrency' to concurrency
+        with self.lock:
+            limit = self.limits.get(name)
+            if limit is None:
+                controller = None
+                if settings.get('adaptive'):
+                    controller = AIMDController(int(settings.get('min_concurrency', 1)), concurrency,
+                                                float(settings.get('adaptive_window', ADAPTIVE_WINDOW)))
+                limit = self.limits[name] = RateLimit(name, float(settings.get('max_bytes_per_second', 0)),
+                                                      settings.get('burst_bytes'), controller)
+        return limit
+
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.limits.values()))
+
+    def as_dict(self):
+        return collections.OrderedDict((limit.name, limit.as_dict()) for limit in self)
+
+
+# the limits of every server and bucket of this process
+registry = RateLimits()
+
+
+def get_sftp_limit(sftp_dict):
+    # the sftp_server config: 'max_bytes_per_second', 'burst_bytes', and 'adaptive_sessions' to let the
+    # controller pick between 'min_sessions' and 'sessions'
+    settings = {
+        'max_bytes_per_second': sftp_dict.get('max_bytes_per_second', 0),
+        'burst_bytes': sftp_dict.get('burst_bytes'),
+        'adaptive': sftp_dict.get('adaptive_sessions'),
+        'min_concurrency': sftp_dict.get('min_sessions', 1),
+        'adaptive_window': sftp_dict.get('adaptive_window', ADAPTIVE_WINDOW)
+    }
+    return registry.get('sftp:' + str(sftp_dict['host']) + ':' + str(sftp_dict['port']), settings,
+                        int(sftp_dict.get('sessions', 1)))
+
+
+def get_bucket_limit(s3_bucket, s3_config, upload_workers):
+    # 'bucket_limits' of the s3 config, by bucket name: 'max_bytes_per_second', 'burst_bytes', and 'adaptive'
+    # to let the controller pick between 'min_concurrency' and 'max_concurrency' (upload_workers by default)
+    settings = s3_config.get('bucket_limits', {}).get(s3_bucket, {})
+    return registry.get('s3:' + s3_bucket, settings, int(settings.get('max_concurrency', upload_workers)))
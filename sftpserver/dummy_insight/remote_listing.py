@@ -0,0 +1,80 @@
+import json
+import os
+import stat
+
+# a file is downloaded once its size and mtime have been the same in this many consecutive listings,
+# 1 downloads every file the first time it is listed
+STABLE_POLLS = 1
+
+
+class ListingCache(object):
+    """
+    (size, mtime) of every file of a feed's remote directory as of the last listing, with the number of
+    consecutive listings it has kept them in and whether the file is done (downloaded, or found published in
+    the transfer manifest). select() turns a listdir_attr() result into the files to download: regular files
+    that are not done and have kept their size for 'stable_polls' listings, so an upload still being written
+    by the partner is left alone. Files no longer listed are forgotten. With 'path' the cache is saved there
+    after every cycle, so single runs started by the supervisor see the previous run's listing.
+    """
+
+    def __init__(self, stable_polls=STABLE_POLLS, path=None):
+        self.stable_polls = max(1, stable_polls)
+        self.path = path
+        # file name: [size, mtime, consecutive listings, done]
+        self.files = {}
+        self.waiting = 0
+        self.skipped = 0
+        if path and os.path.exists(path):
+            try:
+                with open(path) as f:
+                    self.files = json.load(f)
+            except ValueError:
+                # a damaged cache only costs one listing's worth of stability counts
+                self.files = {}
+
+    def select(self, entries):
+        files = {}
+        selected = []
+        self.waiting = 0
+        self.skipped = 0
+        for entry in entries:
+            if entry.st_mode is not None and not stat.S_ISREG(entry.st_mode):
+                # directories, links and other special entries are never downloaded
+                continue
+            cached = self.files.get(entry.filename)
+            if cached and cached[0] == entry.st_size and cached[1] == entry.st_mtime:
+                cached[2] += 1
+            else:
+                cached = [entry.st_size, entry.st_mtime, 1, False]
+            files[entry.filename] = cached
+            if cached[3]:
+                self.skipped += 1
+            elif cached[2] < self.stable_polls:
+                self.waiting += 1
+            else:
+                selected.append(entry)
+        self.files = files
+        return selected
+
+    def mark_done(self, filename):
+        cached = self.files.get(filename)
+        if cached:
+            cached[3] = True
+
+    def save(self):
+        if not self.path:
+            return
+        partial_path = self.path + '.part'
+        with open(partial_path, 'w') as f:
+            json.dump(self.files, f, separators=(',', ':'))
+        os.replace(partial_path, self.path)
+
+
+def open_listing_cache(feed_type, config, home, default_path):
+    # 'stable_polls' and 'listing_cache_file' in ftp_client, relative paths are under the home directory
+    # like download_dir
+    ftp_client = config[feed_type]['ftp_client']
+    path = os.path.join(home, ftp_client.get('listing_cache_file', default_path))
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    return ListingCache(int(ftp_client.get('stable_polls', STABLE_POLLS)), path)
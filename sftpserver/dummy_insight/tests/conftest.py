@@ -0,0 +1,7 @@
+import os
+import sys
+
+# the tests import the downloader's modules the way the benchmarks do, and use the benchmarks' stand-ins
+DUMMY_INSIGHT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, os.path.join(DUMMY_INSIGHT_DIR, 'benchmarks'))
+sys.path.insert(0, DUMMY_INSIGHT_DIR)
@@ -0,0 +1,103 @@
+import asyncio
+import hashlib
+import os
+import random
+
+import pytest
+
+import async_engine
+import standins
+
+FEED_TYPE = 'test'
+BUCKET = 'edi-benchmark'
+PART_SIZE = 64 * 1024
+
+
+@pytest.fixture
+def feed(tmp_path):
+    remote_root = tmp_path / 'remote'
+    download_dir = tmp_path / 'download'
+    remote_root.mkdir()
+    download_dir.mkdir()
+    config = standins.make_feed_config(FEED_TYPE, str(download_dir), async_block_size=10000)
+    return config, str(remote_root), str(download_dir)
+
+
+def write_file(directory, name, size):
+    body = os.urandom(size)
+    with open(os.path.join(directory, name), 'wb') as f:
+        f.write(body)
+    return body
+
+
+def run_cycle(config, remote_root, download_dir, on_downloaded=None):
+    multipart = {'threshold': PART_SIZE, 'part_size': PART_SIZE, 'concurrency': 2}
+    cycle = async_engine.AsyncFeedCycle(FEED_TYPE, config, download_dir, multipart, on_downloaded=on_downloaded,
+                                        report_error=lambda message: None)
+    s3client = standins.AsyncFakeS3Client()
+    publisher = standins.AsyncFakeMQPublisher()
+    result = asyncio.run(cycle.run(standins.AsyncFakeSFTPClient(remote_root), s3client, publisher))
+    return result, s3client, publisher
+
+
+def test_part_hashes_match_the_parts():
+    body = os.urandom(5 * PART_SIZE + 123)
+    for seed in range(20):
+        rng = random.Random(seed)
+        part_hashes = []
+        position = 0
+        while position < len(body):
+            block = body[position:position + rng.randint(1, 3 * PART_SIZE)]
+            async_engine.update_part_hashes(part_hashes, PART_SIZE, position, block)
+            position += len(block)
+        assert [part_hash.hexdigest() for part_hash in part_hashes] == \
+            [hashlib.md5(body[offset:offset + PART_SIZE]).hexdigest() for offset in range(0, len(body), PART_SIZE)]
+
+
+@pytest.mark.parametrize('size', [1000, 3 * PART_SIZE + 17])
+def test_uploaded_with_the_md5_taken_while_downloading(feed, size):
+    config, remote_root, download_dir = feed
+    body = write_file(remote_root, 'EDI.edi', size)
+
+    result, s3client, publisher = run_cycle(config, remote_root, download_dir)
+
+    assert result
+    (file, headers), = publisher.published
+    assert headers['data.md5'] == hashlib.md5(body).hexdigest()
+    assert s3client.objects[(BUCKET, headers['data.s3keyprefix'] + file)] == body
+    assert os.listdir(download_dir) == []
+
+
+@pytest.mark.parametrize('size', [1000, 3 * PART_SIZE + 17])
+def test_corrupted_local_copy_is_not_uploaded(feed, size):
+    config, remote_root, download_dir = feed
+    write_file(remote_root, 'EDI.edi', size)
+
+    def on_downloaded(entry):
+        # the copy in download_dir changes between the download and the upload
+        with open(os.path.join(download_dir, entry.filename), 'r+b') as f:
+            f.seek(size - 1)
+            last = f.read(1)
+            f.seek(size - 1)
+            f.write(bytes([last[0] ^ 0xff]))
+
+    result, s3client, publisher = run_cycle(config, remote_root, download_dir, on_downloaded)
+
+    assert not result
+    assert publisher.published == []
+    assert s3client.objects == {}
+    assert os.listdir(download_dir) == ['EDI.edi']
+
+
+@pytest.mark.parametrize('setting, value', [('strict_order', True), ('content_index_file', 'index.db'),
+                                            ('batch_format', 'tar'), ('transfer_mode', 'stream')])
+def test_unsupported_settings_fall_back_to_blocking(feed, setting, value):
+    import dummydownloader
+
+    config, remote_root, download_dir = feed
+    assert dummydownloader.get_feed_engine(FEED_TYPE, config, 'async') == 'async'
+
+    config[FEED_TYPE]['ftp_client'][setting] = value
+    assert async_engine.get_unsupported_settings(FEED_TYPE, config) == [setting]
+    assert dummydownloader.get_feed_engine(FEED_TYPE, config, 'async') == 'blocking'
+    assert dummydownloader.get_feed_engine(FEED_TYPE, config, 'blocking') == 'blocking'
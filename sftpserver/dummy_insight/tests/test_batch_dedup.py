@@ -0,0 +1,86 @@
+import hashlib
+import os
+import sqlite3
+
+import pytest
+
+import content_index
+import standins
+
+FEED_TYPE = 'test'
+BUCKET = 'edi-benchmark'
+
+
+def write_files(directory, names):
+    # files of distinct content, small enough to be batched
+    for i, name in enumerate(names):
+        with open(os.path.join(directory, name), 'wb') as f:
+            f.write(('%s %08d ' % (name, i)).encode() + os.urandom(200))
+
+
+def test_index_without_batch_offset_is_upgraded(tmp_path):
+    path = str(tmp_path / 'index.db')
+    db = sqlite3.connect(path)
+    db.execute("CREATE TABLE contents (md5 BLOB NOT NULL, size INTEGER NOT NULL, s3_key TEXT NOT NULL, "
+               "updated REAL NOT NULL, PRIMARY KEY (md5, size)) WITHOUT ROWID")
+    db.execute("INSERT INTO contents VALUES (?, 10, '2020/01/01/EDI.edi', 0)", (bytes(16),))
+    db.commit()
+    db.close()
+
+    index = content_index.ContentIndex(path, retention_days=0)
+    assert index.get('00' * 16, 10) == ('2020/01/01/EDI.edi', None)
+    index.add('11' * 16, 20, '2020/01/01/batch-1.tar', 512)
+    assert index.get('11' * 16, 20) == ('2020/01/01/batch-1.tar', 512)
+    index.close()
+
+
+@pytest.mark.parametrize('batch_format', ['tar', 'zip', 'lines'])
+def test_duplicate_of_batched_file_points_into_the_batch(tmp_path, batch_format):
+    # publish_to_rabbitmq builds its message properties with pika
+    pytest.importorskip('pika')
+    import dummydownloader
+
+    download_dir = str(tmp_path / 'download')
+    os.mkdir(download_dir)
+    config = standins.make_feed_config(FEED_TYPE, download_dir, batch_format=batch_format, duplicates='pointer',
+                                       content_index_file=str(tmp_path / 'index.db'))
+    s3client = standins.FakeS3Client()
+    mq_connection = standins.FakeMQConnection()
+    dummydownloader.feed_context.mq_connection = mq_connection
+    index = content_index.open_content_index(FEED_TYPE, config, '/')
+
+    def run_cycle(names):
+        publish_queue = dummydownloader.PublishQueue(mq_connection, s3client, FEED_TYPE, config, index=index)
+        try:
+            for name in names:
+                publish_queue.put(name)
+            assert publish_queue.drain()
+        finally:
+            publish_queue.close()
+
+    originals = ['EDI_%08d.edi' % i for i in range(5)]
+    write_files(download_dir, originals)
+    contents = {}
+    for name in originals:
+        with open(os.path.join(download_dir, name), 'rb') as f:
+            contents[name] = f.read()
+    run_cycle(originals)
+    assert len(s3client.objects) == 1
+
+    # the partner sends the same files again under new names
+    resent = ['RESEND_%08d.edi' % i for i in range(5)]
+    for original, name in zip(originals, resent):
+        with open(os.path.join(download_dir, name), 'wb') as f:
+            f.write(contents[original])
+    requests = s3client.request_count
+    run_cycle(resent)
+
+    assert s3client.request_count == requests
+    assert os.listdir(download_dir) == []
+    headers = dict((message[2], message[3].headers) for message in mq_connection.published)
+    for original, name in zip(originals, resent):
+        body = s3client.objects[(BUCKET, headers[name]['data.s3key'])]
+        offset = headers[name]['data.s3offset']
+        assert body[offset:offset + headers[name]['data.size']] == contents[original]
+        assert headers[name]['data.md5'] == hashlib.md5(contents[original]).hexdigest()
+    index.close()
@@ -0,0 +1,55 @@
+import pytest
+
+import content_index
+import dummydownloader
+import standins
+import transfer_manifest
+
+FEED_TYPE = 'test'
+
+
+class FakeConnections(object):
+    # the FeedConnections of a daemon cycle, kept open by the caller
+
+    def __init__(self):
+        self.mq_connection = standins.FakeMQConnection()
+        self.s3client = standins.FakeS3Client()
+
+    def get_mq_connection(self):
+        return self.mq_connection
+
+    def get_s3_client(self):
+        return self.s3client
+
+    def get_sftp_connection(self):
+        raise AssertionError("no download after a failed start-up scan")
+
+
+def closing(monkeypatch, cls, closed):
+    close = cls.close
+
+    def record_close(self):
+        closed.append(cls.__name__)
+        close(self)
+
+    monkeypatch.setattr(cls, 'close', record_close)
+
+
+def test_cycle_that_raises_closes_the_queue_manifest_and_index(tmp_path, monkeypatch):
+    config = standins.make_feed_config(FEED_TYPE, str(tmp_path / 'download'),
+                                       manifest_file=str(tmp_path / 'manifest.db'),
+                                       content_index_file=str(tmp_path / 'index.db'))
+    closed = []
+    for cls in (dummydownloader.PublishQueue, transfer_manifest.TransferManifest, content_index.ContentIndex):
+        closing(monkeypatch, cls, closed)
+
+    def publish_files(mq_connection, s3client, feed_type, config, publish_queue=None):
+        raise RuntimeError("simulated failure of the start-up scan")
+
+    monkeypatch.setattr(dummydownloader, 'publish_files', publish_files)
+    # no error reporter thread, it would replay the spill file of earlier runs to a real broker
+    monkeypatch.setattr(dummydownloader.error_reports, 'register', lambda feed_type, config: None)
+
+    with pytest.raises(RuntimeError):
+        dummydownloader.download_and_publish(FEED_TYPE, config, FakeConnections())
+    assert sorted(closed) == ['ContentIndex', 'PublishQueue', 'TransferManifest']
@@ -0,0 +1,90 @@
+import hashlib
+import io
+import os
+import tarfile
+import zipfile
+
+import pytest
+
+import file_batches
+
+
+def add_files(batch, download_dir, sizes):
+    contents = {}
+    for i, size in enumerate(sizes):
+        name = 'EDI_%08d.edi' % i
+        contents[name] = os.urandom(size)
+        with open(os.path.join(download_dir, name), 'wb') as f:
+            f.write(contents[name])
+        batch.add(file_batches.BatchMember(name, size, 1600000000 + i, hashlib.md5(contents[name]).hexdigest()))
+    return contents
+
+
+@pytest.mark.parametrize('batch_format', file_batches.BATCH_FORMATS)
+def test_pack_offsets_address_the_members(tmp_path, batch_format):
+    batch = file_batches.FileBatch(batch_format, '2020/09/13/')
+    contents = add_files(batch, str(tmp_path), [0, 1, 511, 512, 513, 3000, 4095])
+
+    batch.pack(str(tmp_path))
+
+    assert [member['name'] for member in batch.index] == sorted(contents)
+    for member in batch.index:
+        assert batch.body[member['offset']:member['offset'] + member['size']] == contents[member['name']]
+        assert member['md5'] == hashlib.md5(contents[member['name']]).hexdigest()
+    assert batch.content_md5 == hashlib.md5(batch.body).hexdigest()
+    assert batch.name == 'batch-' + batch.content_md5 + '.' + ('txt' if batch_format == 'lines' else batch_format)
+
+
+def read_archive(batch_format, body):
+    if batch_format == 'tar':
+        with tarfile.open(fileobj=io.BytesIO(body)) as archive:
+            return dict((info.name, archive.extractfile(info).read()) for info in archive.getmembers())
+    with zipfile.ZipFile(io.BytesIO(body)) as archive:
+        return dict((name, archive.read(name)) for name in archive.namelist())
+
+
+@pytest.mark.parametrize('batch_format', ['tar', 'zip'])
+def test_packed_archives_can_be_read(tmp_path, batch_format):
+    batch = file_batches.FileBatch(batch_format, '2020/09/13/')
+    contents = add_files(batch, str(tmp_path), [10, 700, 2000])
+    assert read_archive(batch_format, batch.pack(str(tmp_path)).body) == contents
+
+
+def test_packing_the_same_files_again_gives_the_same_name(tmp_path):
+    first = file_batches.FileBatch('tar', '2020/09/13/')
+    add_files(first, str(tmp_path), [100, 200])
+    second = file_batches.FileBatch('tar', '2020/09/13/')
+    for member in first.members:
+        second.add(member)
+    assert first.pack(str(tmp_path)).name == second.pack(str(tmp_path)).name
+
+
+def member(name, size, mtime):
+    return file_batches.BatchMember(name, size, mtime, None)
+
+
+def test_batcher_hands_back_full_and_old_batches():
+    batcher = file_batches.FileBatcher('lines', threshold=100, max_files=3, max_bytes=1000, max_age=60)
+    assert batcher.accepts(99)
+    assert not batcher.accepts(100)
+
+    assert batcher.add(member('a', 10, 1000), '2020/09/13/') is None
+    assert batcher.add(member('b', 10, 1010), '2020/09/14/') is None
+    assert batcher.add(member('c', 10, 1020), '2020/09/13/') is None
+    full = batcher.add(member('d', 10, 1030), '2020/09/13/')
+    assert [m.filename for m in full.members] == ['a', 'c', 'd']
+
+    # by bytes as well as by files
+    assert batcher.add(member('e', 999, 1040), '2020/09/13/') is None
+    assert [m.filename for m in batcher.add(member('f', 1, 1050), '2020/09/13/').members] == ['e', 'f']
+
+    assert batcher.due(now=1069) == []
+    assert [m.filename for batch in batcher.due(now=1070) for m in batch.members] == ['b']
+    batcher.add(member('g', 10, 1080), '2020/09/13/')
+    assert [m.filename for batch in batcher.flush() for m in batch.members] == ['g']
+    assert batcher.flush() == []
+
+
+def test_unknown_format_is_refused():
+    with pytest.raises(ValueError):
+        file_batches.FileBatcher('rar')
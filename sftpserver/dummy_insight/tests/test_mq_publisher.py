@@ -0,0 +1,70 @@
+import dummydownloader
+import standins
+
+
+def publish(mq_publisher, item):
+    mq_publisher.publish('edi', 'direct', 'test', item, None, item)
+
+
+def test_batch_is_due_when_full():
+    mq_connection = standins.FakeMQConnection()
+    mq_publisher = dummydownloader.MQPublisher(mq_connection, batch_size=3, batch_ms=60000)
+    assert not mq_publisher.batch_due()
+    publish(mq_publisher, 'A.edi')
+    publish(mq_publisher, 'B.edi')
+    assert not mq_publisher.batch_due()
+    publish(mq_publisher, 'C.edi')
+    assert mq_publisher.batch_due()
+
+    assert mq_publisher.flush() == ['A.edi', 'B.edi', 'C.edi']
+    assert [message[2] for message in mq_connection.published] == ['A.edi', 'B.edi', 'C.edi']
+    assert not mq_publisher.batch_due()
+    assert mq_publisher.flush() == []
+
+
+def test_batch_is_due_when_old_enough():
+    mq_publisher = dummydownloader.MQPublisher(standins.FakeMQConnection(), batch_size=100, batch_ms=200)
+    publish(mq_publisher, 'A.edi')
+    assert not mq_publisher.batch_due()
+    # the age of a batch is that of its first message
+    mq_publisher.batch_started -= 0.2
+    publish(mq_publisher, 'B.edi')
+    assert mq_publisher.batch_due()
+
+
+def test_nothing_is_confirmed_before_the_commit():
+    mq_connection = standins.FakeMQConnection()
+    mq_publisher = dummydownloader.MQPublisher(mq_connection, batch_size=2)
+    publish(mq_publisher, 'A.edi')
+    assert mq_connection.published == []
+    assert mq_publisher.flush() == ['A.edi']
+    assert len(mq_connection.published) == 1
+
+
+def test_channel_and_exchange_are_set_up_once():
+    mq_connection = standins.FakeMQConnection()
+    mq_publisher = dummydownloader.MQPublisher(mq_connection, batch_size=10)
+    for item in ('A.edi', 'B.edi', 'C.edi'):
+        publish(mq_publisher, item)
+    mq_publisher.flush()
+    # channel, tx_select, exchange_declare and one commit
+    assert mq_connection.round_trips == 4
+
+
+def test_closed_channel_drops_the_uncommitted_batch():
+    mq_publisher = dummydownloader.MQPublisher(standins.FakeMQConnection(), batch_size=10)
+    publish(mq_publisher, 'A.edi')
+    mq_publisher.channel.close()
+    # rolled back by the broker with its channel, the file is published again by the next run
+    publish(mq_publisher, 'B.edi')
+    assert mq_publisher.flush() == ['B.edi']
+
+
+def test_batch_keys_of_the_config():
+    config = standins.make_feed_config('test', '/tmp')
+    mq_publisher = dummydownloader.get_mq_publisher(standins.FakeMQConnection(), 'test', config)
+    assert (mq_publisher.batch_size, mq_publisher.batch_ms) == (dummydownloader.MQ_PUBLISH_BATCH_SIZE,
+                                                                dummydownloader.MQ_PUBLISH_BATCH_MS)
+    config['test']['rabbitmq'].update(publish_batch_size=7, publish_batch_ms=30)
+    mq_publisher = dummydownloader.get_mq_publisher(standins.FakeMQConnection(), 'test', config)
+    assert (mq_publisher.batch_size, mq_publisher.batch_ms) == (7, 30)
@@ -0,0 +1,88 @@
+import json
+import logging
+import sys
+import timeit
+import types
+
+import pytest
+
+import pipeline_metrics
+import rate_limits
+
+# the budget of bench_metrics.py, the loop with metrics may be this many percent slower
+MAX_OVERHEAD = 5.0
+
+
+def test_histogram_buckets_and_quantiles():
+    histogram = pipeline_metrics.Histogram((0.1, 1.0, 10.0))
+    for value in (0.05, 0.1, 0.5, 0.5, 20.0):
+        histogram.observe(value)
+    assert histogram.cumulative() == [(0.1, 2), (1.0, 4), (10.0, 4), (float('inf'), 5)]
+    assert histogram.count == 5
+    assert histogram.quantile(0.5) == pytest.approx(0.1 + 0.9 * 0.25)
+    assert histogram.quantile(1.0) == 10.0
+    assert pipeline_metrics.Histogram().quantile(0.5) == 0.0
+
+
+def test_disabled_registry_records_nothing():
+    registry = pipeline_metrics.MetricsRegistry()
+    registry.enabled = False
+    registry.feed('feed').record('sftp_get', 1, 100, 0.01)
+    assert registry.as_dict() == {}
+    registry.enabled = True
+    registry.feed('feed').record('sftp_get', 1, 100, 0.01)
+    assert registry.as_dict()['feed']['stages']['sftp_get']['files'] == 1
+    assert 'edi_stage_files_total{feed="feed",stage="sftp_get"} 1' in registry.render_prometheus()
+
+
+def test_json_dump_keeps_feeds_apart_from_the_rate_limits(tmp_path):
+    registry = pipeline_metrics.MetricsRegistry()
+    registry.feed('rate_limits').record('sftp_get', 1, 100, 0.01)
+    path = str(tmp_path / 'metrics.json')
+    registry.dump_json(path)
+    with open(path) as f:
+        assert list(json.load(f)) == ['feeds']
+
+    registry.limits = rate_limits.RateLimits()
+    registry.limits.get('sftp:partner:22', {'max_bytes_per_second': 1024}, 4)
+    registry.dump_json(path)
+    with open(path) as f:
+        data = json.load(f)
+    assert data['feeds']['rate_limits']['stages']['sftp_get']['files'] == 1
+    assert data['rate_limits']['sftp:partner:22']['rate_limit'] == 1024
+
+
+def test_recording_overhead(monkeypatch):
+    # what the transfer loop pays for the metrics of a file, one record() per stage, against the time the same
+    # loop takes per file with metrics disabled, the fastest of a few rounds of each
+    import bench_metrics
+    import dummydownloader
+    import standins
+
+    # the loop publishes through a FakeMQConnection, BasicProperties is all it needs of pika
+    pika = types.ModuleType('pika')
+    pika.BasicProperties = standins.FakeBasicProperties
+    monkeypatch.setitem(sys.modules, 'pika', pika)
+
+    dummydownloader.console.setLevel(logging.WARNING)
+    files = 300
+    best = None
+    try:
+        pipeline_metrics.registry.enabled = False
+        for _ in range(3):
+            result, elapsed = bench_metrics.run_pipeline(files, 1024, 0.0)
+            assert result
+            best = elapsed if best is None else min(best, elapsed)
+    finally:
+        pipeline_metrics.registry.enabled = True
+
+    feed_metrics = pipeline_metrics.FeedMetrics('feed')
+    stages = ('sftp_get', 's3_upload', 'mq_publish', 'delete')
+
+    def record_file():
+        for stage in stages:
+            feed_metrics.record(stage, 1, 1024, 0.001)
+
+    record_seconds = min(timeit.repeat(record_file, number=files, repeat=5))
+    overhead = record_seconds / best * 100
+    assert overhead < MAX_OVERHEAD, "metrics cost %.2f%% of the transfer loop" % overhead
@@ -0,0 +1,30 @@
+import pstats
+import threading
+
+import pytest
+
+import pipeline_trace
+
+
+def test_profiles_of_every_thread_are_merged(tmp_path):
+    def work():
+        sum(range(1000))
+
+    profiles = pipeline_trace.ThreadProfiles()
+    profiles.start()
+    thread = threading.Thread(target=work)
+    thread.start()
+    thread.join()
+    work()
+    path = str(tmp_path / 'run.prof')
+    profiles.write(path)
+    assert [name for _, _, name in pstats.Stats(path).stats].count('work') == 1
+    assert len(profiles.profiles) == 2
+
+
+def test_nothing_recorded(tmp_path):
+    profiles = pipeline_trace.ThreadProfiles()
+    path = tmp_path / 'run.prof'
+    with pytest.raises(ValueError):
+        profiles.write(str(path))
+    assert not path.exists()
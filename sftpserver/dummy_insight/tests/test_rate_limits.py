@@ -0,0 +1,165 @@
+import pytest
+
+import rate_limits
+
+
+class FakeTime(object):
+    # the clock of rate_limits, moved by the tests and by sleep()
+
+    def __init__(self):
+        self.now = 1000.0
+        self.slept = 0.0
+
+    def monotonic(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.slept += seconds
+        self.now += seconds
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeTime()
+    monkeypatch.setattr(rate_limits, 'time', clock)
+    return clock
+
+
+def test_unlimited_bucket_never_waits(clock):
+    bucket = rate_limits.TokenBucket()
+    assert bucket.reserve(10 ** 9) == 0.0
+    assert bucket.bytes == 10 ** 9
+
+
+def test_bucket_waits_for_its_bytes(clock):
+    bucket = rate_limits.TokenBucket(rate=1000, burst=500)
+    assert bucket.reserve(500) == 0.0
+    # in debt, concurrent callers queue up behind each other
+    assert bucket.reserve(1000) == pytest.approx(1.0)
+    assert bucket.reserve(500) == pytest.approx(1.5)
+    clock.now += 1.5
+    assert bucket.reserve(0) == 0.0
+    # the tokens never go above the burst
+    clock.now += 100
+    assert bucket.reserve(600) == pytest.approx(0.1)
+    assert bucket.waited == pytest.approx(2.6)
+
+
+def test_bucket_keeps_to_its_rate(clock):
+    bucket = rate_limits.TokenBucket(rate=64 * 1024)
+    for _ in range(100):
+        bucket.take(16 * 1024)
+    # the burst goes at once, the rest at the rate
+    assert clock.slept == pytest.approx((100 * 16 * 1024 - bucket.burst) / bucket.rate)
+
+
+def test_current_rate(clock):
+    bucket = rate_limits.TokenBucket()
+    bucket.reserve(1000)
+    clock.now += rate_limits.RATE_WINDOW / 2
+    bucket.reserve(1000)
+    assert bucket.current_rate() == pytest.approx(2000 / rate_limits.RATE_WINDOW)
+    clock.now += rate_limits.RATE_WINDOW / 2 + 0.1
+    bucket.reserve(500)
+    assert bucket.current_rate() == pytest.approx(1500 / rate_limits.RATE_WINDOW)
+
+
+def run_window(controller, clock, rate, seconds=0.1, window=1.0):
+    # 'rate' bytes per second over one window of transfers at the controller's limit
+    transfers = controller.limit
+    for _ in range(transfers):
+        assert controller.acquire(0)
+    clock.now += window
+    for _ in range(transfers):
+        controller.release(False, int(rate * window / transfers), seconds)
+
+
+def test_controller_adds_transfers_while_they_pay_off(clock):
+    controller = rate_limits.AIMDController(1, 8, window=1.0)
+    for limit in range(1, 6):
+        assert controller.limit == limit
+        run_window(controller, clock, rate=limit * 1000.0)
+    assert controller.increases == 5
+
+    # throughput stops growing: the increase is taken back and held
+    run_window(controller, clock, rate=5000.0)
+    assert controller.limit == 5
+    for _ in range(rate_limits.HOLD_WINDOWS):
+        run_window(controller, clock, rate=5000.0)
+        assert controller.limit == 5
+    run_window(controller, clock, rate=5000.0)
+    assert controller.limit == 6
+
+
+def test_controller_halves_on_errors_and_probes_later(clock):
+    controller = rate_limits.AIMDController(1, 8, window=1.0)
+    for limit in range(1, 7):
+        run_window(controller, clock, rate=limit * 1000.0)
+    assert controller.limit == 7
+
+    assert controller.acquire(0)
+    assert controller.acquire(0)
+    controller.release(True, None, 0.1)
+    # at most once per window
+    controller.release(True, None, 0.1)
+    assert controller.limit == 3
+    assert controller.decreases == 1
+    assert controller.ceiling == 6
+
+    # grows back to one below where it failed, the window of the error does not count as one without errors
+    rate = 3000.0
+    limits = []
+    for _ in range(rate_limits.PROBE_WINDOWS):
+        rate *= 2
+        run_window(controller, clock, rate=rate)
+        limits.append(controller.limit)
+    assert limits[-1] == max(limits) == 6
+    for _ in range(2):
+        rate *= 2
+        run_window(controller, clock, rate=rate)
+    assert controller.limit == 8
+
+
+def test_controller_halves_on_a_latency_spike(clock):
+    controller = rate_limits.AIMDController(1, 8, window=1.0)
+    for limit in range(1, 5):
+        run_window(controller, clock, rate=limit * 1000.0)
+    assert controller.limit == 5
+    run_window(controller, clock, rate=6000.0, seconds=0.1 * rate_limits.LATENCY_FACTOR * 2)
+    assert controller.limit == 2
+
+
+def test_controller_stays_within_its_limit(clock):
+    controller = rate_limits.AIMDController(2, 4, window=1.0)
+    assert controller.acquire(0)
+    assert controller.acquire(0)
+    assert not controller.acquire(0)
+    controller.release(False, None, 0.0)
+    assert controller.acquire(0)
+
+
+def test_sessions_are_kept_within_the_adaptive_limit(clock):
+    limit = rate_limits.RateLimit('sftp:test', controller=rate_limits.AIMDController(2, 4))
+    assert limit.open_session()
+    assert limit.open_session()
+    assert not limit.open_session()
+    # the first session of a feed is opened whatever the limit
+    assert limit.open_session(force=True)
+    limit.close_session()
+    limit.close_session()
+    assert limit.open_session()
+
+    started = limit.acquire(0)
+    assert started is not None
+    limit.release(started, error=True)
+    assert (limit.in_use, limit.errors) == (0, 1)
+
+
+def test_registry_shares_the_limit_of_a_server(clock):
+    registry = rate_limits.RateLimits()
+    first = registry.get('sftp:host:22', {'max_bytes_per_second': 1000, 'adaptive': True}, 8)
+    second = registry.get('sftp:host:22', {}, 2)
+    assert first is second
+    assert first.bucket.rate == 1000
+    assert (first.controller.minimum, first.controller.maximum) == (1, 8)
+    assert list(registry) == [first]
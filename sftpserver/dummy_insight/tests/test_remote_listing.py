@@ -0,0 +1,75 @@
+import stat
+
+import remote_listing
+import standins
+
+REGULAR = stat.S_IFREG | 0o644
+DIRECTORY = stat.S_IFDIR | 0o755
+
+
+def entry(name, size=10, mtime=100, mode=REGULAR):
+    return standins.FakeSFTPAttributes(name, size, mtime, mode)
+
+
+def names(entries):
+    return [e.filename for e in entries]
+
+
+def test_files_are_selected_once_they_are_stable():
+    listing = remote_listing.ListingCache(stable_polls=3)
+    assert names(listing.select([entry('A.edi')])) == []
+    assert listing.waiting == 1
+    assert names(listing.select([entry('A.edi')])) == []
+    assert names(listing.select([entry('A.edi')])) == ['A.edi']
+    assert listing.waiting == 0
+
+
+def test_a_file_that_changes_starts_over():
+    listing = remote_listing.ListingCache(stable_polls=2)
+    listing.select([entry('A.edi', size=10)])
+    assert names(listing.select([entry('A.edi', size=20)])) == []
+    assert names(listing.select([entry('A.edi', size=20, mtime=101)])) == []
+    assert names(listing.select([entry('A.edi', size=20, mtime=101)])) == ['A.edi']
+
+
+def test_done_files_are_skipped_until_they_change():
+    listing = remote_listing.ListingCache()
+    assert names(listing.select([entry('A.edi'), entry('B.edi')])) == ['A.edi', 'B.edi']
+    listing.mark_done('A.edi')
+    listing.mark_done('UNLISTED.edi')
+    assert names(listing.select([entry('A.edi'), entry('B.edi')])) == ['B.edi']
+    assert listing.skipped == 1
+    # a new file under the same name
+    assert names(listing.select([entry('A.edi', size=11), entry('B.edi')])) == ['A.edi', 'B.edi']
+
+
+def test_special_entries_and_unlisted_files():
+    listing = remote_listing.ListingCache()
+    selected = listing.select([entry('A.edi'), entry('archive', mode=DIRECTORY), entry('B.edi', mode=None)])
+    assert names(selected) == ['A.edi', 'B.edi']
+    listing.mark_done('A.edi')
+    listing.select([entry('B.edi')])
+    assert sorted(listing.files) == ['B.edi']
+    # forgotten once no longer listed, so listed again it is new
+    assert names(listing.select([entry('A.edi'), entry('B.edi')])) == ['A.edi', 'B.edi']
+
+
+def test_saved_cache_is_loaded_by_the_next_run(tmp_path):
+    path = str(tmp_path / 'listing.json')
+    listing = remote_listing.ListingCache(stable_polls=2, path=path)
+    listing.select([entry('A.edi'), entry('B.edi')])
+    listing.select([entry('A.edi'), entry('B.edi')])
+    listing.mark_done('A.edi')
+    listing.save()
+
+    listing = remote_listing.ListingCache(stable_polls=2, path=path)
+    assert names(listing.select([entry('A.edi'), entry('B.edi'), entry('C.edi')])) == ['B.edi']
+    assert (listing.skipped, listing.waiting) == (1, 1)
+
+
+def test_damaged_cache_starts_empty(tmp_path):
+    path = tmp_path / 'listing.json'
+    path.write_text('{"A.edi": [10, 1')
+    listing = remote_listing.ListingCache(path=str(path))
+    assert listing.files == {}
+    assert names(listing.select([entry('A.edi')])) == ['A.edi']
@@ -0,0 +1,123 @@
+import hashlib
+import os
+import random
+
+import pytest
+
+import dummydownloader
+import standins
+
+SIZE = 256 * 1024
+PART_SIZE = 16 * 1024
+INTERRUPTIONS = 5
+
+
+@pytest.mark.parametrize('seed', range(5))
+@pytest.mark.parametrize('hashed', [False, True])
+def test_download_resumes_from_the_partial_file(tmp_path, seed, hashed):
+    rng = random.Random(seed)
+    content = os.urandom(SIZE)
+    (tmp_path / 'BATCH.edi').write_bytes(content)
+    local_filename = str(tmp_path / 'download' / 'BATCH.edi')
+    os.mkdir(os.path.dirname(local_filename))
+
+    # the connection drops at these offsets of the file, one after the other
+    offsets = sorted(rng.sample(range(1, SIZE), INTERRUPTIONS))
+    sent = 0
+    attempts = 0
+    while True:
+        attempts += 1
+        fail_after = offsets[attempts - 1] - sent if attempts <= INTERRUPTIONS else None
+        sftp = standins.FakeSFTPConnection(str(tmp_path), fail_after_bytes=fail_after)
+        content_hash = dummydownloader.new_content_hash() if hashed else None
+        try:
+            dummydownloader.download_file(sftp, 'BATCH.edi', local_filename, SIZE, SIZE + 1, content_hash)
+            sent += sftp.bytes_sent
+            break
+        except EOFError:
+            sent += sftp.bytes_sent
+            assert sent == offsets[attempts - 1]
+            assert not os.path.exists(local_filename)
+            assert os.path.getsize(local_filename + dummydownloader.PARTIAL_SUFFIX) == sent
+
+    assert attempts == INTERRUPTIONS + 1
+    # every byte crossed the connection once
+    assert sent == SIZE
+    with open(local_filename, 'rb') as f:
+        assert f.read() == content
+    assert not os.path.exists(local_filename + dummydownloader.PARTIAL_SUFFIX)
+    if hashed:
+        assert content_hash.hexdigest() == hashlib.md5(content).hexdigest()
+
+
+def test_partial_file_larger_than_the_remote_file_starts_over(tmp_path):
+    content = os.urandom(SIZE)
+    (tmp_path / 'BATCH.edi').write_bytes(content)
+    os.mkdir(str(tmp_path / 'download'))
+    local_filename = str(tmp_path / 'download' / 'BATCH.edi')
+    with open(local_filename + dummydownloader.PARTIAL_SUFFIX, 'wb') as f:
+        f.write(os.urandom(SIZE + 1))
+
+    sftp = standins.FakeSFTPConnection(str(tmp_path))
+    assert dummydownloader.download_file(sftp, 'BATCH.edi', local_filename, SIZE, SIZE + 1) == SIZE
+    with open(local_filename, 'rb') as f:
+        assert f.read() == content
+
+
+def multipart_config(tmp_path):
+    return {'threshold': 0, 'part_size': PART_SIZE, 'concurrency': 4, 'checkpoint_dir': str(tmp_path / 'checkpoints')}
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_multipart_upload_resumes_from_the_checkpoint(tmp_path, seed):
+    rng = random.Random(seed)
+    content = os.urandom(SIZE + 123)
+    local_filename = str(tmp_path / 'BATCH.edi')
+    with open(local_filename, 'wb') as f:
+        f.write(content)
+    multipart = multipart_config(tmp_path)
+    part_count = (len(content) + PART_SIZE - 1) // PART_SIZE
+
+    s3client = standins.FakeS3Client()
+    attempts = 0
+    while True:
+        attempts += 1
+        if attempts <= INTERRUPTIONS:
+            s3client.fail_at_request = s3client.request_count + rng.randrange(1, part_count + 2)
+        else:
+            s3client.fail_at_request = None
+        try:
+            dummydownloader.upload_file_multipart(s3client, 'edi-benchmark', local_filename, 'BATCH.edi', multipart,
+                                                  hashlib.md5(content).hexdigest())
+            break
+        except ConnectionError:
+            checkpoint = dummydownloader.load_checkpoint(os.path.join(multipart['checkpoint_dir'], 'BATCH.edi.json'))
+            # the upload is continued, its parts in S3 are recorded with their ETags
+            assert checkpoint is None or set(checkpoint['parts']) <= set(str(n) for n in range(1, part_count + 1))
+
+    assert s3client.objects[('edi-benchmark', 'BATCH.edi')] == content
+    # a part that made it to S3 is never sent again
+    assert s3client.bytes_received == len(content)
+    # one upload, created before the first part
+    assert s3client.upload_count == 1
+    assert os.listdir(multipart['checkpoint_dir']) == []
+
+
+def test_changed_file_starts_a_new_multipart_upload(tmp_path):
+    local_filename = str(tmp_path / 'BATCH.edi')
+    with open(local_filename, 'wb') as f:
+        f.write(os.urandom(SIZE))
+    multipart = multipart_config(tmp_path)
+
+    s3client = standins.FakeS3Client(fail_at_request=3)
+    with pytest.raises(ConnectionError):
+        dummydownloader.upload_file_multipart(s3client, 'edi-benchmark', local_filename, 'BATCH.edi', multipart)
+
+    content = os.urandom(SIZE // 2)
+    with open(local_filename, 'wb') as f:
+        f.write(content)
+    s3client.fail_at_request = None
+    dummydownloader.upload_file_multipart(s3client, 'edi-benchmark', local_filename, 'BATCH.edi', multipart)
+
+    assert s3client.objects[('edi-benchmark', 'BATCH.edi')] == content
+    assert s3client.upload_count == 2
@@ -0,0 +1,25 @@
+import subprocess
+import sys
+
+import bench_startup
+
+from conftest import DUMMY_INSIGHT_DIR
+
+
+def test_import_loads_no_lazy_module(tmp_path):
+    # in a process of its own, the tests before this one import some of them; the log file goes to tmp_path
+    script = "import sys; sys.path.insert(0, %r); import dummydownloader; print('\\n'.join(sys.modules))" % \
+             DUMMY_INSIGHT_DIR
+    output = subprocess.check_output([sys.executable, '-c', script], cwd=str(tmp_path), universal_newlines=True)
+    loaded = set(output.split())
+    assert 'dummydownloader' in loaded
+    assert [name for name in bench_startup.LAZY_MODULES if name in loaded] == []
+
+
+def test_startup_runs_load_no_lazy_module():
+    # the command lines of the start-up benchmark, which never get to a transfer
+    for _, arguments in bench_startup.RUNS:
+        _, imports = bench_startup.run_startup(arguments)
+        loaded = set(name for name, _, _, _ in imports)
+        assert 'error_reporter' in loaded
+        assert [name for name in bench_startup.LAZY_MODULES if name in loaded] == []
@@ -0,0 +1,113 @@
+import pytest
+
+# publish_to_rabbitmq builds its message properties with pika
+pytest.importorskip('pika')
+
+import dummydownloader
+import standins
+import transfer_manifest
+
+FEED_TYPE = 'test'
+BUCKET = 'edi-benchmark'
+SIZE = 4096
+
+
+class FailingCommitConnection(standins.FakeMQConnection):
+    # the broker takes the messages but fails the commit of the batch holding them
+
+    def channel(self):
+        channel = super(FailingCommitConnection, self).channel()
+
+        def tx_commit():
+            raise ConnectionError("simulated broker failure on commit")
+
+        channel.tx_commit = tx_commit
+        return channel
+
+
+@pytest.fixture
+def feed(tmp_path):
+    remote_root = tmp_path / 'remote'
+    remote_root.mkdir()
+    config = standins.make_feed_config(FEED_TYPE, str(tmp_path / 'download'), transfer_mode='stream',
+                                       manifest_file=str(tmp_path / 'manifest.db'))
+    (tmp_path / 'download').mkdir()
+    names = standins.write_edi_files(str(remote_root), 3, SIZE)
+    return config, str(remote_root), names
+
+
+def stream_to_s3(config, remote_root, s3client):
+    # the stream path of download_and_publish up to the manifest's UPLOADED, before anything is published.
+    # The manifest is left open, like a killed run leaves it.
+    manifest = transfer_manifest.open_manifest(FEED_TYPE, config, '/')
+    sftp = standins.FakeSFTPConnection(remote_root)
+    transfer = dummydownloader.S3StreamTransfer(s3client, FEED_TYPE, config)
+    streamed = {}
+    for entry in sftp.listdir_attr():
+        transfer(sftp, entry)
+        key = manifest.mark_downloaded(entry.filename, entry.st_size, entry.st_mtime, entry.filename)
+        s3_key, etag, content_md5 = transfer.uploaded.pop(entry.filename)
+        manifest.mark_uploaded(key, s3_key, etag)
+        streamed[entry.filename] = s3_key, content_md5, key
+    return manifest, streamed
+
+
+def restart(config, s3client):
+    # the start-up of the next run
+    mq_connection = standins.FakeMQConnection()
+    manifest = transfer_manifest.open_manifest(FEED_TYPE, config, '/')
+    publish_queue = dummydownloader.PublishQueue(mq_connection, s3client, FEED_TYPE, config, manifest)
+    try:
+        result = dummydownloader.publish_files(mq_connection, s3client, FEED_TYPE, config, publish_queue)
+    finally:
+        publish_queue.close()
+    return result, manifest, mq_connection
+
+
+def check_republished(streamed, s3client, manifest, mq_connection):
+    headers = dict((body, properties.headers) for exchange, routing_key, body, properties
+                   in mq_connection.published)
+    assert sorted(headers) == sorted(streamed)
+    for name, (s3_key, content_md5, key) in streamed.items():
+        assert headers[name]['data.s3keyprefix'] + name == s3_key
+        # the size of the remote file, recorded in the key of its manifest entry
+        assert headers[name]['data.size'] == key[1]
+        assert (BUCKET, s3_key) in s3client.objects
+        assert manifest.get(*key)[1] == transfer_manifest.PUBLISHED
+    assert manifest.get_uploaded() == []
+
+
+def test_killed_between_upload_and_publish(feed):
+    config, remote_root, names = feed
+    s3client = standins.FakeS3Client()
+    killed_manifest, streamed = stream_to_s3(config, remote_root, s3client)
+    requests = s3client.request_count
+    assert sorted(streamed) == sorted(names)
+
+    result, manifest, mq_connection = restart(config, s3client)
+
+    assert result
+    check_republished(streamed, s3client, manifest, mq_connection)
+    # published under the recorded S3 keys, nothing is uploaded again
+    assert s3client.request_count == requests
+    manifest.close()
+    killed_manifest.close()
+
+
+def test_failed_commit_after_upload(feed):
+    config, remote_root, names = feed
+    s3client = standins.FakeS3Client()
+    manifest, streamed = stream_to_s3(config, remote_root, s3client)
+    publish_queue = dummydownloader.PublishQueue(FailingCommitConnection(), s3client, FEED_TYPE, config, manifest)
+    for name, (s3_key, content_md5, key) in sorted(streamed.items()):
+        publish_queue.put(name, s3_key, key[1], content_md5, key)
+    assert not publish_queue.drain()
+    publish_queue.close()
+    assert len(manifest.get_uploaded()) == len(names)
+    manifest.close()
+
+    result, manifest, mq_connection = restart(config, s3client)
+
+    assert result
+    check_republished(streamed, s3client, manifest, mq_connection)
+    manifest.close()
@@ -0,0 +1,98 @@
+import os
+import time
+
+import pytest
+
+import dummydownloader
+import remote_listing
+import standins
+import transfer_manifest
+
+
+@pytest.fixture
+def manifest(tmp_path):
+    manifest = transfer_manifest.TransferManifest(str(tmp_path / 'manifest.db'))
+    yield manifest
+    manifest.close()
+
+
+def test_stages(manifest):
+    assert manifest.get('/in/EDI.edi', 10, 100) is None
+    assert manifest.get_unfinished('EDI.edi') is None
+
+    key = manifest.mark_downloaded('/in/EDI.edi', 10, 100.7, 'EDI.edi')
+    assert key == ('/in/EDI.edi', 10, 100)
+    assert manifest.get('/in/EDI.edi', 10, 100.7) == ('EDI.edi', transfer_manifest.DOWNLOADED, None, None)
+    assert manifest.get_unfinished('EDI.edi') == (transfer_manifest.DOWNLOADED, None, None, key)
+    assert manifest.get_uploaded() == []
+
+    manifest.mark_uploaded(key, '2020/01/01/EDI.edi', '"etag"')
+    assert manifest.get_unfinished('EDI.edi') == (transfer_manifest.UPLOADED, '2020/01/01/EDI.edi', '"etag"', key)
+    assert manifest.get_uploaded() == [('EDI.edi', '2020/01/01/EDI.edi', 10, key)]
+    assert not manifest.is_published('EDI.edi')
+
+    manifest.mark_published([key])
+    assert manifest.get(*key)[1] == transfer_manifest.PUBLISHED
+    assert manifest.get_unfinished('EDI.edi') is None
+    assert manifest.get_uploaded() == []
+    assert manifest.is_published('EDI.edi')
+
+
+def test_stages_never_go_back(manifest):
+    key = manifest.mark_downloaded('/in/EDI.edi', 10, 100, 'EDI.edi')
+    manifest.mark_published([key])
+    manifest.mark_uploaded(key, '2020/01/01/EDI.edi', '"etag"')
+    assert manifest.get(*key) == ('EDI.edi', transfer_manifest.PUBLISHED, None, None)
+
+
+def test_later_stages_only_update_their_own_entry(manifest):
+    # an earlier remote file of the same name that never got further than downloaded
+    stale = manifest.mark_downloaded('/in/EDI.edi', 10, 100, 'EDI.edi')
+    key = manifest.mark_downloaded('/in/EDI.edi', 20, 200, 'EDI.edi')
+
+    manifest.mark_uploaded(key, '2020/01/01/EDI.edi', '"etag"')
+    manifest.mark_published([key])
+
+    assert manifest.get(*stale)[1] == transfer_manifest.DOWNLOADED
+    assert manifest.get(*key)[1] == transfer_manifest.PUBLISHED
+    # the file in download_dir is the one recorded last
+    assert manifest.get_unfinished('EDI.edi') is None
+    assert manifest.is_published('EDI.edi')
+
+
+def test_published_entries_are_pruned(tmp_path):
+    path = str(tmp_path / 'manifest.db')
+    manifest = transfer_manifest.TransferManifest(path)
+    old = manifest.mark_downloaded('/in/OLD.edi', 10, 100, 'OLD.edi')
+    manifest.mark_published([old])
+    waiting = manifest.mark_downloaded('/in/WAITING.edi', 10, 100, 'WAITING.edi')
+    with manifest.db:
+        manifest.db.execute("UPDATE transfers SET updated = ?", (time.time() - 31 * 86400,))
+    manifest.close()
+
+    manifest = transfer_manifest.TransferManifest(path, retention_days=30)
+    assert manifest.get(*old) is None
+    assert manifest.get(*waiting)[1] == transfer_manifest.DOWNLOADED
+    manifest.close()
+
+
+def test_skip_processed_files(manifest, tmp_path):
+    download_dir = str(tmp_path)
+    entries = [standins.FakeSFTPAttributes(name, 10, 100) for name in ('NEW.edi', 'PUBLISHED.edi', 'WAITING.edi',
+                                                                      'GONE.edi', 'CHANGED.edi')]
+    published = manifest.mark_downloaded('/in/PUBLISHED.edi', 10, 100, 'PUBLISHED.edi')
+    manifest.mark_published([published])
+    # still in download_dir, picked up by the start-up scan
+    manifest.mark_downloaded('/in/WAITING.edi', 10, 100, 'WAITING.edi')
+    (tmp_path / 'WAITING.edi').write_bytes(b'x' * 10)
+    # recorded, but its local copy is gone without it being published
+    manifest.mark_downloaded('/in/GONE.edi', 10, 100, 'GONE.edi')
+    # the server has a new file under an old name
+    manifest.mark_downloaded('/in/CHANGED.edi', 10, 50, 'CHANGED.edi')
+
+    listing = remote_listing.ListingCache()
+    listing.select(entries)
+    remaining = dummydownloader.skip_processed_files(manifest, '/in', entries, download_dir, listing)
+
+    assert [entry.filename for entry in remaining] == ['NEW.edi', 'GONE.edi', 'CHANGED.edi']
+    assert [name for name, cached in sorted(listing.files.items()) if cached[3]] == ['PUBLISHED.edi', 'WAITING.edi']
@@ -0,0 +1,110 @@
+import os
+import threading
+import time
+
+# stages a remote file goes through, in order
+DOWNLOADED = 1
+UPLOADED = 2
+PUBLISHED = 3
+
+
+class TransferManifest(object):
+    """
+    On-disk record (SQLite) of every remote file the downloader has processed, keyed by remote path, size and
+    mtime, with the last stage each one reached: downloaded, uploaded to S3 (with the object's key and ETag)
+    and published. Lookups go through the primary key or the local_name index, so they stay fast with millions
+    of entries. Published entries older than 'retention_days' are pruned when the manifest is opened.
+    """
+
+    def __init__(self, path, retention_days=30):
+        self.path = path
+        self.lock = threading.Lock()
+        import sqlite3
+
+        self.db = sqlite3.connect(path, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS transfers ("
+                            "remote_path TEXT NOT NULL, size INTEGER NOT NULL, mtime INTEGER NOT NULL, "
+                            "local_name TEXT NOT NULL, stage INTEGER NOT NULL, s3_key TEXT, etag TEXT, "
+                            "updated REAL NOT NULL, PRIMARY KEY (remote_path, size, mtime)) WITHOUT ROWID")
+            self.db.execute("CREATE INDEX IF NOT EXISTS transfers_local_name ON transfers (local_name, stage)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS transfers_updated ON transfers (updated)")
+            if retention_days:
+                self.db.execute("DELETE FROM transfers WHERE stage = ? AND updated < ?",
+                                (PUBLISHED, time.time() - retention_days * 86400))
+
+    def get(self, remote_path, size, mtime):
+        # (local_name, stage, s3_key, etag) or None
+        with self.lock:
+            return self.db.execute("SELECT local_name, stage, s3_key, etag FROM transfers "
+                                   "WHERE remote_path = ? AND size = ? AND mtime = ?",
+                                   (remote_path, size, int(mtime))).fetchone()
+
+    def get_unfinished(self, local_name):
+        # (stage, s3_key, etag, key) of the file in download_dir, or None if it has not been recorded
+        # or has been published already. The file is the remote file of that name recorded last, the entries
+        # of the earlier ones are left as they are.
+        with self.lock:
+            row = self.db.execute("SELECT stage, s3_key, etag, remote_path, size, mtime FROM transfers "
+                                  "WHERE local_name = ? ORDER BY updated DESC LIMIT 1",
+                                  (local_name,)).fetchone()
+        if row is None or row[0] >= PUBLISHED:
+            return None
+        return row[:3] + (row[3:],)
+
+    def get_uploaded(self):
+        # (local_name, s3_key, size, key) of every entry uploaded to S3 and not published yet, oldest first
+        with self.lock:
+            rows = self.db.execute("SELECT local_name, s3_key, size, remote_path, mtime FROM transfers "
+                                   "WHERE stage = ? ORDER BY updated", (UPLOADED,)).fetchall()
+        return [(local_name, s3_key, size, (remote_path, size, mtime))
+                for local_name, s3_key, size, remote_path, mtime in rows]
+
+    def is_published(self, local_name):
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM transfers WHERE local_name = ? AND stage = ? LIMIT 1",
+                                   (local_name, PUBLISHED)).fetchone() is not None
+
+    def mark_downloaded(self, remote_path, size, mtime, local_name):
+        # returns the key of the entry, (remote_path, size, mtime), the later stages of the file are recorded
+        # under it. A local name is reused by every remote file of that name, so it is no key.
+        key = (remote_path, size, int(mtime))
+        with self.lock, self.db:
+            self.db.execute("INSERT OR REPLACE INTO transfers "
+                            "(remote_path, size, mtime, local_name, stage, s3_key, etag, updated) "
+                            "VALUES (?, ?, ?, ?, ?, NULL, NULL, ?)",
+                            key + (local_name, DOWNLOADED, time.time()))
+        return key
+
+    def mark_uploaded(self, key, s3_key, etag):
+        with self.lock, self.db:
+            self.db.execute("UPDATE transfers SET stage = ?, s3_key = ?, etag = ?, updated = ? "
+                            "WHERE remote_path = ? AND size = ? AND mtime = ? AND stage < ?",
+                            (UPLOADED, s3_key, etag, time.time()) + tuple(key) + (UPLOADED,))
+
+    def mark_published(self, keys):
+        # one transaction for a whole batch of confirmed messages
+        now = time.time()
+        with self.lock, self.db:
+            self.db.executemany("UPDATE transfers SET stage = ?, updated = ? "
+                                "WHERE remote_path = ? AND size = ? AND mtime = ? AND stage < ?",
+                                [(PUBLISHED, now) + tuple(key) + (PUBLISHED,) for key in keys])
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+def open_manifest(feed_type, config, home):
+    # opt-in per feed with 'manifest_file' in ftp_client, relative paths are under the home directory
+    # like download_dir
+    ftp_client = config[feed_type]['ftp_client']
+    if not ftp_client.get('manifest_file'):
+        return None
+
+    path = os.path.join(home, ftp_client['manifest_file'])
+    os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    return TransferManifest(path, ftp_client.get('manifest_retention_days', 30))
@@ -0,0 +1,75 @@
+import collections
+import fnmatch
+import re
+
+# order the files of a cycle are transferred in: as listed by the server, smallest first, oldest first,
+# or by the first of the feed's 'priority_patterns' they match (oldest first among equals)
+POLICIES = ('fifo', 'size', 'age', 'priority')
+
+# files at least this big go through the large-file lane when the feed has 'large_file_sessions'
+LARGE_FILE_THRESHOLD = 64 * 1024 * 1024
+
+# a file in download_dir, ordered like a remote listing entry
+LocalFile = collections.namedtuple('LocalFile', ('filename', 'st_size', 'st_mtime'))
+
+
+class TransferSchedule(object):
+    """
+    How a feed's files are scheduled, from its ftp_client config:
+    'schedule' is one of POLICIES (fifo by default), 'priority_patterns' a list of file name patterns, highest
+    priority first, files matching none of them come last.
+    'large_file_sessions' > 0 opens a lane for files of at least 'large_file_threshold' bytes: they are
+    downloaded on SFTP sessions of their own, uploaded by an S3 worker of their own and published as soon as
+    they are done, so small files keep flowing past them instead of waiting behind them.
+    'strict_order' is for feeds whose consumers depend on the order of the messages: every file is downloaded
+    and published one after the other in schedule order, on one session and without the large-file lane.
+    """
+
+    def __init__(self, policy='fifo', priority_patterns=(), large_file_threshold=LARGE_FILE_THRESHOLD,
+                 large_file_sessions=0, strict_order=False):
+        if policy not in POLICIES:
+            raise ValueError("unknown schedule '" + str(policy) + "', expected one of " + str(list(POLICIES)))
+        self.policy = policy
+        self.priority_patterns = [re.compile(fnmatch.translate(pattern)) for pattern in priority_patterns]
+        self.large_file_threshold = large_file_threshold
+        self.strict_order = strict_order
+        self.large_file_sessions = 0 if strict_order else large_file_sessions
+
+    @property
+    def has_large_lane(self):
+        return self.large_file_sessions > 0
+
+    def is_large(self, file_size):
+        return self.has_large_lane and file_size is not None and file_size >= self.large_file_threshold
+
+    def get_priority(self, filename):
+        for priority, pattern in enumerate(self.priority_patterns):
+            if pattern.match(filename):
+                return priority
+        return len(self.priority_patterns)
+
+    def order(self, entries):
+        # sorted() is stable, files the policy cannot tell apart keep their listing order
+        if self.policy == 'size':
+            return sorted(entries, key=lambda entry: entry.st_size)
+        if self.policy == 'age':
+            return sorted(entries, key=lambda entry: entry.st_mtime)
+        if self.policy == 'priority':
+            return sorted(entries, key=lambda entry: (self.get_priority(entry.filename), entry.st_mtime))
+        return list(entries)
+
+    def split(self, entries):
+        # (small files, large files), each in schedule order
+        small = []
+        large = []
+        for entry in self.order(entries):
+            (large if self.is_large(entry.st_size) else small).append(entry)
+        return small, large
+
+
+def get_transfer_schedule(feed_type, config):
+    ftp_client = config[feed_type]['ftp_client']
+
+    return TransferSchedule(ftp_client.get('schedule', 'fifo'), ftp_client.get('priority_patterns', ()),
+                            int(ftp_client.get('large_file_threshold', LARGE_FILE_THRESHOLD)),
+                            int(ftp_client.get('large_file_sessions', 0)), bool(ftp_client.get('strict_order')))